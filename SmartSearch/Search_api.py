@@ -0,0 +1,375 @@
+"""
+HTTP-слой SmartSearch (FastAPI): маршруты, модели ответов, сериализация,
+метрики запросов и лог медленных запросов.
+
+Индекс, поиск и операции над индексом живут в Search_service_module, пул
+процессов и допуск запросов — в Search_pool. Обработчики читают индекс из
+модуля сервиса в момент запроса, так что подмена индекса видна сразу.
+Приложение доступно и как Search_service_module.app:
+
+    uvicorn Search_api:app --port 8001
+    python Search_service_module.py serve   # то же + build / --workers / --shards
+"""
+import asyncio
+import time
+from typing import Annotated, Any, Dict, Iterable, List, Tuple
+
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, TypeAdapter
+from starlette.concurrency import run_in_threadpool
+
+import Search_index
+import Search_pool
+import Search_service_module as svc
+
+app = FastAPI(title="TH3 Smart Search (CSV-based)")
+
+
+@app.on_event("startup")
+def on_startup():
+    svc.on_startup()
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    svc.on_shutdown()
+
+
+# ==========================
+#   МОДЕЛИ ЗАПРОСОВ И ОТВЕТОВ
+# ==========================
+
+class SearchResult(BaseModel):
+    id: int
+    name: str
+    description: str | None = None
+    score: float
+    score_name: float
+    score_desc: float | None = None  # None — описание не оценено: кончился бюджет времени
+    score_semantic: float | None = None  # 100 * косинус, только в mode=hybrid
+    score_spec: float | None = None  # 100 * доля совпавших характеристик запроса
+
+
+_search_results_adapter = TypeAdapter(List[SearchResult])
+
+
+class BatchSearchRequest(BaseModel):
+    queries: List[Annotated[str, Field(max_length=svc.MAX_QUERY_CHARS)]] = Field(
+        ..., min_length=1, max_length=svc.MAX_BATCH_QUERIES
+    )
+    top_k: int = Field(svc.DEFAULT_TOP_K, ge=1, le=50)
+    min_score: float = Field(svc.DEFAULT_MIN_SCORE, ge=0.0, le=100.0)
+    stream: bool = Field(False, description="Отдавать ответ построчно в NDJSON")
+    budget_ms: float | None = Field(
+        svc.BATCH_TIME_BUDGET_MS, gt=0, le=600_000, description="Бюджет времени на весь пакет"
+    )
+
+
+class BatchSearchResult(BaseModel):
+    query: str
+    results: List[SearchResult]
+    partial: bool = False  # бюджет кончился до оценки всех описаний
+
+
+_batch_results_adapter = TypeAdapter(List[BatchSearchResult])
+
+
+class ItemResult(BaseModel):
+    id: int  # id_сте
+    name: str
+    score: float
+
+
+class ItemGroup(BaseModel):
+    id: int  # id_категории
+    name: str
+    score: float  # лучшая СТЕ категории
+    items: List[ItemResult]
+
+
+_item_groups_adapter = TypeAdapter(List[ItemGroup])
+
+
+class Suggestion(BaseModel):
+    id: int
+    name: str
+    distance: int  # опечаток относительно префикса (Левенштейн)
+
+
+_suggestions_adapter = TypeAdapter(List[Suggestion])
+
+
+# ==========================
+#   МАРШРУТЫ
+# ==========================
+
+@app.get("/health")
+async def health():
+    # async: выполняется прямо в event loop и не ждёт потоков, занятых поиском
+    if svc.shard_client is not None:
+        # шарды опрашиваются с коротким таймаутом, в тредпуле — event loop не ждёт
+        shards = await run_in_threadpool(svc.shard_client.health)
+        return {**shards, "pending_searches": Search_pool.pending_searches}
+    return svc.index_health()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus (по текущему процессу-воркеру)."""
+    index = svc.cat_index
+    lemma_stats = svc._lemma_cache.stats()
+    result_stats = svc._result_cache.stats()
+    gauges = {
+        "smartsearch_index_categories": ("Категорий в индексе", 0 if index is None else len(index)),
+        "smartsearch_index_version": ("Версия текущего индекса", 0 if index is None else index.version),
+        "smartsearch_pending_searches": ("Поисков в работе", Search_pool.pending_searches),
+        "smartsearch_lemma_cache_size": ("Слов в кэше лемм", lemma_stats["size"]),
+        "smartsearch_lemma_cache_hit_rate": ("Доля попаданий в кэш лемм", lemma_stats["hit_rate"]),
+        "smartsearch_result_cache_size": ("Записей в кэше результатов", result_stats["size"]),
+    }
+    return PlainTextResponse(
+        svc.metrics.render(gauges), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.post("/reload")
+def reload_endpoint(
+    force: bool = Query(False, description="Пересобрать, даже если есть снимок"),
+    incremental: bool = Query(False, description="Перелемматизировать только изменившиеся категории"),
+    shard: int | None = Query(None, ge=0, description="Только этот шард (SEARCH_SHARDS)"),
+):
+    """Пересобрать индекс (можно дергать после обновления CSV), см. reload_index."""
+    return svc.reload_index(force=force, incremental=incremental, shard=shard)
+
+
+@app.post("/index/upsert")
+def upsert_endpoint(items: List[svc.CategoryUpsert]):
+    """Добавить или заменить категории без пересборки всего индекса."""
+    return svc.upsert_categories(items)
+
+
+@app.delete("/index/{category_id}")
+def delete_endpoint(category_id: int):
+    return svc.delete_category(category_id)
+
+
+@app.get("/suggest", response_model=List[Suggestion])
+async def suggest(
+    q: str = Query(..., min_length=1, max_length=svc.MAX_QUERY_CHARS),
+    limit: int = Query(svc.SUGGEST_LIMIT, ge=1, le=50),
+    max_distance: int | None = Query(
+        None, ge=0, le=Search_index.SUGGEST_MAX_DISTANCE, description="По умолчанию — по длине префикса"
+    ),
+):
+    """
+    Автодополнение названий категорий на каждое нажатие клавиши.
+    Обход префиксного дерева ограничен глубиной и числом опечаток, поэтому
+    выполняется прямо в event loop, без пула поиска и без fuzzy-скоринга.
+    """
+    t0 = time.perf_counter()
+    index = svc._suggest_index
+    if svc.shard_client is not None:
+        svc.metrics.inc("smartsearch_queries_total", endpoint="suggest")
+        results = await run_in_threadpool(svc.shard_client.suggest, q, limit, max_distance)
+    elif index is None or len(index) == 0:
+        return []
+    else:
+        svc.metrics.inc("smartsearch_queries_total", endpoint="suggest")
+        results = svc.suggest_categories(index, q, limit=limit, max_distance=max_distance)
+    body = _suggestions_adapter.dump_json(_suggestions_adapter.validate_python(results))
+    svc.metrics.observe("smartsearch_request_seconds", time.perf_counter() - t0, endpoint="suggest")
+    return Response(content=body, media_type="application/json")
+
+
+@app.get("/search/categories", response_model=List[SearchResult])
+async def search_categories(
+    q: str = Query(..., min_length=1, max_length=svc.MAX_QUERY_CHARS),
+    top_k: int = Query(svc.DEFAULT_TOP_K, ge=1, le=50),
+    min_score: float = Query(svc.DEFAULT_MIN_SCORE, ge=0.0, le=100.0),
+    exhaustive: bool = Query(False, description="Полный проход без инвертированного индекса"),
+    mode: str = Query("lexical", pattern="^(lexical|hybrid)$", description="hybrid — + векторный поиск"),
+    budget_ms: float | None = Query(
+        svc.SEARCH_TIME_BUDGET_MS, gt=0, le=60_000, description="Бюджет времени; по умолчанию SEARCH_TIME_BUDGET_MS"
+    ),
+):
+    """
+    Скоринг уходит в пул процессов (SEARCH_EXECUTION="process") или в тредпул,
+    event loop не блокируется. Не больше MAX_PENDING_SEARCHES поисков
+    одновременно, сверх — сразу 503, а не очередь за health-чеками.
+    mode=hybrid выполняется в тредпуле: модель эмбеддингов живёт в этом процессе.
+    Если бюджет кончился до оценки всех описаний, ответ — лучшее из посчитанного
+    с заголовком X-Search-Partial: true (такой ответ не кэшируется).
+    С шардами запрос уходит во все шарды (кэшируют они сами), top-k сливаются;
+    не ответивший шард тоже даёт partial.
+    """
+    t0 = time.perf_counter()
+    index = svc.cat_index
+    client = svc.shard_client
+    if client is None and (index is None or len(index) == 0):
+        return []
+    sem = svc.sem_index
+    if mode == "hybrid" and sem is None and client is None:
+        raise HTTPException(status_code=400, detail="Семантический индекс не подключён (SEMANTIC_SEARCH)")
+    svc.metrics.inc("smartsearch_queries_total", endpoint="search")
+
+    key = None
+    results = None
+    partial = False
+    timings: Dict[str, float] = {}
+    if not exhaustive and client is None:
+        key = svc._result_cache_key(index, q, top_k, min_score) + (mode,)
+        results = svc._result_cache.get(key)
+        if results is not None:
+            svc.metrics.inc("smartsearch_result_cache_hits_total")
+
+    if results is None:
+        with Search_pool.admit_search():
+            pool = Search_pool.search_pool
+            stats: Dict[str, Any] = {}
+            # бюджет считаем от начала запроса: ожидание в очереди тоже его тратит
+            budget = None if budget_ms is None else max(budget_ms / 1000 - (time.perf_counter() - t0), 0.0)
+            if client is not None:
+                results, stats = await run_in_threadpool(
+                    client.search, q, top_k, min_score, exhaustive, mode, budget
+                )
+                if stats["cached"]:
+                    svc.metrics.inc("smartsearch_result_cache_hits_total")
+            elif mode == "hybrid":
+                import Search_semantic
+
+                results = await run_in_threadpool(
+                    Search_semantic.hybrid_search, index, sem, q,
+                    top_k=top_k, min_score=min_score, stats=stats, budget=budget,
+                )
+            elif pool is not None:
+                loop = asyncio.get_running_loop()
+                results, stats = await loop.run_in_executor(
+                    pool, Search_pool.search_in_worker, q, top_k, min_score, exhaustive, budget
+                )
+            else:
+                results = await run_in_threadpool(
+                    svc.smart_search, index, q, top_k=top_k, min_score=min_score,
+                    exhaustive=exhaustive, stats=stats, budget=budget,
+                )
+            timings = stats["timings"]
+            partial = stats["partial"]
+
+        if partial:
+            svc.metrics.inc("smartsearch_partial_results_total", endpoint="search")
+        elif key is not None:
+            svc._result_cache.put(key, results)
+
+    t_serialize = time.perf_counter()
+    body = _search_results_adapter.dump_json(_search_results_adapter.validate_python(results))
+    timings["serialize"] = time.perf_counter() - t_serialize
+
+    elapsed = time.perf_counter() - t0
+    svc.observe_search_stages(timings, endpoint="search")
+    svc.metrics.observe("smartsearch_request_seconds", elapsed, endpoint="search")
+    if not results:
+        svc.metrics.inc("smartsearch_empty_results_total")
+    if svc.SLOW_QUERY_MS is not None and elapsed * 1000 >= svc.SLOW_QUERY_MS:
+        svc.metrics.inc("smartsearch_slow_queries_total")
+        svc.logger.warning(
+            "Медленный запрос %.1f мс: q=%r top_k=%d exhaustive=%s partial=%s стадии: %s",
+            elapsed * 1000, q, top_k, exhaustive, partial,
+            ", ".join(f"{stage}={sec * 1000:.1f}мс" for stage, sec in timings.items()),
+        )
+    headers = {"X-Search-Partial": "true"} if partial else None
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@app.get("/search/items", response_model=List[ItemGroup])
+async def search_items_endpoint(
+    q: str = Query(..., min_length=1, max_length=svc.MAX_QUERY_CHARS),
+    top_k: int = Query(svc.DEFAULT_TOP_K, ge=1, le=50, description="Сколько категорий"),
+    per_category: int = Query(svc.ITEMS_PER_CATEGORY, ge=1, le=50, description="Сколько СТЕ в категории"),
+    min_score: float = Query(svc.DEFAULT_MIN_SCORE, ge=0.0, le=100.0),
+):
+    """Поиск конкретных СТЕ, сгруппированный по категориям (нужен ITEM_SEARCH=1)."""
+    t0 = time.perf_counter()
+    index = svc.cat_index
+    client = svc.shard_client
+    if client is None:
+        if index is None or len(index) == 0:
+            return []
+        if index.items is None:
+            raise HTTPException(status_code=400, detail="Индекс СТЕ не собран (ITEM_SEARCH)")
+    svc.metrics.inc("smartsearch_queries_total", endpoint="items")
+    with Search_pool.admit_search():
+        stats: Dict[str, Any] = {}
+        if client is not None:
+            results, stats = await run_in_threadpool(client.search_items, q, top_k, per_category, min_score)
+        else:
+            results = await run_in_threadpool(
+                svc.search_items, index, q, top_k=top_k, per_category=per_category,
+                min_score=min_score, stats=stats,
+            )
+
+    timings = stats["timings"]
+    t_serialize = time.perf_counter()
+    body = _item_groups_adapter.dump_json(_item_groups_adapter.validate_python(results))
+    timings["serialize"] = time.perf_counter() - t_serialize
+    svc.observe_search_stages(timings, endpoint="items")
+    svc.metrics.observe("smartsearch_request_seconds", time.perf_counter() - t0, endpoint="items")
+    if not results:
+        svc.metrics.inc("smartsearch_empty_results_total")
+    headers = None
+    if stats.get("partial"):
+        svc.metrics.inc("smartsearch_partial_results_total", endpoint="items")
+        headers = {"X-Search-Partial": "true"}
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@app.post("/search/categories/batch", response_model=List[BatchSearchResult])
+def search_categories_batch(req: BatchSearchRequest):
+    """
+    Поиск по списку запросов за один HTTP-вызов.
+    stream=true — ответ в NDJSON (одна строка на запрос) по мере готовности.
+    """
+    t0 = time.perf_counter()
+    index = svc.cat_index
+    stats: Dict[str, Any] = {"timings": {}}
+    budget = None if req.budget_ms is None else req.budget_ms / 1000
+    if svc.shard_client is not None:
+        pairs: Iterable[Tuple[str, List[Dict[str, Any]]]] = svc.shard_client.iter_batch(
+            req.queries, req.top_k, req.min_score, stats=stats, budget=budget
+        )
+    elif index is None or len(index) == 0:
+        pairs = ((q, []) for q in req.queries)
+    else:
+        pairs = svc.iter_smart_search_batch(
+            index, req.queries, top_k=req.top_k, min_score=req.min_score, stats=stats, budget=budget,
+        )
+    svc.metrics.inc("smartsearch_queries_total", len(req.queries), endpoint="batch")
+
+    def result(q: str, results: List[Dict[str, Any]]) -> BatchSearchResult:
+        return BatchSearchResult(query=q, results=results, partial=q in stats.get("partial_queries", ()))
+
+    def observe(serialize_seconds: float) -> None:
+        if stats.get("partial_queries"):
+            svc.metrics.inc("smartsearch_partial_results_total", len(stats["partial_queries"]), endpoint="batch")
+        stats["timings"]["serialize"] = serialize_seconds
+        svc.observe_search_stages(stats["timings"], endpoint="batch")
+        svc.metrics.observe("smartsearch_request_seconds", time.perf_counter() - t0, endpoint="batch")
+
+    if req.stream:
+        def ndjson_lines():
+            serialize = 0.0
+            for q, results in pairs:
+                t_item = time.perf_counter()
+                line = result(q, results).model_dump_json() + "\n"
+                serialize += time.perf_counter() - t_item
+                yield line
+            observe(serialize)
+
+        return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+    pairs = list(pairs)
+    t_serialize = time.perf_counter()
+    body = _batch_results_adapter.dump_json(
+        [result(q, results) for q, results in pairs]
+    )
+    observe(time.perf_counter() - t_serialize)
+    return Response(content=body, media_type="application/json")
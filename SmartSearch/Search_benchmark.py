@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+"""
+Бенчмарки SmartSearch на синтетическом каталоге в формате result_itr4.csv.
+
+    python Search_benchmark.py aggregation --categories 2000 --products 50
+    python Search_benchmark.py ingestion --categories 2000 --chunk-rows 50000
+    python Search_benchmark.py normalize --categories 2000 --products 50
+    python Search_benchmark.py search --sizes 1000,10000,100000 --queries 2000 --concurrency 4
+    python Search_benchmark.py search --sizes 10000 --save base.json
+    python Search_benchmark.py search --sizes 10000 --baseline base.json  # код 1 при регрессии
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+import Search_index
+import Search_service_module as svc
+
+
+# ==========================
+#   СИНТЕТИЧЕСКИЙ КАТАЛОГ
+# ==========================
+
+_WORDS = [
+    "бумага", "офисная", "ручка", "шариковая", "карандаш", "чернографитный", "степлер",
+    "папка", "регистратор", "тетрадь", "клей", "ножницы", "мыло", "жидкое", "перчатки",
+    "нитриловые", "молоко", "вода", "питьевая", "кабель", "медный", "принтер", "лазерный",
+    "картридж", "стол", "письменный", "стул", "офисный", "лампа", "светодиодная",
+    "ноутбук", "маркер", "перманентный", "салфетки", "влажные", "контейнер", "пищевой",
+]
+_BRANDS = ["hp", "lenovo", "samsung", "brauberg", "erich krause", "kores", "bic"]
+_SPECS = {
+    "Объем": ["250 мл", "500 мл", "1 л", "5 л"],
+    "Цвет": ["синий", "красный", "черный", "белый", "зеленый"],
+    "Материал": ["пластик", "металл", "бумага", "картон", "нитрил"],
+    "Вес": ["100 г", "500 г", "1 кг"],
+    "Формат": ["A4", "A3", "A5"],
+    "Тип": ["одноразовый", "многоразовый"],
+    "Количество в упаковке": ["10 шт", "50 шт", "100 шт", "500 шт"],
+    "Страна бренда": ["Россия", "Китай", "Германия"],
+}
+N_SPEC_COLUMNS = 31
+
+
+def make_synthetic_csv(
+    path: str, n_categories: int, products_per_category: int = 20, seed: int = 42
+) -> str:
+    """
+    CSV той же формы, что result_itr4.csv: id_сте, название_сте, id_категории,
+    название_категории, производитель, страна_происхождения, spec1..spec31.
+    """
+    rnd = random.Random(seed)
+    spec_keys = list(_SPECS)
+    header = [
+        "id_сте", "название_сте", "id_категории", "название_категории",
+        "производитель", "страна_происхождения",
+    ] + [f"spec{i}" for i in range(1, N_SPEC_COLUMNS + 1)]
+
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        ste_id = 0
+        for cat in range(n_categories):
+            cat_name = " ".join(rnd.sample(_WORDS, rnd.randint(1, 3))).capitalize()
+            for _ in range(rnd.randint(1, 2 * products_per_category - 1)):
+                ste_id += 1
+                brand = rnd.choice(_BRANDS)
+                specs = [
+                    f"{key}: {rnd.choice(_SPECS[key])}"
+                    for key in rnd.sample(spec_keys, rnd.randint(2, len(spec_keys)))
+                ]
+                writer.writerow(
+                    [ste_id, f"{cat_name} {brand} {rnd.choice(_WORDS)}", 10_000 + cat, cat_name,
+                     brand, rnd.choice(_SPECS["Страна бренда"])]
+                    + specs + [""] * (N_SPEC_COLUMNS - len(specs))
+                )
+    return path
+
+
+def _timeit(fn: Callable[[], object], repeat: int) -> List[float]:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+# ==========================
+#   АГРЕГАЦИЯ CSV -> КАТЕГОРИИ
+# ==========================
+
+def bench_aggregation(csv_path: str, repeat: int = 3) -> None:
+    """Построчная (apply + iterrows) против векторной агрегации + проверка совпадения."""
+    df = pd.read_csv(csv_path)
+    print(f"СТЕ: {len(df)}, категорий: {df['id_категории'].nunique()}")
+
+    rowwise = svc.aggregate_categories_rowwise(df.copy())
+    vectorized = svc.aggregate_categories(df.copy())
+    same = rowwise.reset_index(drop=True).equals(vectorized.reset_index(drop=True))
+    print(f"Результаты совпадают: {same}")
+
+    t_row = min(_timeit(lambda: svc.aggregate_categories_rowwise(df.copy()), repeat))
+    t_vec = min(_timeit(lambda: svc.aggregate_categories(df.copy()), repeat))
+    print(f"rowwise:    {t_row:.3f} с")
+    print(f"vectorized: {t_vec:.3f} с  (x{t_row / t_vec:.1f})")
+
+
+def bench_ingestion(csv_path: str, chunk_rows: int) -> None:
+    """Пиковая память (tracemalloc) чтения CSV целиком против потокового."""
+    svc.CSV_PATH = csv_path
+    results = {}
+    for label, rows in (("full", None), (f"chunked({chunk_rows})", chunk_rows)):
+        svc.CSV_CHUNK_ROWS = rows
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        results[label] = svc.load_categories_from_csv()
+        elapsed = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label:>18}: {elapsed:.3f} с, пик памяти {peak / 2**20:.1f} МБ")
+    full, chunked = results.values()
+    print(f"Результаты совпадают: {full.equals(chunked)}")
+
+
+# ==========================
+#   НОРМАЛИЗАЦИЯ ТЕКСТА
+# ==========================
+
+_NOISE = "ЁёAZaz09 %/.,-_:;!?()[]«»№\t\n\u00a0\u2009\u0130\u212aßµ—"
+
+
+def _noisy_texts(n: int, seed: int = 7) -> List[str]:
+    """Строки из «неудобных» символов: регистр, ё, пунктуация, юникодные пробелы."""
+    rnd = random.Random(seed)
+    alphabet = _NOISE + "".join(_WORDS)
+    return ["".join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 80))) for _ in range(n)]
+
+
+def bench_normalize(csv_path: str, repeat: int = 3) -> None:
+    """
+    Однопроходный normalize_text / lemmatize_text против прежних
+    (normalize_text_legacy / lemmatize_text_legacy) на описаниях категорий
+    + проверка, что результаты совпадают.
+    """
+    svc.CSV_PATH = csv_path
+    cats = svc.load_categories_from_csv()
+    texts = cats["название_категории"].tolist() + cats["category_desc_raw"].tolist()
+    checked = texts + _noisy_texts(5000)
+    print(f"Текстов: {len(texts)}, символов: {sum(map(len, texts))}")
+
+    same_norm = all(svc.normalize_text(t) == svc.normalize_text_legacy(t) for t in checked)
+    same_lem = all(svc.lemmatize_text(t) == svc.lemmatize_text_legacy(t) for t in checked)
+    print(f"normalize_text совпадает: {same_norm}, lemmatize_text совпадает: {same_lem}")
+
+    # кэш лемм уже прогрет проверкой выше — сравниваем именно разбор текста
+    for label, new, old in (
+        ("normalize_text", svc.normalize_text, svc.normalize_text_legacy),
+        ("lemmatize_text", svc.lemmatize_text, svc.lemmatize_text_legacy),
+    ):
+        t_old = min(_timeit(lambda: [old(t) for t in texts], repeat))
+        t_new = min(_timeit(lambda: [new(t) for t in texts], repeat))
+        print(f"{label}: прежний {t_old:.3f} с, однопроходный {t_new:.3f} с  (x{t_old / t_new:.1f})")
+
+
+# ==========================
+#   ПОИСК: QPS И ЗАДЕРЖКИ
+# ==========================
+
+# Набор запросов: (тип, доля). layout — русский запрос, набранный в EN-раскладке
+QUERY_MIX = (
+    ("exact", 0.20),     # название категории целиком
+    ("word", 0.20),      # одно слово из названия
+    ("prefix", 0.10),    # начало слова, как при наборе
+    ("typo", 0.20),      # пропущенная / переставленная / заменённая буква
+    ("layout", 0.15),    # ",evfuf" вместо "бумага"
+    ("spec", 0.10),      # слово + характеристика: "бумага a4", "вода 5 л"
+    ("miss", 0.05),      # мусор, которого в каталоге нет
+)
+_RU_TO_EN = str.maketrans({ru: chr(en) for en, ru in svc.EN_TO_RU.items()})
+_RU_LETTERS = "абвгдежзийклмнопрстуфхцчшщыьэюя"
+
+
+def _typo(word: str, rnd: random.Random) -> str:
+    if len(word) < 4:
+        return word
+    i = rnd.randrange(1, len(word) - 1)
+    kind = rnd.choice(("drop", "swap", "replace"))
+    if kind == "drop":
+        return word[:i] + word[i + 1:]
+    if kind == "swap":
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    return word[:i] + rnd.choice(_RU_LETTERS) + word[i + 1:]
+
+
+def make_query_mix(names: List[str], n_queries: int, seed: int = 7) -> List[Tuple[str, str]]:
+    """(тип, запрос) по названиям категорий каталога в пропорциях QUERY_MIX."""
+    rnd = random.Random(seed)
+    kinds = [kind for kind, _ in QUERY_MIX]
+    weights = [w for _, w in QUERY_MIX]
+    spec_values = [v for values in _SPECS.values() for v in values]
+
+    queries = []
+    for kind in rnd.choices(kinds, weights, k=n_queries):
+        name = rnd.choice(names).lower()
+        words = name.split() or [name]
+        word = rnd.choice(words)
+        if kind == "exact":
+            q = name
+        elif kind == "word":
+            q = word
+        elif kind == "prefix":
+            q = word[:rnd.randint(3, max(3, len(word) - 1))]
+        elif kind == "typo":
+            q = " ".join(_typo(w, rnd) if w == word else w for w in words)
+        elif kind == "layout":
+            q = name.translate(_RU_TO_EN)
+        elif kind == "spec":
+            q = f"{word} {rnd.choice(spec_values).lower()}"
+        else:
+            q = "".join(rnd.choice("qwxzjv") for _ in range(rnd.randint(4, 8)))
+        queries.append((kind, q))
+    return queries
+
+
+def latency_summary(latencies: List[float], wall: float) -> Dict[str, float]:
+    """QPS по общему времени прогона + перцентили задержки одного запроса (мс)."""
+    lat = np.asarray(latencies) * 1000
+    p50, p95, p99 = np.percentile(lat, [50, 95, 99])
+    return {
+        "queries": len(lat),
+        "qps": round(len(lat) / wall, 1),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(float(lat.max()), 3),
+    }
+
+
+def _print_summary(label: str, summary: Dict[str, float]) -> None:
+    print(
+        f"  {label:<24} QPS {summary['qps']:>9.1f}   p50 {summary['p50_ms']:>8.2f} мс"
+        f"   p95 {summary['p95_ms']:>8.2f} мс   p99 {summary['p99_ms']:>8.2f} мс"
+    )
+
+
+def run_in_process(index, queries: List[Tuple[str, str]], warmup: int) -> Dict[str, Dict[str, float]]:
+    """smart_search напрямую, последовательно; сводка общая и по типам запросов."""
+    for _, q in queries[:warmup]:
+        svc.smart_search(index, q)
+
+    latencies: Dict[str, List[float]] = {}
+    t_start = time.perf_counter()
+    for kind, q in queries:
+        t0 = time.perf_counter()
+        svc.smart_search(index, q)
+        latencies.setdefault(kind, []).append(time.perf_counter() - t0)
+    wall = time.perf_counter() - t_start
+
+    everything = [t for values in latencies.values() for t in values]
+    report = {"all": latency_summary(everything, wall)}
+    for kind, values in latencies.items():
+        report[kind] = latency_summary(values, sum(values))
+    return report
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_http(queries: List[Tuple[str, str]], concurrency: int, warmup: int) -> Dict[str, float]:
+    """
+    GET /search/categories через настоящий uvicorn на свободном порту.
+    Сервис подключается к уже опубликованному снимку (как воркер в serve --workers N).
+    """
+    import httpx
+    import uvicorn
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(svc.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("uvicorn не запустился")
+        time.sleep(0.05)
+
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        with httpx.Client(base_url=base_url) as client:
+            for _, q in queries[:warmup]:
+                client.get("/search/categories", params={"q": q}).raise_for_status()
+
+        slices = [queries[i::concurrency] for i in range(concurrency)]
+        latencies: List[List[float]] = [[] for _ in slices]
+
+        def worker(i: int) -> None:
+            with httpx.Client(base_url=base_url, timeout=60.0) as client:
+                for _, q in slices[i]:
+                    t0 = time.perf_counter()
+                    client.get("/search/categories", params={"q": q}).raise_for_status()
+                    latencies[i].append(time.perf_counter() - t0)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+        t_start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - t_start
+    finally:
+        server.should_exit = True
+        thread.join()
+
+    return latency_summary([t for values in latencies for t in values], wall)
+
+
+def bench_search(
+    sizes: List[int],
+    products: int,
+    n_queries: int,
+    concurrency: int,
+    http: bool = True,
+    result_cache: bool = False,
+) -> Dict[str, Dict[str, float]]:
+    """
+    Для каждого размера каталога: синтетический CSV -> индекс (через снимок,
+    как в сервисе) -> прогон QUERY_MIX в процессе и через HTTP.
+    Возвращает {"<размер>/<режим>": сводка} для сохранения / сравнения.
+    """
+    svc.logger.setLevel(logging.WARNING)
+    svc.LEMMA_CACHE_PATH = None
+    if not result_cache:
+        # иначе повторяющиеся запросы мерят кэш, а не поиск
+        svc._result_cache.maxsize = 0
+
+    results: Dict[str, Dict[str, float]] = {}
+    for size in sizes:
+        workdir = tempfile.mkdtemp(prefix="smartsearch-bench-")
+        try:
+            csv_path = make_synthetic_csv(os.path.join(workdir, "catalog.csv"), size, products)
+            svc.CSV_PATH = csv_path
+            svc.SNAPSHOT_DIR = os.path.join(workdir, "snapshots")
+
+            t0 = time.perf_counter()
+            index = svc.publish_index(svc.build_index_from_csv())
+            build = time.perf_counter() - t0
+            queries = make_query_mix(index.names.to_list(), n_queries)
+            warmup = min(100, n_queries // 10)
+            print(f"\nКатегорий: {size}, сборка индекса {build:.1f} с, запросов: {n_queries}")
+
+            report = run_in_process(index, queries, warmup)
+            _print_summary("in-process", report["all"])
+            for kind, _ in QUERY_MIX:
+                if kind in report:
+                    _print_summary(f"  {kind}", report[kind])
+            results[f"{size}/in-process"] = report["all"]
+
+            if http:
+                svc.SHARED_SNAPSHOT = True
+                try:
+                    summary = run_http(queries, concurrency, warmup)
+                finally:
+                    svc.SHARED_SNAPSHOT = False
+                _print_summary(f"http (x{concurrency})", summary)
+                results[f"{size}/http"] = summary
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def find_regressions(
+    current: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float
+) -> List[str]:
+    """Сравнение с сохранённым прогоном: p95 выросла или QPS упал больше чем на tolerance."""
+    problems = []
+    for key, now in current.items():
+        before = baseline.get(key)
+        if before is None:
+            continue
+        if now["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            problems.append(f"{key}: p95 {before['p95_ms']} -> {now['p95_ms']} мс")
+        if now["qps"] < before["qps"] / (1 + tolerance):
+            problems.append(f"{key}: QPS {before['qps']} -> {now['qps']}")
+    return problems
+
+
+# ==========================
+#   CLI
+# ==========================
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки SmartSearch")
+    parser.add_argument("bench", choices=["aggregation", "ingestion", "normalize", "search"])
+    parser.add_argument("--csv", help="готовый CSV; без него генерируется синтетический")
+    parser.add_argument("--categories", type=int, default=2000)
+    parser.add_argument("--products", type=int, default=20, help="среднее число СТЕ на категорию")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--chunk-rows", type=int, default=50_000)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="search: размеры каталога через запятую")
+    parser.add_argument("--queries", type=int, default=2000, help="search: запросов на размер")
+    parser.add_argument("--concurrency", type=int, default=4, help="search: параллельных HTTP-клиентов")
+    parser.add_argument("--no-http", action="store_true", help="search: только in-process")
+    parser.add_argument("--ranking", choices=["ngram", "bm25"], help="search: ранжирование кандидатов")
+    parser.add_argument("--result-cache", action="store_true", help="search: не выключать кэш результатов")
+    parser.add_argument("--save", help="search: сохранить сводку в JSON")
+    parser.add_argument("--baseline", help="search: JSON прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="search: допустимое ухудшение (доля)")
+    args = parser.parse_args()
+
+    if args.bench == "search":
+        if args.ranking:
+            Search_index.CANDIDATE_RANKING = args.ranking
+        results = bench_search(
+            [int(size) for size in args.sizes.split(",")],
+            products=args.products,
+            n_queries=args.queries,
+            concurrency=args.concurrency,
+            http=not args.no_http,
+            result_cache=args.result_cache,
+        )
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as f:
+                problems = find_regressions(results, json.load(f), args.tolerance)
+            for problem in problems:
+                print(f"РЕГРЕССИЯ {problem}")
+            return 1 if problems else 0
+        return 0
+
+    csv_path = args.csv
+    if csv_path is None:
+        fd, csv_path = tempfile.mkstemp(suffix=".csv")
+        os.close(fd)
+        make_synthetic_csv(csv_path, args.categories, args.products)
+
+    try:
+        if args.bench == "aggregation":
+            bench_aggregation(csv_path, repeat=args.repeat)
+        elif args.bench == "ingestion":
+            bench_ingestion(csv_path, chunk_rows=args.chunk_rows)
+        elif args.bench == "normalize":
+            bench_normalize(csv_path, repeat=args.repeat)
+    finally:
+        if args.csv is None:
+            os.remove(csv_path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1178 @@
+"""
+Индексные структуры SmartSearch: инвертированный индекс по n-граммам лемм
+с BM25, индекс характеристик, префиксное дерево для /suggest, колонки строк
+в одном буфере, fuzzy-скоринг и индекс СТЕ.
+
+Модуль не знает ни о CSV, ни о снимках, ни о FastAPI: тексты приходят уже
+нормализованными и лемматизированными, а там, где разбирать нужно самому
+(характеристики), лемматизатор передаётся снаружи — как в Search_layout.
+Собирает и хранит индексы Search_service_module.
+"""
+import mmap
+import os
+import re
+import sys
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+from rapidfuzz import fuzz, process
+
+# ==========================
+#   НАСТРОЙКИ
+# ==========================
+
+# Инвертированный индекс (отбор кандидатов перед fuzzy-скорингом)
+NGRAM_SIZE = 3               # символьные триграммы по словарю лемм
+NGRAM_MIN_SIMILARITY = 0.3   # порог Dice-похожести слова запроса и леммы из словаря
+MAX_TOKEN_EXPANSIONS = 20    # сколько похожих лемм берём на одно слово запроса
+NAME_HIT_WEIGHT = 2.0        # попадание в название важнее попадания в описание
+MAX_CANDIDATES = 300         # сколько категорий отдаём на fuzzy-скоринг
+
+# Ранжирование кандидатов перед fuzzy: "ngram" — сумма похожестей найденных лемм,
+# "bm25" — BM25 по леммам (tf / idf / длина поля) с весами в постингах
+CANDIDATE_RANKING = os.getenv("CANDIDATE_RANKING", "bm25")
+BM25_K1 = 1.2
+BM25_B = 0.75
+BM25_TOKEN_EXPANSIONS = 3    # слово не из словаря -> столько ближайших лемм (опечатки, раскладка)
+
+# Индекс характеристик: "Ключ: Значение" из spec-колонок -> постинги категорий
+SPEC_MAX_KEY_WORDS = 3
+SPEC_MAX_VALUE_WORDS = 3     # длинные значения — это уже описание, их ищет fuzzy
+
+# Автодополнение (/suggest): префиксное дерево по лемматизированным названиям
+SUGGEST_LIMIT = 10
+SUGGEST_MAX_DISTANCE = 2     # потолок опечаток (расстояние Левенштейна до префикса)
+SUGGEST_MAX_KEY_CHARS = 40   # глубина дерева: длиннее префиксы не печатают
+
+# Fuzzy-скоринг
+DESC_SCORE_WEIGHT = 0.7      # final = max(score_name, score_desc * DESC_SCORE_WEIGHT)
+SCORER_WORKERS = -1          # потоки rapidfuzz.process.cdist (-1 = все ядра)
+
+
+# ==========================
+#   ТОКЕНЫ
+# ==========================
+
+# После lower() и ё→е от _clear_re (Search_service_module) остаются только эти символы и пробелы,
+# так что токены normalize_text — это ровно непрерывные серии этих символов
+_TOKEN_RE = re.compile(r"[a-zа-я0-9%/.,\-]+")
+
+
+def normalize_tokens(text: str) -> List[str]:
+    """
+    Токены нормализованного текста за один проход: lower, ё→е и один findall
+    скомпилированной регуляркой вместо sub + sub + strip + split.
+    Совпадает с normalize_text_legacy(text).split().
+    """
+    if not text:
+        return []
+    return _TOKEN_RE.findall(text.lower().replace("ё", "е"))
+
+
+# ==========================
+#   ИНВЕРТИРОВАННЫЙ ИНДЕКС
+# ==========================
+
+def _char_ngrams(token: str, n: int = NGRAM_SIZE) -> set:
+    """Символьные n-граммы слова с пробелами по краям (чтобы учитывать начало/конец)."""
+    padded = f" {token} "
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+def _to_csr(lists: List[List[int]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Список списков -> (indptr, indices), как в scipy.sparse.csr_matrix."""
+    indptr = np.zeros(len(lists) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(x) for x in lists])
+    if indptr[-1]:
+        indices = np.fromiter(
+            (i for x in lists for i in x), dtype=np.int32, count=int(indptr[-1])
+        )
+    else:
+        indices = np.zeros(0, dtype=np.int32)
+    return indptr, indices
+
+
+def _csr_from_pairs(
+    rows: np.ndarray, cols: np.ndarray, n_rows: int, *values: np.ndarray
+) -> Tuple[np.ndarray, ...]:
+    """
+    Пары (строка, столбец) -> (indptr, столбцы, *values): столбцы внутри
+    строки по возрастанию, values переставлены вместе с ними.
+    """
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=n_rows))
+    return (indptr, cols[order].astype(np.int32), *(v[order] for v in values))
+
+
+def _sorted_ids(names: List[str]) -> Tuple[List[str], np.ndarray]:
+    """Имена по алфавиту + номер каждого исходного имени в этом порядке."""
+    order = sorted(range(len(names)), key=names.__getitem__)
+    remap = np.empty(len(names), dtype=np.int64)
+    remap[order] = np.arange(len(names))
+    return [names[i] for i in order], remap
+
+
+def _row_pairs(indptr: np.ndarray, docs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """CSR -> пары (строка, документ) для каждого постинга."""
+    rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+    return rows, np.asarray(docs, dtype=np.int64)
+
+
+def _bm25_weights(
+    indptr: np.ndarray,
+    docs: np.ndarray,
+    tf: np.ndarray,
+    doc_lens: np.ndarray,
+    catalog: Tuple[np.ndarray, int, int] | None = None,
+) -> np.ndarray:
+    """
+    BM25-вклад каждого постинга: idf(t) * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl)).
+    Постинги (indptr, docs) — разреженная матрица термин x документ по столбцам-терминам,
+    так что оценка запроса — это сумма готовых весов по его терминам.
+    catalog — (df терминов, число документов, сумма длин поля) всего каталога,
+    если индекс — его часть (шард): idf и avgdl тогда общие, а не по своим строкам.
+    """
+    doc_lens = np.asarray(doc_lens, dtype=np.float64)
+    postings = np.diff(indptr)
+    if catalog is None:
+        df, n_docs, len_sum = postings, len(doc_lens), doc_lens.sum()
+    else:
+        df, n_docs, len_sum = catalog
+    idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+    avgdl = len_sum / n_docs if n_docs and len_sum else 1.0
+    tf = tf.astype(np.float64)
+    norm = BM25_K1 * (1.0 - BM25_B + BM25_B * doc_lens[docs] / avgdl)
+    return (np.repeat(idf, postings) * tf * (BM25_K1 + 1.0) / (tf + norm)).astype(np.float32)
+
+
+def _gram_pairs(vocab_list: List[str]) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """Триграммы лемм: (триграммы, номер триграммы и номер леммы на каждую пару)."""
+    gram_names: Dict[str, int] = {}
+    gram_ids: List[int] = []
+    gram_tids: List[int] = []
+    for tid, token in enumerate(vocab_list):
+        for gram in _char_ngrams(token):
+            gram_ids.append(gram_names.setdefault(gram, len(gram_names)))
+            gram_tids.append(tid)
+    return list(gram_names), np.asarray(gram_ids, dtype=np.int64), np.asarray(gram_tids, dtype=np.int64)
+
+
+_NGRAM_FIELDS = ("name", "desc")
+
+
+class NgramIndex:
+    """
+    Инвертированный индекс по леммам категорий.
+
+    - словарь лемм (vocab) -> постинги категорий отдельно для названия и описания
+    - символьные триграммы -> леммы словаря (для опечаток и неполных слов)
+
+    Слово запроса сначала раскрывается в похожие леммы словаря по триграммам,
+    затем по их постингам набираются категории-кандидаты. Fuzzy-скоринг потом
+    идёт только по кандидатам, а не по всей таблице.
+
+    У постингов есть BM25-веса (name_weights / desc_weights): с ними
+    кандидаты ранжируются по BM25 (CANDIDATE_RANKING = "bm25"). tf постингов
+    и длины полей хранятся рядом — по ним веса пересчитываются при merge.
+
+    Леммы и триграммы пронумерованы по алфавиту (dict vocab / gram_slots
+    идут в порядке номеров): индекс зависит только от набора документов,
+    поэтому merge и build по тем же строкам дают один и тот же индекс.
+    """
+
+    def __init__(
+        self,
+        vocab: Dict[str, int],
+        name_postings: Tuple[np.ndarray, np.ndarray],
+        desc_postings: Tuple[np.ndarray, np.ndarray],
+        gram_slots: Dict[str, int],
+        gram_postings: Tuple[np.ndarray, np.ndarray],
+        token_gram_count: np.ndarray,
+        n_docs: int,
+        name_weights: np.ndarray,
+        desc_weights: np.ndarray,
+        name_tf: np.ndarray,
+        desc_tf: np.ndarray,
+        name_lens: np.ndarray,
+        desc_lens: np.ndarray,
+    ):
+        self.vocab = vocab
+        self.name_indptr, self.name_docs = name_postings
+        self.desc_indptr, self.desc_docs = desc_postings
+        self.name_weights = name_weights
+        self.desc_weights = desc_weights
+        self.name_tf = name_tf
+        self.desc_tf = desc_tf
+        self.name_lens = name_lens
+        self.desc_lens = desc_lens
+        self.gram_slots = gram_slots
+        self.gram_indptr, self.gram_tokens = gram_postings
+        self.token_gram_count = token_gram_count
+        self.n_docs = n_docs
+
+    @classmethod
+    def build(cls, name_texts: Iterable[str], desc_texts: Iterable[str]) -> "NgramIndex":
+        tokens: Dict[str, int] = {}  # в порядке появления; _assemble нумерует по алфавиту
+        pairs = {fname: ([], [], []) for fname in _NGRAM_FIELDS}  # (лемма, документ, tf)
+        lens: Dict[str, List[int]] = {fname: [] for fname in _NGRAM_FIELDS}
+
+        for doc, texts in enumerate(zip(name_texts, desc_texts)):
+            for fname, text in zip(_NGRAM_FIELDS, texts):
+                words = text.split()
+                lens[fname].append(len(words))
+                tids, docs, tfs = pairs[fname]
+                for token, tf in Counter(words).items():
+                    tid = tokens.get(token)
+                    if tid is None:
+                        tid = tokens[token] = len(tokens)
+                    tids.append(tid)
+                    docs.append(doc)
+                    tfs.append(tf)
+
+        vocab_list, remap = _sorted_ids(list(tokens))
+        return cls._assemble(
+            vocab_list,
+            {
+                fname: (
+                    remap[np.asarray(tids, dtype=np.int64)],
+                    np.asarray(docs, dtype=np.int64),
+                    np.asarray(tfs, dtype=np.int32),
+                )
+                for fname, (tids, docs, tfs) in pairs.items()
+            },
+            {fname: np.asarray(lens[fname], dtype=np.int32) for fname in _NGRAM_FIELDS},
+            *_gram_pairs(vocab_list),
+        )
+
+    @classmethod
+    def merge(cls, parts: List[Tuple["NgramIndex", np.ndarray]], n_docs: int) -> "NgramIndex":
+        """
+        Индекс из строк нескольких индексов без разбора текстов: parts —
+        (индекс, new_rows), new_rows[i] — номер строки i в новом индексе
+        (-1 — строка выбывает). Постинги переносятся с перенумерацией, BM25
+        пересчитывается по tf и длинам полей (idf и avgdl — по новому набору),
+        триграммы берутся готовые. Результат совпадает с build по тем же строкам.
+        """
+        lens = {fname: np.zeros(n_docs, dtype=np.int32) for fname in _NGRAM_FIELDS}
+        live_parts = []
+        for index, new_rows in parts:
+            new_rows = np.asarray(new_rows, dtype=np.int64)
+            rows = np.flatnonzero(new_rows >= 0)
+            fields = {}
+            for fname in _NGRAM_FIELDS:
+                lens[fname][new_rows[rows]] = np.asarray(getattr(index, fname + "_lens"))[rows]
+                tids, docs = _row_pairs(getattr(index, fname + "_indptr"), getattr(index, fname + "_docs"))
+                docs = new_rows[docs]
+                keep = docs >= 0
+                fields[fname] = (tids[keep], docs[keep], np.asarray(getattr(index, fname + "_tf"))[keep])
+            live = np.unique(np.concatenate([tids for tids, _, _ in fields.values()]))
+            live_parts.append((index, fields, live))
+
+        # словари частей уже по алфавиту: сортировка склеенных отрезков почти линейна
+        token_lists = [list(index.vocab) for index, _, _ in live_parts]
+        live_tokens: List[str] = []
+        for tokens, (_, _, live) in zip(token_lists, live_parts):
+            live_tokens.extend(tokens[t] for t in live.tolist())
+        vocab_list = list(dict.fromkeys(sorted(live_tokens)))
+        vocab = {token: tid for tid, token in enumerate(vocab_list)}
+
+        pairs: Dict[str, List[Tuple[np.ndarray, ...]]] = {fname: [] for fname in _NGRAM_FIELDS}
+        gram_names: Dict[str, int] = {}
+        gram_parts: List[Tuple[np.ndarray, np.ndarray]] = []
+        has_grams = np.zeros(len(vocab_list), dtype=bool)
+        for tokens, (index, fields, live) in zip(token_lists, live_parts):
+            tmap = np.full(len(tokens), -1, dtype=np.int64)
+            tmap[live] = [vocab[tokens[t]] for t in live.tolist()]
+            for fname, (tids, docs, tf) in fields.items():
+                pairs[fname].append((tmap[tids], docs, tf))
+
+            # триграммы леммы — из первой части, где она есть
+            slots, tids = _row_pairs(index.gram_indptr, index.gram_tokens)
+            tids = tmap[tids]
+            keep = tids >= 0
+            keep[keep] = ~has_grams[tids[keep]]
+            gmap = np.fromiter(
+                (gram_names.setdefault(g, len(gram_names)) for g in index.gram_slots),
+                dtype=np.int64, count=len(index.gram_slots),
+            )
+            gram_parts.append((gmap[slots[keep]], tids[keep]))
+            has_grams[tids[keep]] = True
+
+        return cls._assemble(
+            vocab_list,
+            {
+                fname: tuple(np.concatenate(arrays) for arrays in zip(*field_pairs))
+                for fname, field_pairs in pairs.items()
+            },
+            lens,
+            list(gram_names),
+            np.concatenate([g for g, _ in gram_parts]),
+            np.concatenate([t for _, t in gram_parts]),
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Статистика своих строк для общего словаря шардов (with_catalog):
+        число строк, суммы длин полей и df лемм по полям (леммы без постингов
+        не входят).
+        """
+        df = {fname: np.diff(getattr(self, fname + "_indptr")) for fname in _NGRAM_FIELDS}
+        vocab_list = list(self.vocab)
+        live = np.flatnonzero(sum(df.values()))
+        return {
+            "n_docs": len(self.name_lens),
+            "len_sum": {fname: int(np.asarray(getattr(self, fname + "_lens")).sum()) for fname in _NGRAM_FIELDS},
+            "tokens": {vocab_list[t]: [int(df[fname][t]) for fname in _NGRAM_FIELDS] for t in live.tolist()},
+        }
+
+    def with_catalog(self, catalog: Dict[str, Any]) -> "NgramIndex | None":
+        """
+        Тот же индекс (те же строки и постинги) со словарём и триграммами всего
+        каталога и BM25 по его idf / avgdl. catalog — сумма stats() всех шардов.
+        Чужие леммы получают пустые постинги: расширение опечаток, раскладка и
+        оценки строк тогда те же, что у одного индекса по всему каталогу.
+        None — каких-то своих лемм в catalog нет (он собран до правки шарда).
+        """
+        tokens = catalog["tokens"]
+        vocab_list = sorted(tokens)
+        vocab = {token: tid for tid, token in enumerate(vocab_list)}
+        own = list(self.vocab)
+        live = np.flatnonzero(sum(np.diff(getattr(self, fname + "_indptr")) for fname in _NGRAM_FIELDS))
+        if any(own[t] not in vocab for t in live.tolist()):
+            return None
+        tmap = np.full(len(own), -1, dtype=np.int64)
+        tmap[live] = [vocab[own[t]] for t in live.tolist()]
+
+        pairs = {}
+        for fname in _NGRAM_FIELDS:
+            tids, docs = _row_pairs(getattr(self, fname + "_indptr"), getattr(self, fname + "_docs"))
+            pairs[fname] = (tmap[tids], docs, np.asarray(getattr(self, fname + "_tf")))
+        df = np.array([tokens[token] for token in vocab_list], dtype=np.int64).reshape(-1, len(_NGRAM_FIELDS))
+        return self._assemble(
+            vocab_list,
+            pairs,
+            {fname: np.asarray(getattr(self, fname + "_lens")) for fname in _NGRAM_FIELDS},
+            *_gram_pairs(vocab_list),
+            catalog={
+                fname: (df[:, i], catalog["n_docs"], catalog["len_sum"][fname])
+                for i, fname in enumerate(_NGRAM_FIELDS)
+            },
+        )
+
+    @classmethod
+    def _assemble(
+        cls,
+        vocab_list: List[str],
+        pairs: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]],
+        lens: Dict[str, np.ndarray],
+        gram_names: List[str],
+        gram_ids: np.ndarray,
+        gram_tids: np.ndarray,
+        catalog: Dict[str, Tuple[np.ndarray, int, int]] | None = None,
+    ) -> "NgramIndex":
+        """
+        Общая часть build, merge и with_catalog: постинги (лемма, документ, tf)
+        уже в номерах vocab_list, триграммы — пары (номер в gram_names, лемма)
+        по одной на каждую триграмму каждой леммы. Триграммы нумеруются по
+        алфавиту. catalog — статистика BM25 всего каталога по полям (шард).
+        """
+        catalog = catalog or {}
+        n_tokens = len(vocab_list)
+        postings = {}
+        for fname, (tids, docs, tf) in pairs.items():
+            indptr, field_docs, field_tf = _csr_from_pairs(tids, docs, n_tokens, tf)
+            postings[fname] = (indptr, field_docs, field_tf.astype(np.int32))
+
+        used = np.unique(gram_ids)
+        grams_sorted, slot_of_used = _sorted_ids([gram_names[g] for g in used.tolist()])
+        slot = np.zeros(len(gram_names), dtype=np.int64)
+        slot[used] = slot_of_used
+        gram_indptr, gram_tokens = _csr_from_pairs(slot[gram_ids], gram_tids, len(grams_sorted))
+
+        return cls(
+            vocab={token: tid for tid, token in enumerate(vocab_list)},
+            name_postings=postings["name"][:2],
+            desc_postings=postings["desc"][:2],
+            gram_slots={gram: i for i, gram in enumerate(grams_sorted)},
+            gram_postings=(gram_indptr, gram_tokens),
+            token_gram_count=np.bincount(gram_tids, minlength=n_tokens).astype(np.int32),
+            n_docs=len(lens["name"]),
+            name_weights=_bm25_weights(*postings["name"], lens["name"], catalog.get("name")),
+            desc_weights=_bm25_weights(*postings["desc"], lens["desc"], catalog.get("desc")),
+            name_tf=postings["name"][2],
+            desc_tf=postings["desc"][2],
+            name_lens=lens["name"],
+            desc_lens=lens["desc"],
+        )
+
+    def memory_usage(self) -> Tuple[int, int]:
+        """(байты в памяти, байты в mmap): массивы постингов + словари."""
+        in_memory = mapped = 0
+        for arr in (
+            self.name_indptr, self.name_docs, self.desc_indptr, self.desc_docs,
+            self.gram_indptr, self.gram_tokens, self.token_gram_count,
+            self.name_weights, self.desc_weights,
+            self.name_tf, self.desc_tf, self.name_lens, self.desc_lens,
+        ):
+            if isinstance(arr, np.memmap):
+                mapped += arr.nbytes
+            else:
+                in_memory += arr.nbytes
+        for d in (self.vocab, self.gram_slots):
+            in_memory += sys.getsizeof(d) + sum(sys.getsizeof(k) for k in d)
+        return in_memory, mapped
+
+    def expand_token(self, token: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Похожие на слово запроса леммы словаря: (id лемм, Dice-похожесть)."""
+        grams = _char_ngrams(token)
+        parts = [
+            self.gram_tokens[self.gram_indptr[slot]:self.gram_indptr[slot + 1]]
+            for slot in (self.gram_slots.get(g) for g in grams)
+            if slot is not None
+        ]
+        if not parts:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float64)
+
+        token_ids, shared = np.unique(np.concatenate(parts), return_counts=True)
+        sim = 2.0 * shared / (len(grams) + self.token_gram_count[token_ids])
+        keep = sim >= NGRAM_MIN_SIMILARITY
+        token_ids, sim = token_ids[keep], sim[keep]
+
+        if len(token_ids) > MAX_TOKEN_EXPANSIONS:
+            top = np.argpartition(-sim, MAX_TOKEN_EXPANSIONS - 1)[:MAX_TOKEN_EXPANSIONS]
+            token_ids, sim = token_ids[top], sim[top]
+        return token_ids, sim
+
+    def candidates(
+        self,
+        query_lem: str,
+        limit: int = MAX_CANDIDATES,
+        ranking: str | None = None,
+        allowed: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """
+        Номера строк-кандидатов (по возрастанию) для лемматизированного запроса:
+        limit лучших по ranking ("ngram" / "bm25", по умолчанию CANDIDATE_RANKING).
+        allowed — выбирать только среди этих строк (например, по характеристикам).
+        """
+        if (ranking or CANDIDATE_RANKING) == "bm25":
+            doc_scores = self.bm25_scores(query_lem)
+        else:
+            doc_scores = self.ngram_scores(query_lem)
+        if doc_scores is None:
+            return np.zeros(0, dtype=np.int64)
+        if allowed is not None:
+            keep = np.zeros(len(doc_scores), dtype=bool)
+            keep[allowed] = True
+            doc_scores = np.where(keep, doc_scores, 0.0)
+
+        found = np.flatnonzero(doc_scores)
+        if len(found) > limit:
+            top = np.argpartition(-doc_scores[found], limit - 1)[:limit]
+            found = np.sort(found[top])
+        return found
+
+    def bm25_scores(self, query_lem: str) -> np.ndarray | None:
+        """
+        BM25 всех категорий по запросу (None — ни одно слово не нашлось).
+        Слово из словаря — ровно его постинги; иначе (опечатка, неполное слово)
+        BM25_TOKEN_EXPANSIONS ближайших лемм с весом по похожести.
+        Поле названия весит NAME_HIT_WEIGHT.
+        """
+        docs_parts: List[np.ndarray] = []
+        weight_parts: List[np.ndarray] = []
+
+        for token in set(query_lem.split()):
+            tid = self.vocab.get(token)
+            if tid is not None:
+                expansions = [(tid, 1.0)]
+            else:
+                token_ids, sim = self.expand_token(token)
+                best = np.argsort(-sim, kind="stable")[:BM25_TOKEN_EXPANSIONS]
+                expansions = zip(token_ids[best].tolist(), sim[best].tolist())
+            for tid, w in expansions:
+                for indptr, docs, weights, field_weight in (
+                    (self.name_indptr, self.name_docs, self.name_weights, NAME_HIT_WEIGHT),
+                    (self.desc_indptr, self.desc_docs, self.desc_weights, 1.0),
+                ):
+                    lo, hi = indptr[tid], indptr[tid + 1]
+                    if hi > lo:
+                        docs_parts.append(docs[lo:hi])
+                        weight_parts.append(weights[lo:hi] * (w * field_weight))
+
+        if not docs_parts:
+            return None
+        return np.bincount(
+            np.concatenate(docs_parts),
+            weights=np.concatenate(weight_parts),
+            minlength=self.n_docs,
+        )
+
+    def ngram_scores(self, query_lem: str) -> np.ndarray | None:
+        """
+        Вес категории = сумма похожестей найденных лемм, попадания в название
+        весят NAME_HIT_WEIGHT (None — ни одно слово не нашлось).
+        """
+        docs_parts: List[np.ndarray] = []
+        weight_parts: List[np.ndarray] = []
+
+        for token in set(query_lem.split()):
+            token_ids, sim = self.expand_token(token)
+            for tid, w in zip(token_ids.tolist(), sim.tolist()):
+                name_docs = self.name_docs[self.name_indptr[tid]:self.name_indptr[tid + 1]]
+                desc_docs = self.desc_docs[self.desc_indptr[tid]:self.desc_indptr[tid + 1]]
+                if len(name_docs):
+                    docs_parts.append(name_docs)
+                    weight_parts.append(np.full(len(name_docs), w * NAME_HIT_WEIGHT))
+                if len(desc_docs):
+                    docs_parts.append(desc_docs)
+                    weight_parts.append(np.full(len(desc_docs), w))
+
+        if not docs_parts:
+            return None
+        return np.bincount(
+            np.concatenate(docs_parts),
+            weights=np.concatenate(weight_parts),
+            minlength=self.n_docs,
+        )
+
+
+# ==========================
+#   ИНДЕКС ХАРАКТЕРИСТИК
+# ==========================
+
+_SPEC_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+_SPEC_GLUED_RE = re.compile(r"(\d+(?:[.,]\d+)?)([a-zа-я%]+)")
+
+
+def _spec_number(token: str) -> str:
+    """Число в одном виде: "1,50" и "1.5" -> "1.5"."""
+    token = token.replace(",", ".")
+    if "." in token:
+        token = token.rstrip("0").rstrip(".")
+    return token or "0"
+
+
+def spec_tokens(text: str, lemmatize: Callable[[str], str]) -> List[Tuple[str, int]]:
+    """
+    Слова ключа / значения характеристики в каноническом виде с номером
+    исходного токена: числа приводятся к одному виду, "500мл" делится на
+    число и единицу, единица после числа остаётся как есть (лемма от "л"
+    или "г" бессмысленна), остальные слова — леммы (lemmatize — одно слово).
+    """
+    words: List[Tuple[str, int]] = []
+    after_number = False
+    for pos, token in enumerate(normalize_tokens(text)):
+        token = token.strip(".,-/")
+        glued = _SPEC_GLUED_RE.fullmatch(token)
+        for part in glued.groups() if glued else (token,) if token else ():
+            if _SPEC_NUMBER_RE.fullmatch(part):
+                words.append((_spec_number(part), pos))
+                after_number = True
+            else:
+                words.append((part if after_number else lemmatize(part), pos))
+                after_number = False
+    return words
+
+
+def _spec_phrase(text: str, lemmatize: Callable[[str], str]) -> str:
+    return " ".join(word for word, _ in spec_tokens(text, lemmatize))
+
+
+class SpecIndex:
+    """
+    Характеристики СТЕ ("Объём: 500 мл") разобраны один раз при сборке:
+    термин "ключ=значение" -> постинги категорий (CSR, как в NgramIndex).
+
+    Запрос с характеристиками ("шампунь объем 500 мл", "500мл") отвечается
+    пересечением постингов, а не поиском подстроки "500 мл" в склеенном
+    описании категории.
+
+    lemmatize — лемма одного слова; та же функция, которой разобраны
+    характеристики при сборке, разбирает и запрос.
+    """
+
+    def __init__(
+        self,
+        terms: Dict[str, int],
+        postings: Tuple[np.ndarray, np.ndarray],
+        lemmatize: Callable[[str], str],
+    ):
+        self.terms = terms
+        self.lemmatize = lemmatize
+        self.indptr, self.docs = postings
+        # производное от terms — в снимок не пишем
+        self.keys = set()
+        self.values: Dict[str, List[int]] = {}
+        self.key_slots: Dict[str, List[int]] = {}
+        self.slot_keys: List[str] = [""] * len(terms)
+        for term, slot in terms.items():
+            key, value = term.split("=", 1)
+            self.keys.add(key)
+            self.values.setdefault(value, []).append(slot)
+            self.key_slots.setdefault(key, []).append(slot)
+            self.slot_keys[slot] = key
+
+    @classmethod
+    def build(cls, desc_texts: Iterable[str], lemmatize: Callable[[str], str]) -> "SpecIndex":
+        terms: Dict[str, int] = {}  # в порядке появления; в индексе — по алфавиту, как в NgramIndex
+        slot_ids: List[int] = []
+        doc_ids: List[int] = []
+        parsed: Dict[str, str | None] = {}  # одни и те же строки spec повторяются во всём каталоге
+        for doc, desc in enumerate(desc_texts):
+            slots = set()
+            for ste_text in desc.split(" | "):
+                for item in ste_text.split("; "):
+                    if item not in parsed:
+                        parsed[item] = cls._term(item, lemmatize)
+                    term = parsed[item]
+                    if term is not None:
+                        slots.add(terms.setdefault(term, len(terms)))
+            slot_ids.extend(slots)
+            doc_ids.extend([doc] * len(slots))
+        term_list, remap = _sorted_ids(list(terms))
+        slots = remap[np.asarray(slot_ids, dtype=np.int64)]
+        return cls._assemble(term_list, slots, np.asarray(doc_ids, dtype=np.int64), lemmatize)
+
+    @classmethod
+    def merge(cls, parts: List[Tuple["SpecIndex", np.ndarray]]) -> "SpecIndex":
+        """Строки нескольких индексов без разбора описаний — как NgramIndex.merge."""
+        moved = []
+        live_terms: List[str] = []
+        for spec, new_rows in parts:
+            slots, docs = _row_pairs(spec.indptr, spec.docs)
+            docs = np.asarray(new_rows, dtype=np.int64)[docs]
+            keep = docs >= 0
+            term_list = list(spec.terms)
+            live = np.unique(slots[keep])
+            live_terms.extend(term_list[t] for t in live.tolist())
+            moved.append((term_list, live, slots[keep], docs[keep]))
+
+        term_list = list(dict.fromkeys(sorted(live_terms)))
+        terms = {term: slot for slot, term in enumerate(term_list)}
+        slot_parts, doc_parts = [], []
+        for part_terms, live, slots, docs in moved:
+            tmap = np.full(len(part_terms), -1, dtype=np.int64)
+            tmap[live] = [terms[part_terms[t]] for t in live.tolist()]
+            slot_parts.append(tmap[slots])
+            doc_parts.append(docs)
+        return cls._assemble(
+            term_list, np.concatenate(slot_parts), np.concatenate(doc_parts), parts[0][0].lemmatize
+        )
+
+    def with_terms(self, term_list: List[str]) -> "SpecIndex | None":
+        """
+        Те же постинги со словарём терминов всего каталога (шард): запрос
+        разбирается на характеристики одинаково во всех шардах. None — каких-то
+        своих терминов в term_list нет, как в NgramIndex.with_catalog.
+        """
+        terms = {term: slot for slot, term in enumerate(sorted(term_list))}
+        own = list(self.terms)
+        live = np.flatnonzero(np.diff(self.indptr))
+        if any(own[t] not in terms for t in live.tolist()):
+            return None
+        tmap = np.full(len(own), -1, dtype=np.int64)
+        tmap[live] = [terms[own[t]] for t in live.tolist()]
+        slots, docs = _row_pairs(self.indptr, self.docs)
+        return self._assemble(list(terms), tmap[slots], docs, self.lemmatize)
+
+    def live_terms(self) -> List[str]:
+        """Термины, у которых есть строки (для общего словаря шардов)."""
+        live = np.diff(self.indptr) > 0
+        return [term for term, slot in self.terms.items() if live[slot]]
+
+    @classmethod
+    def _assemble(
+        cls, term_list: List[str], slots: np.ndarray, docs: np.ndarray, lemmatize: Callable[[str], str]
+    ) -> "SpecIndex":
+        indptr, docs = _csr_from_pairs(slots, docs, len(term_list))
+        return cls({term: slot for slot, term in enumerate(term_list)}, (indptr, docs), lemmatize)
+
+    @staticmethod
+    def _term(item: str, lemmatize: Callable[[str], str]) -> str | None:
+        key, sep, value = item.partition(":")
+        if not sep:
+            return None  # название СТЕ, а не характеристика
+        key, value = _spec_phrase(key, lemmatize), _spec_phrase(value, lemmatize)
+        if not key or not value:
+            return None
+        if len(key.split()) > SPEC_MAX_KEY_WORDS or len(value.split()) > SPEC_MAX_VALUE_WORDS:
+            return None
+        return f"{key}={value}"
+
+    def memory_usage(self) -> Tuple[int, int]:
+        """(в куче, mmap) — как у NgramIndex."""
+        arrays = (self.indptr, self.docs)
+        mapped = sum(a.nbytes for a in arrays if isinstance(a, np.memmap))
+        in_memory = sum(a.nbytes for a in arrays) - mapped
+        in_memory += sum(len(t.encode("utf-8")) for t in self.terms)
+        return in_memory, mapped
+
+    def parse_query(self, query: str) -> Tuple[str, List[List[int]]]:
+        """
+        Характеристики в запросе: "ключ значение" (двоеточие не обязательно),
+        если такая пара есть в индексе, и "число единица" ("500 мл", "500мл"),
+        если такое значение встречается у какого-нибудь ключа.
+        Возвращает (запрос без характеристик, [слоты на каждую характеристику]).
+        Неизвестные индексу пары остаются в тексте — их оценит fuzzy.
+        """
+        tokens = spec_tokens(query, self.lemmatize)
+        words = [w for w, _ in tokens]
+        used = set()
+        attrs: List[List[int]] = []
+        i = 0
+        while i < len(words):
+            found = self._match_key_value(words, i) or self._match_measure(words, i)
+            if found is None:
+                i += 1
+                continue
+            end, slots = found
+            attrs.append(slots)
+            used.update(pos for _, pos in tokens[i:end])
+            i = end
+        if not attrs:
+            return query, []
+        rest = [t for pos, t in enumerate(normalize_tokens(query)) if pos not in used]
+        return " ".join(rest), attrs
+
+    def _match_key_value(self, words: List[str], i: int) -> Tuple[int, List[int]] | None:
+        for key_end in range(min(len(words), i + SPEC_MAX_KEY_WORDS), i, -1):
+            key = " ".join(words[i:key_end])
+            if key not in self.keys:
+                continue
+            for end in range(min(len(words), key_end + SPEC_MAX_VALUE_WORDS), key_end, -1):
+                slot = self.terms.get(f"{key}={' '.join(words[key_end:end])}")
+                if slot is not None:
+                    return end, [slot]
+        return None
+
+    def _match_measure(self, words: List[str], i: int) -> Tuple[int, List[int]] | None:
+        if i + 1 >= len(words) or not _SPEC_NUMBER_RE.fullmatch(words[i]):
+            return None
+        slots = self.values.get(f"{words[i]} {words[i + 1]}")
+        return (i + 2, slots) if slots else None
+
+    def match(self, attrs: List[List[int]]) -> Tuple[np.ndarray, float]:
+        """
+        Строки, у которых совпало больше всего характеристик запроса,
+        и доля совпавших (1.0 — все).
+        """
+        hits = np.zeros(0, dtype=np.int64)
+        for slots in attrs:
+            rows = np.unique(np.concatenate(
+                [self.docs[self.indptr[s]:self.indptr[s + 1]] for s in slots]
+            ))
+            hits = np.concatenate([hits, rows])
+        if not len(hits):
+            return hits, 0.0
+        counts = np.bincount(hits)
+        best = int(counts.max())
+        return np.flatnonzero(counts == best), best / len(attrs)
+
+    def specificity(self, attrs: List[List[int]], rows: np.ndarray) -> np.ndarray:
+        """
+        Насколько категории rows "про" характеристики запроса: среднее по
+        характеристикам 1 / (сколько разных значений этого ключа у категории),
+        0 — если характеристика не совпала. На "цвет синий" категория только
+        синих товаров получает 1.0, а пяти цветов — 0.2. Зависит только от
+        самой строки, поэтому у шардов то же, что и у целого индекса.
+        """
+        size = int(rows.max()) + 1 if len(rows) else 0
+        total = np.zeros(len(rows))
+        for slots in attrs:
+            best = np.zeros(len(rows))
+            for slot in slots:
+                docs = self.docs[self.indptr[slot]:self.indptr[slot + 1]]
+                matched = np.zeros(size, dtype=bool)
+                matched[docs[docs < size]] = True
+                key_docs = np.concatenate([
+                    self.docs[self.indptr[s]:self.indptr[s + 1]] for s in self.key_slots[self.slot_keys[slot]]
+                ])
+                n_values = np.bincount(key_docs[key_docs < size], minlength=size)[rows]
+                best = np.maximum(best, np.where(matched[rows], 1.0 / np.maximum(n_values, 1), 0.0))
+            total += best
+        return total / len(attrs)
+
+
+# ==========================
+#   ПРЕФИКСНОЕ ДЕРЕВО (/suggest)
+# ==========================
+
+def suggest_max_distance(prefix: str) -> int:
+    """
+    Сколько опечаток прощаем — по длине последнего слова: в «мыло ж»
+    одна правка уже превращает «ж» в любую другую букву.
+    """
+    words = prefix.split()
+    n = len(words[-1]) if words else 0
+    return min(SUGGEST_MAX_DISTANCE, 0 if n <= 3 else 1 if n <= 6 else 2)
+
+
+class SuggestTrie:
+    """
+    Префиксное дерево по лемматизированным названиям категорий в плоских массивах.
+
+    Ключи — название целиком и его хвосты с начала каждого слова («гелевый ручка»
+    находится и по «руч»). Ключи отсортированы, поэтому поддерево узла — это
+    непрерывный диапазон ключей [node_lo, node_hi). Дети узла лежат в CSR:
+    child_chars[child_ptr[i]:child_ptr[i + 1]] — символы рёбер одной строкой,
+    child_nodes — номера детей.
+
+    Поиск — обход дерева со строкой динамики Левенштейна на каждом узле
+    (автомат Левенштейна, развёрнутый по дереву): ветка отсекается, как только
+    минимум строки превысил допустимое число опечаток.
+    """
+
+    def __init__(
+        self,
+        child_ptr: np.ndarray,
+        child_chars: str,
+        child_nodes: np.ndarray,
+        node_lo: np.ndarray,
+        node_hi: np.ndarray,
+        key_rows: np.ndarray,
+        key_rank: np.ndarray,
+    ):
+        self.child_ptr = child_ptr
+        self.child_chars = child_chars
+        self.child_nodes = child_nodes
+        self.node_lo = node_lo
+        self.node_hi = node_hi
+        self.key_rows = key_rows  # строка индекса для каждого ключа
+        self.key_rank = key_rank  # порядок показа: сначала с начала названия, потом короче
+
+    @classmethod
+    def build(cls, name_texts: Iterable[str], max_key_chars: int = SUGGEST_MAX_KEY_CHARS) -> "SuggestTrie":
+        entries = set()
+        for row, name in enumerate(name_texts):
+            words = name.split()
+            for start in range(len(words)):
+                key = " ".join(words[start:])[:max_key_chars]
+                entries.add((key, start > 0, len(name), row))
+        entries = sorted(entries)
+
+        children: List[List[Tuple[str, int]]] = [[]]
+        node_lo, node_hi = [0], [len(entries)]
+        path = [0]  # узлы пути предыдущего ключа по глубине
+        prev = ""
+        for k, (key, _, _, _) in enumerate(entries):
+            common = 0
+            limit = min(len(prev), len(key))
+            while common < limit and prev[common] == key[common]:
+                common += 1
+            for node in path[common + 1:]:
+                node_hi[node] = k  # поддерево закончилось: дальше ключи с другим префиксом
+            del path[common + 1:]
+            for ch in key[common:]:
+                node = len(node_lo)
+                node_lo.append(k)
+                node_hi.append(len(entries))
+                children[path[-1]].append((ch, node))
+                children.append([])
+                path.append(node)
+            prev = key
+
+        child_ptr, child_nodes = _to_csr([[node for _, node in c] for c in children])
+        n = len(entries)
+        order = np.lexsort((
+            np.arange(n),
+            np.fromiter((e[2] for e in entries), dtype=np.int64, count=n),
+            np.fromiter((e[1] for e in entries), dtype=bool, count=n),
+        ))
+        key_rank = np.empty(n, dtype=np.int32)
+        key_rank[order] = np.arange(n, dtype=np.int32)
+        return cls(
+            child_ptr=child_ptr,
+            child_chars="".join(ch for c in children for ch, _ in c),
+            child_nodes=child_nodes,
+            node_lo=np.asarray(node_lo, dtype=np.int32),
+            node_hi=np.asarray(node_hi, dtype=np.int32),
+            key_rows=np.fromiter((e[3] for e in entries), dtype=np.int32, count=n),
+            key_rank=key_rank,
+        )
+
+    @property
+    def nbytes(self) -> int:
+        arrays = (self.child_ptr, self.child_nodes, self.node_lo, self.node_hi, self.key_rows, self.key_rank)
+        return sum(a.nbytes for a in arrays) + len(self.child_chars.encode("utf-8"))
+
+    def _matches(self, prefix: str, max_distance: int) -> List[Tuple[int, int]]:
+        """(расстояние, узел) для узлов, чей путь не дальше max_distance от prefix."""
+        n = len(prefix)
+        max_distance = min(max_distance, n - 1)  # иначе подходил бы корень — всё дерево
+        matches = []
+        stack = [(0, list(range(n + 1)))]
+        while stack:
+            node, row = stack.pop()
+            a, b = int(self.child_ptr[node]), int(self.child_ptr[node + 1])
+            for ch, child in zip(self.child_chars[a:b], self.child_nodes[a:b].tolist()):
+                new = [row[0] + 1]
+                for j in range(1, n + 1):
+                    new.append(min(row[j - 1] + (prefix[j - 1] != ch), row[j] + 1, new[j - 1] + 1))
+                if new[n] <= max_distance:
+                    matches.append((new[n], child))
+                    if new[n] == 0:
+                        continue  # точное совпадение: глубже ключи те же, а расстояние не меньше
+                if min(new) <= max_distance:
+                    stack.append((child, new))
+        return matches
+
+    def search(self, prefix: str, max_distance: int = 0, limit: int = SUGGEST_LIMIT) -> List[Tuple[int, int]]:
+        """
+        До limit строк индекса (без повторов) с наименьшим числом опечаток:
+        [(row, distance), ...]. При равном расстоянии — по key_rank.
+        """
+        prefix = prefix[:SUGGEST_MAX_KEY_CHARS]
+        if not prefix or limit <= 0:
+            return []
+        by_distance: Dict[int, List[int]] = {}
+        for distance, node in self._matches(prefix, max_distance):
+            by_distance.setdefault(distance, []).append(node)
+
+        results: List[Tuple[int, int]] = []
+        seen = set()
+        for distance in sorted(by_distance):
+            need = limit + len(seen)  # запас на строки, уже показанные с меньшим расстоянием
+            parts = []
+            for node in by_distance[distance]:
+                keys = np.arange(self.node_lo[node], self.node_hi[node])
+                if len(keys) > need:
+                    keys = keys[np.argpartition(self.key_rank[keys], need - 1)[:need]]
+                parts.append(keys)
+            keys = np.unique(np.concatenate(parts))
+            keys = keys[np.argsort(self.key_rank[keys], kind="stable")]
+            for row in self.key_rows[keys].tolist():
+                if row not in seen:
+                    seen.add(row)
+                    results.append((row, distance))
+                    if len(results) == limit:
+                        return results
+        return results
+
+
+# ==========================
+#   КОМПАКТНОЕ ХРАНЕНИЕ СТРОК
+# ==========================
+
+class TextColumn:
+    """
+    Колонка строк без Python-объекта на каждую строку: все строки подряд
+    в одном UTF-8 буфере + смещения (np.int64, len + 1).
+
+    Буфер — bytes в памяти или mmap файла снимка: тогда строка читается
+    с диска (из page cache) только когда её реально запросили.
+    """
+
+    def __init__(self, buffer, offsets: np.ndarray, on_disk: bool = False):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.on_disk = on_disk
+
+    @classmethod
+    def from_strings(cls, texts: Iterable[str]) -> "TextColumn":
+        encoded = [t.encode("utf-8") for t in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        return cls(b"".join(encoded), offsets)
+
+    @classmethod
+    def merge(cls, parts: List[Tuple["TextColumn", np.ndarray]], n_rows: int) -> "TextColumn":
+        """
+        Колонка из строк нескольких колонок (new_rows — как в NgramIndex.merge)
+        без раскодирования: подряд идущие строки одной части копируются из её
+        буфера одним срезом.
+        """
+        if n_rows == 0:
+            return cls(b"", np.zeros(1, dtype=np.int64))
+        src_part = np.empty(n_rows, dtype=np.int64)
+        src_row = np.empty(n_rows, dtype=np.int64)
+        for p, (_, new_rows) in enumerate(parts):
+            new_rows = np.asarray(new_rows, dtype=np.int64)
+            rows = np.flatnonzero(new_rows >= 0)
+            src_part[new_rows[rows]] = p
+            src_row[new_rows[rows]] = rows
+
+        breaks = np.flatnonzero((np.diff(src_part) != 0) | (np.diff(src_row) != 1)) + 1
+        lengths = np.empty(n_rows, dtype=np.int64)
+        chunks = []
+        for lo, hi in zip([0] + breaks.tolist(), breaks.tolist() + [n_rows]):
+            column = parts[src_part[lo]][0]
+            first, last = int(src_row[lo]), int(src_row[hi - 1]) + 1
+            offsets = np.asarray(column.offsets[first:last + 1])
+            chunks.append(column.buffer[int(offsets[0]):int(offsets[-1])])
+            lengths[lo:hi] = np.diff(offsets)
+        offsets = np.zeros(n_rows + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        return cls(b"".join(chunks), offsets)
+
+    @classmethod
+    def load(cls, prefix: str, lazy: bool = True) -> "TextColumn":
+        """Колонка из <prefix>.bin / <prefix>.offsets.npy; lazy — через mmap."""
+        offsets = np.load(prefix + ".offsets.npy", mmap_mode="r" if lazy else None)
+        with open(prefix + ".bin", "rb") as f:
+            if lazy and offsets[-1] > 0:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                return cls(buffer, offsets, on_disk=True)
+            return cls(f.read(), np.asarray(offsets))
+
+    def save(self, prefix: str) -> None:
+        with open(prefix + ".bin", "wb") as f:
+            f.write(self.buffer[:int(self.offsets[-1])])
+        np.save(prefix + ".offsets.npy", np.asarray(self.offsets))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.buffer[int(self.offsets[i]):int(self.offsets[i + 1])].decode("utf-8")
+
+    def take(self, rows: np.ndarray) -> List[str]:
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.offsets[rows].tolist()
+        ends = self.offsets[rows + 1].tolist()
+        buf = self.buffer
+        return [buf[a:b].decode("utf-8") for a, b in zip(starts, ends)]
+
+    def to_list(self) -> List[str]:
+        offsets = np.asarray(self.offsets).tolist()
+        buf = self.buffer
+        return [buf[a:b].decode("utf-8") for a, b in zip(offsets[:-1], offsets[1:])]
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.offsets[-1]) + self.offsets.nbytes
+
+
+# ==========================
+#   FUZZY-СКОРИНГ
+# ==========================
+
+class FuzzyScorer:
+    """
+    Пакетный fuzzy-скоринг: name_norm / desc_norm лежат непрерывными
+    колонками, все строки (или кандидаты) оцениваются одним вызовом
+    rapidfuzz.process.cdist (на C++ и во всех ядрах), а не построчными
+    fuzz.WRatio из Python.
+    """
+
+    def __init__(self, name_norm: TextColumn, desc_norm: TextColumn):
+        self.name_norm = name_norm
+        self.desc_norm = desc_norm
+
+    def _cdist(self, queries: List[str], choices: List[str]) -> np.ndarray:
+        return process.cdist(
+            queries, choices, scorer=fuzz.WRatio, dtype=np.float64, workers=SCORER_WORKERS
+        )
+
+    @staticmethod
+    def _texts(column: TextColumn, rows: np.ndarray | None) -> List[str]:
+        return column.to_list() if rows is None else column.take(rows)
+
+    def score_names(self, queries: List[str], rows: np.ndarray | None = None) -> np.ndarray:
+        """Матрица (len(queries) x число строк); rows — кандидаты, None — все строки."""
+        return self._cdist(queries, self._texts(self.name_norm, rows))
+
+    def score_descs(self, queries: List[str], rows: np.ndarray | None = None) -> np.ndarray:
+        return self._cdist(queries, self._texts(self.desc_norm, rows))
+
+    def score_desc_one(self, query: str, row: int) -> float:
+        return fuzz.WRatio(query, self.desc_norm[row])
+
+    def score(
+        self, queries: List[str], rows: np.ndarray | None = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Матрицы оценок по названию и описанию (без отсечения по границам)."""
+        return self.score_names(queries, rows), self.score_descs(queries, rows)
+
+
+def combine_scores(score_name: np.ndarray, score_desc: np.ndarray) -> np.ndarray:
+    """Итоговая оценка: название важнее, описание со штрафом."""
+    return np.maximum(score_name, score_desc * DESC_SCORE_WEIGHT)
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Индексы k лучших оценок по убыванию; при равенстве раньше идёт меньший
+    индекс (как у стабильной сортировки). argpartition вместо полной
+    сортировки: O(n) + сортировка только k элементов.
+    """
+    n = len(scores)
+    if n > k:
+        kth = np.partition(scores, n - k)[n - k]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)[:k - len(above)]
+        idx = np.concatenate([above, ties])
+    else:
+        idx = np.arange(n)
+    return idx[np.lexsort((idx, -scores[idx]))]
+
+
+
+# ==========================
+#   ИНДЕКС СТЕ
+# ==========================
+
+@dataclass
+class ItemIndex:
+    """
+    Названия СТЕ для /search/items. Тот же конвейер, что у категорий:
+    лемматизация, TextColumn, NgramIndex (только поле названия) и
+    FuzzyScorer. Описания СТЕ не храним — характеристики уже есть в
+    описании категории, — поэтому индекс СТЕ не удваивает память.
+    СТЕ ссылаются на категорию по id: правки категорий индекс СТЕ не трогают.
+    """
+    ids: np.ndarray
+    category_ids: np.ndarray
+    names: TextColumn
+    name_norm: TextColumn
+    ngram: NgramIndex
+    scorer: FuzzyScorer | None = None
+
+    def __post_init__(self):
+        if self.scorer is None:
+            # описаний у СТЕ нет — score_descs для них не вызывается
+            self.scorer = FuzzyScorer(self.name_norm, self.name_norm)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "ItemIndex":
+        name_norm = df["name_norm"].tolist()
+        return cls(
+            ids=df["id_сте"].to_numpy(dtype=np.int64),
+            category_ids=df["id_категории"].to_numpy(dtype=np.int64),
+            names=TextColumn.from_strings(df["название_сте"]),
+            name_norm=TextColumn.from_strings(name_norm),
+            ngram=NgramIndex.build(name_norm, [""] * len(name_norm)),
+        )
+
+    def memory_usage(self) -> Tuple[int, int]:
+        """(в куче, mmap) — как у NgramIndex."""
+        in_memory, mapped = self.ngram.memory_usage()
+        for arr in (self.ids, self.category_ids):
+            if isinstance(arr, np.memmap):
+                mapped += arr.nbytes
+            else:
+                in_memory += arr.nbytes
+        for col in (self.names, self.name_norm):
+            if col.on_disk:
+                mapped += col.nbytes
+            else:
+                in_memory += col.nbytes
+        return in_memory, mapped
+
+    def same_items(self, df: pd.DataFrame) -> bool:
+        """Совпадает ли индекс с таблицей СТЕ (для diff-перезагрузки)."""
+        return (
+            len(df) == len(self.ids)
+            and np.array_equal(df["id_сте"].to_numpy(dtype=np.int64), self.ids)
+            and np.array_equal(df["id_категории"].to_numpy(dtype=np.int64), self.category_ids)
+            and df["название_сте"].tolist() == self.names.to_list()
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
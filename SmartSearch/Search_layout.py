@@ -0,0 +1,118 @@
+"""
+Исправление раскладки EN→RU для запросов SmartSearch.
+
+Модуль без внешних зависимостей: его используют и сервис
+(Search_service_module), и консольный Search_service, каждый со своим
+лемматизатором — словарь детектора должен быть построен той же функцией,
+которой потом проверяются слова запроса.
+"""
+import math
+import re
+from collections import Counter
+from typing import Callable, Dict
+
+EN_TO_RU = str.maketrans({
+    'q':'й', 'w':'ц', 'e':'у', 'r':'к', 't':'е', 'y':'н', 'u':'г', 'i':'ш', 'o':'щ', 'p':'з', '[':'х', ']':'ъ',
+    'a':'ф', 's':'ы', 'd':'в', 'f':'а', 'g':'п', 'h':'р', 'j':'о', 'k':'л', 'l':'д', ';':'ж', '\'':'э',
+    'z':'я', 'x':'ч', 'c':'с', 'v':'м', 'b':'и', 'n':'т', 'm':'ь', ',':'б', '.':'ю', '`':'ё'
+})
+
+
+_LATIN_RE = re.compile(r"[a-z]")
+_CYRILLIC_RE = re.compile(r"[а-яё]")
+
+
+class LayoutDetector:
+    """
+    Определяем раскладку по словам запроса. Биграммная модель символов
+    обучена на словаре лемм каталога; слово на латинице переводим EN→RU, если
+    перевод есть в словаре или заметно правдоподобнее оригинала. Так ",evfuf"
+    становится "бумага", а "hp" / "lenovo" из каталога остаются как есть.
+
+    Одного выигрыша мало, если латиницы в словаре нет совсем (каталог из
+    одних характеристик): тогда любое латинское слово "неправдоподобно" и
+    "hp" превращалось бы в "рз". Поэтому перевод по модели ещё и должен быть
+    не хуже floor_quantile-квантиля оценок самих слов словаря.
+
+    lemmatize — та же нормализация, которой построен vocab (текст -> леммы
+    через пробел); smoothing — add-k сглаживание биграмм, min_gain — на сколько
+    средний log P биграммы должен вырасти после перевода.
+    """
+
+    def __init__(
+        self,
+        vocab: Dict[str, int],
+        lemmatize: Callable[[str], str],
+        smoothing: float = 0.1,
+        min_gain: float = 1.5,
+        floor_quantile: float = 0.01,
+    ):
+        self.vocab = vocab
+        self.lemmatize = lemmatize
+        self.min_gain = min_gain
+        pair_counts: Counter = Counter()
+        prev_counts: Counter = Counter()
+        for word in vocab:
+            padded = f" {word} "
+            pair_counts.update(zip(padded, padded[1:]))
+            prev_counts.update(padded[:-1])
+
+        k = smoothing
+        alphabet = len({c for pair in pair_counts for c in pair}) or 1
+        self._log_probs = {
+            pair: math.log((n + k) / (prev_counts[pair[0]] + k * alphabet))
+            for pair, n in pair_counts.items()
+        }
+        self._unseen = {
+            c: math.log(k / (n + k * alphabet)) for c, n in prev_counts.items()
+        }
+        # символ, которого в каталоге нет вовсе, — хуже любого известного
+        self._unknown = min(self._unseen.values(), default=math.log(k / (k * alphabet)))
+
+        vocab_scores = sorted(self.score(word) for word in vocab)
+        self._floor = (
+            vocab_scores[int(floor_quantile * (len(vocab_scores) - 1))] if vocab_scores else -math.inf
+        )
+
+    def score(self, word: str) -> float:
+        """Средний log P биграммы слова (с границами слова)."""
+        padded = f" {word} "
+        total = 0.0
+        for pair in zip(padded, padded[1:]):
+            lp = self._log_probs.get(pair)
+            if lp is None:
+                lp = self._unseen.get(pair[0], self._unknown)
+            total += lp
+        return total / (len(padded) - 1)
+
+    def _known(self, text: str) -> bool:
+        lemmas = self.lemmatize(text).split()
+        return bool(lemmas) and all(lemma in self.vocab for lemma in lemmas)
+
+    def fix_token(self, token: str) -> str:
+        token = token.lower()
+        if not _LATIN_RE.search(token) or _CYRILLIC_RE.search(token):
+            return token
+        translated = token.translate(EN_TO_RU)
+        if self._known(token):
+            return token
+        if self._known(translated):
+            return translated
+        if self.score(translated) >= max(self.score(token) + self.min_gain, self._floor):
+            return translated
+        return token
+
+    def fix(self, text: str) -> str:
+        return " ".join(self.fix_token(token) for token in text.split())
+
+
+def correct_keyboard_layout(text: str, detector: LayoutDetector | None = None) -> str:
+    """
+    Пытаемся починить, если пользователь набрал русский на EN-раскладке.
+    С detector решение принимается по каждому слову, без него — весь текст EN→RU.
+    """
+    if not text:
+        return text
+    if detector is not None:
+        return detector.fix(text)
+    return text.translate(EN_TO_RU)
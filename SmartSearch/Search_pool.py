@@ -0,0 +1,122 @@
+"""
+Пул процессов поиска и допуск запросов SmartSearch.
+
+SEARCH_EXECUTION="process": скоринг идёт в процессах, форкнутых от сервиса
+после загрузки индекса, — индекс у них общий (copy-on-write / mmap), а
+fuzzy-скоринг не делит GIL с event loop. После каждой подмены индекса пул
+форкается заново.
+
+Допуск: одновременно не больше MAX_PENDING_SEARCHES поисков, сверх —
+сразу 503, а не очередь за health-чеками.
+
+Настройки и сам индекс — в Search_service_module, здесь только пул и
+счётчик поисков в работе; модуль читает их из сервиса в момент вызова.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
+
+from fastapi import HTTPException
+
+import Search_index
+import Search_service_module as svc
+
+# ==========================
+#   ПУЛ ПРОЦЕССОВ
+# ==========================
+
+search_pool: ProcessPoolExecutor | None = None
+
+
+def _init_search_worker() -> None:
+    """
+    Процесс поиска получает индекс форком. Локи кэша могли быть захвачены
+    чужим потоком в момент fork — создаём свои; cdist в воркере однопоточный,
+    параллелизм даёт сам пул.
+    """
+    Search_index.SCORER_WORKERS = 1
+    svc._lemma_cache._lock = threading.Lock()
+    svc._result_cache._lock = threading.Lock()
+    svc._suggest_cache._lock = threading.Lock()
+
+
+def search_in_worker(
+    query: str,
+    top_k: int,
+    min_score: float,
+    exhaustive: bool,
+    budget: float | None = None,
+    spec: str = "auto",
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """Результаты + stats (время стадий, partial): метрики воркера пула иначе остались бы в его процессе."""
+    index = svc.cat_index
+    if index is None:
+        return [], {"timings": {}, "partial": False, "score_spec": 0.0}
+    stats: Dict[str, Any] = {}
+    results = svc.smart_search(
+        index, query, top_k=top_k, min_score=min_score, exhaustive=exhaustive,
+        stats=stats, budget=budget, spec=spec,
+    )
+    return results, stats
+
+
+def restart_search_pool() -> None:
+    """
+    Новый пул форкается от текущего процесса, то есть с текущим cat_index.
+    Старый пул доделывает начатые запросы и закрывается.
+    """
+    global search_pool
+    if svc.SEARCH_EXECUTION != "process":
+        return
+    if "fork" not in multiprocessing.get_all_start_methods():
+        svc.logger.warning("fork недоступен на этой платформе, поиск выполняется inline")
+        return
+
+    if svc.cat_index is not None:
+        _ = svc.cat_index.layout  # детектор раскладки обучаем до fork, а не в каждом воркере
+    old_pool = search_pool
+    search_pool = ProcessPoolExecutor(
+        max_workers=svc.SEARCH_PROCESSES or os.cpu_count() or 1,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_search_worker,
+    )
+    # с fork-контекстом все воркеры стартуют на первой задаче — запускаем их сейчас
+    search_pool.submit(int).result()
+    if old_pool is not None:
+        old_pool.shutdown(wait=False)
+
+
+def shutdown_search_pool() -> None:
+    global search_pool
+    if search_pool is not None:
+        search_pool.shutdown(wait=False, cancel_futures=True)
+        search_pool = None
+
+
+# ==========================
+#   ДОПУСК ЗАПРОСОВ
+# ==========================
+
+pending_searches = 0  # меняется только из event loop, лок не нужен
+
+
+@contextmanager
+def admit_search() -> Iterator[None]:
+    """
+    Место для ещё одного поиска на время блока. Если их уже
+    MAX_PENDING_SEARCHES — 503 с Retry-After, поиск не начинается.
+    """
+    global pending_searches
+    if pending_searches >= svc.MAX_PENDING_SEARCHES:
+        svc.metrics.inc("smartsearch_rejected_total")
+        raise HTTPException(
+            status_code=503, detail="Поиск перегружен, повторите позже", headers={"Retry-After": "1"}
+        )
+    pending_searches += 1
+    try:
+        yield
+    finally:
+        pending_searches -= 1
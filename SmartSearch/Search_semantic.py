@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+"""
+Семантический (векторный) поиск категорий поверх лексического SmartSearch.
+
+Названия и описания категорий кодируются sentence-transformers моделью
+офлайн, пачками на CPU; векторы и ANN-индекс (HNSW в faiss-cpu или IVF на
+NumPy, если faiss не установлен) лежат рядом со снимком индекса:
+
+    pip install sentence-transformers [faiss-cpu]
+    python Search_semantic.py build                   # по текущему снимку
+    python Search_semantic.py build --backend numpy
+
+Сервис с SEMANTIC_SEARCH=1 подключает их на старте и отвечает на
+/search/categories?mode=hybrid: кандидаты BM25/fuzzy + ближайшие по
+вектору категории, итог — смесь fuzzy-оценки и косинуса.
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+
+import Search_service_module as svc
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # семантика необязательна: без пакета работает только лексический поиск
+    SentenceTransformer = None
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+# ==========================
+#   НАСТРОЙКИ
+# ==========================
+
+# Лёгкая русская модель (та же, что в Data_science), 312-мерные векторы, быстро на CPU
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "cointegrated/rubert-tiny2")
+EMBED_BATCH_SIZE = 64
+EMBED_MAX_CHARS = 512          # описание категорий длинное — модели хватает начала
+
+ANN_BACKEND = "auto"           # "faiss" (HNSW), "numpy" (IVF) или "auto" — faiss, если есть
+HNSW_M = 32
+HNSW_EF_SEARCH = 64
+IVF_MIN_ROWS = 5_000           # меньше — точный перебор (один список), IVF не нужен
+IVF_NPROBE = 8                 # сколько ближайших кластеров просматривать
+IVF_KMEANS_ITERS = 10
+
+SEMANTIC_TOP_N = 50            # сколько соседей по вектору добавлять к лексическим кандидатам
+HYBRID_LEXICAL_POOL = 50       # сколько лексических результатов брать в смешивание
+HYBRID_SEMANTIC_WEIGHT = 0.3   # score = (1 - w) * fuzzy + w * 100 * cos
+QUERY_EMBEDDING_CACHE_SIZE = 10_000
+
+SEMANTIC_DIR_NAME = "semantic"  # подкаталог снимка CSV
+SEMANTIC_FORMAT_VERSION = 1
+
+
+# ==========================
+#   ЭМБЕДДИНГИ
+# ==========================
+
+class Embedder:
+    """
+    Обёртка над SentenceTransformer: модель грузится при первом encode,
+    векторы нормированы (скалярное произведение = косинус), float32.
+    """
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL, batch_size: int = EMBED_BATCH_SIZE):
+        if SentenceTransformer is None:
+            raise RuntimeError("Семантический поиск требует пакет sentence-transformers")
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self._model = None
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        if self._model is None:
+            self._model = SentenceTransformer(self.model_name, device="cpu")
+        vectors = self._model.encode(
+            texts,
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        return np.asarray(vectors, dtype=np.float32)
+
+
+def category_texts(index: svc.CategoryIndex) -> List[str]:
+    """Текст категории для модели: название + начало сырого описания."""
+    texts = []
+    for name, desc in zip(index.names, index.desc_raw):
+        text = f"{name}. {desc}" if desc else name
+        texts.append(text[:EMBED_MAX_CHARS])
+    return texts
+
+
+def embed_texts(
+    encode: Callable[[List[str]], np.ndarray], texts: List[str], batch_size: int = 1024
+) -> np.ndarray:
+    """
+    Кодируем пачками и пишем в заранее выделенную матрицу — в памяти
+    не копятся промежуточные списки векторов. Прогресс — в лог.
+    """
+    vectors: np.ndarray | None = None
+    t0 = time.perf_counter()
+    for start in range(0, len(texts), batch_size):
+        chunk = encode(texts[start:start + batch_size])
+        if vectors is None:
+            vectors = np.empty((len(texts), chunk.shape[1]), dtype=np.float32)
+        vectors[start:start + len(chunk)] = chunk
+        svc.logger.info(
+            "Эмбеддинги: %d / %d (%.1f с)",
+            min(start + batch_size, len(texts)), len(texts), time.perf_counter() - t0,
+        )
+    if vectors is None:
+        return np.zeros((0, 0), dtype=np.float32)
+    return vectors
+
+
+# ==========================
+#   ANN-ИНДЕКСЫ
+# ==========================
+
+class NumpyIvfIndex:
+    """
+    IVF на NumPy: сферический k-means разбивает векторы на ~sqrt(n) кластеров,
+    запрос сравнивается с центроидами и перебирает только IVF_NPROBE ближайших
+    списков. Векторы читаются из снимка через mmap.
+    """
+
+    backend = "numpy"
+
+    def __init__(
+        self, vectors: np.ndarray, centroids: np.ndarray,
+        list_indptr: np.ndarray, list_rows: np.ndarray,
+    ):
+        self.vectors = vectors
+        self.centroids = centroids
+        self.list_indptr = list_indptr
+        self.list_rows = list_rows
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, seed: int = 0) -> "NumpyIvfIndex":
+        n = len(vectors)
+        n_lists = 1 if n < IVF_MIN_ROWS else int(np.sqrt(n))
+        if n_lists == 1:
+            assign = np.zeros(n, dtype=np.int64)
+            centroids = np.zeros((1, vectors.shape[1]), dtype=np.float32)
+        else:
+            rng = np.random.default_rng(seed)
+            centroids = vectors[rng.choice(n, n_lists, replace=False)].copy()
+            for _ in range(IVF_KMEANS_ITERS):
+                assign = cls._assign(vectors, centroids)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assign, vectors)
+                counts = np.bincount(assign, minlength=n_lists)
+                empty = counts == 0
+                # пустой кластер пересеиваем случайной точкой
+                sums[empty] = vectors[rng.choice(n, int(empty.sum()), replace=False)]
+                norms = np.linalg.norm(sums, axis=1, keepdims=True)
+                centroids = (sums / np.maximum(norms, 1e-12)).astype(np.float32)
+            assign = cls._assign(vectors, centroids)
+
+        order = np.argsort(assign, kind="stable")
+        list_indptr = np.zeros(len(centroids) + 1, dtype=np.int64)
+        list_indptr[1:] = np.cumsum(np.bincount(assign, minlength=len(centroids)))
+        return cls(vectors, centroids, list_indptr, order.astype(np.int32))
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray, chunk: int = 8192) -> np.ndarray:
+        return np.concatenate([
+            np.argmax(vectors[i:i + chunk] @ centroids.T, axis=1)
+            for i in range(0, len(vectors), chunk)
+        ])
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(косинусы, строки) формы (запросы x k), нехватка добита -1."""
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        nprobe = min(IVF_NPROBE, len(self.centroids))
+        for i, q in enumerate(queries):
+            if len(self.centroids) == 1:
+                cand = np.arange(len(self.vectors))
+            else:
+                lists = np.argpartition(-(self.centroids @ q), nprobe - 1)[:nprobe]
+                cand = np.concatenate([
+                    self.list_rows[self.list_indptr[c]:self.list_indptr[c + 1]] for c in lists
+                ])
+            if not len(cand):
+                continue
+            cand = np.sort(cand)  # чтение mmap по возрастанию строк
+            sims = np.asarray(self.vectors[cand] @ q)
+            best = svc.top_k_indices(sims, k)
+            scores[i, :len(best)] = sims[best]
+            rows[i, :len(best)] = cand[best]
+        return scores, rows
+
+    def save(self, path: str) -> None:
+        for name in ("centroids", "list_indptr", "list_rows"):
+            np.save(os.path.join(path, f"ivf_{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, path: str, vectors: np.ndarray) -> "NumpyIvfIndex":
+        def arr(name: str) -> np.ndarray:
+            return np.load(os.path.join(path, f"ivf_{name}.npy"), mmap_mode="r")
+
+        return cls(vectors, np.asarray(arr("centroids")), arr("list_indptr"), arr("list_rows"))
+
+
+class FaissHnswIndex:
+    """HNSW из faiss-cpu по скалярному произведению (векторы нормированы)."""
+
+    backend = "faiss"
+
+    def __init__(self, index):
+        self.index = index
+        self.index.hnsw.efSearch = HNSW_EF_SEARCH
+
+    @classmethod
+    def build(cls, vectors: np.ndarray) -> "FaissHnswIndex":
+        index = faiss.IndexHNSWFlat(vectors.shape[1], HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+        return cls(index)
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        scores, rows = self.index.search(np.ascontiguousarray(queries, dtype=np.float32), k)
+        return scores, rows.astype(np.int64)
+
+    def save(self, path: str) -> None:
+        faiss.write_index(self.index, os.path.join(path, "hnsw.faiss"))
+
+    @classmethod
+    def load(cls, path: str, vectors: np.ndarray) -> "FaissHnswIndex":
+        return cls(faiss.read_index(os.path.join(path, "hnsw.faiss")))
+
+
+def _resolve_backend(backend: str) -> str:
+    if backend == "auto":
+        return "faiss" if faiss is not None else "numpy"
+    if backend == "faiss" and faiss is None:
+        raise RuntimeError("ANN_BACKEND='faiss', но пакет faiss-cpu не установлен")
+    return backend
+
+
+# ==========================
+#   СЕМАНТИЧЕСКИЙ ИНДЕКС
+# ==========================
+
+class SemanticIndex:
+    """
+    Векторы категорий (по id) + ANN-индекс + кэш эмбеддингов запросов.
+    Привязан к снимку CSV: категории из /index/upsert векторов не имеют
+    (их находит лексический поиск) до следующей офлайн-сборки.
+    """
+
+    def __init__(self, ids: np.ndarray, vectors: np.ndarray, ann, model_name: str, embedder=None):
+        self.ids = ids
+        self.vectors = vectors
+        self.ann = ann
+        self.model_name = model_name
+        self.embedder = embedder or Embedder(model_name)
+        self.query_cache = svc.LRUCache(QUERY_EMBEDDING_CACHE_SIZE)
+        self._id_order = np.argsort(ids, kind="stable")
+        self._sorted_ids = np.asarray(ids)[self._id_order]
+        self._row_lookup: Tuple[int, np.ndarray, np.ndarray] | None = None
+
+    def embed_query(self, text: str) -> np.ndarray:
+        key = " ".join(text.lower().split())
+        vector = self.query_cache.get(key)
+        if vector is None:
+            vector = self.embedder.encode([key])[0]
+            self.query_cache.put(key, vector)
+        return vector
+
+    def nearest(self, query_vec: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(id категорий, косинусы) k ближайших."""
+        scores, rows = self.ann.search(query_vec[None, :], k)
+        keep = rows[0] >= 0
+        return np.asarray(self.ids)[rows[0][keep]], scores[0][keep]
+
+    def similarity(self, query_vec: np.ndarray, ids: np.ndarray) -> np.ndarray:
+        """Косинус запроса с категориями ids; нет вектора — NaN."""
+        pos = np.searchsorted(self._sorted_ids, ids)
+        pos = np.minimum(pos, len(self._sorted_ids) - 1)
+        found = self._sorted_ids[pos] == ids
+        sims = np.full(len(ids), np.nan)
+        if found.any():
+            rows = self._id_order[pos[found]]
+            sims[found] = np.asarray(self.vectors[rows]) @ query_vec
+        return sims
+
+    def rows_in(self, index: svc.CategoryIndex, ids: np.ndarray) -> np.ndarray:
+        """Номера строк index для ids (которых там уже нет — пропускаются)."""
+        if self._row_lookup is None or self._row_lookup[0] != index.version:
+            order = np.argsort(index.ids, kind="stable")
+            self._row_lookup = (index.version, np.asarray(index.ids)[order], order)
+        _, sorted_ids, order = self._row_lookup
+        pos = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+        found = sorted_ids[pos] == ids
+        return order[pos[found]]
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "model": self.model_name,
+            "backend": self.ann.backend,
+            "vectors": int(len(self.ids)),
+            "dim": int(self.vectors.shape[1]) if self.vectors.ndim == 2 else 0,
+            "query_cache": self.query_cache.stats(),
+        }
+
+
+def semantic_path(index: svc.CategoryIndex) -> str | None:
+    """Каталог векторов: внутри снимка CSV, из которого вырос индекс."""
+    if index.snapshot is None:
+        return None
+    csv_key = index.snapshot.split(svc._LIVE_SNAPSHOT_SEP)[0]
+    return os.path.join(svc.SNAPSHOT_DIR, csv_key, SEMANTIC_DIR_NAME)
+
+
+def build_semantic_index(
+    index: svc.CategoryIndex,
+    path: str,
+    embedder=None,
+    backend: str = ANN_BACKEND,
+    model_name: str = EMBEDDING_MODEL,
+) -> SemanticIndex:
+    """Офлайн-сборка: эмбеддинги всех категорий + ANN, атомарная запись в path."""
+    embedder = embedder or Embedder(model_name)
+    backend = _resolve_backend(backend)
+
+    t0 = time.perf_counter()
+    vectors = embed_texts(embedder.encode, category_texts(index))
+    ann_cls = FaissHnswIndex if backend == "faiss" else NumpyIvfIndex
+    ann = ann_cls.build(vectors)
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "ids.npy"), np.asarray(index.ids, dtype=np.int64))
+    np.save(os.path.join(tmp_path, "vectors.npy"), vectors)
+    ann.save(tmp_path)
+    meta = {
+        "format_version": SEMANTIC_FORMAT_VERSION,
+        "model": model_name,
+        "backend": backend,
+        "n_categories": len(index),
+        "dim": int(vectors.shape[1]) if vectors.size else 0,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+    svc.logger.info(
+        "Семантический индекс (%s, %s) собран за %.1f с: %s",
+        model_name, backend, time.perf_counter() - t0, path,
+    )
+    return load_semantic_index(index, path=path, embedder=embedder)
+
+
+def load_semantic_index(
+    index: svc.CategoryIndex, path: str | None = None, embedder=None
+) -> SemanticIndex | None:
+    """Векторы и ANN из снимка (mmap); None — их нет или не хватает пакетов."""
+    path = path or semantic_path(index)
+    if path is None or not os.path.isfile(os.path.join(path, "meta.json")):
+        return None
+    with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("format_version") != SEMANTIC_FORMAT_VERSION:
+        svc.logger.warning("Семантический индекс %s: другой формат, нужна пересборка", path)
+        return None
+    if embedder is None and SentenceTransformer is None:
+        svc.logger.warning("sentence-transformers не установлен, семантический поиск выключен")
+        return None
+    if meta["backend"] == "faiss" and faiss is None:
+        svc.logger.warning("Семантический индекс %s собран faiss, а faiss-cpu не установлен", path)
+        return None
+
+    ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+    vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+    ann_cls = FaissHnswIndex if meta["backend"] == "faiss" else NumpyIvfIndex
+    return SemanticIndex(
+        ids, vectors, ann_cls.load(path, vectors), meta["model"],
+        embedder=embedder or Embedder(meta["model"]),
+    )
+
+
+# ==========================
+#   ГИБРИДНЫЙ ПОИСК
+# ==========================
+
+def hybrid_search(
+    index: svc.CategoryIndex,
+    sem: SemanticIndex,
+    query: str,
+    top_k: int = svc.DEFAULT_TOP_K,
+    min_score: float = svc.DEFAULT_MIN_SCORE,
+    stats: Dict[str, Any] | None = None,
+    budget: float | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    Лексические результаты (BM25 -> fuzzy) + SEMANTIC_TOP_N ближайших по
+    вектору. Новые категории из векторной выдачи оцениваются тем же fuzzy,
+    у лексических досчитывается косинус; итог
+    score = (1 - w) * fuzzy + w * 100 * max(cos, 0), фильтр min_score — по нему.
+    budget (секунды) ограничивает лексическую часть, как в smart_search.
+    """
+    timer = svc.StageTimer()
+    lexical_stats: Dict[str, Any] = {}
+    lexical = svc.smart_search(
+        index, query, top_k=max(top_k, HYBRID_LEXICAL_POOL), min_score=0.0,
+        stats=lexical_stats, budget=budget,
+    )
+    timer.timings.update(lexical_stats.get("timings", {}))
+    if stats is not None:
+        stats["timings"] = timer.timings
+        stats["partial"] = lexical_stats.get("partial", False)
+
+    fixed = svc.correct_keyboard_layout((query or "").strip(), index.layout)
+    query_lem = svc.lemmatize_text(fixed) if fixed else ""
+    if not query_lem:
+        return []
+
+    with timer("embed"):
+        query_vec = sem.embed_query(fixed)
+    with timer("semantic"):
+        sem_ids, _ = sem.nearest(query_vec, SEMANTIC_TOP_N)
+        known = {r["id"] for r in lexical}
+        new_ids = np.array([i for i in sem_ids.tolist() if i not in known], dtype=np.int64)
+        new_rows = sem.rows_in(index, new_ids)
+    with timer("scoring"):
+        extra = svc.score_rows(index, query_lem, new_rows)
+
+    merged = lexical + extra
+    if not merged:
+        return []
+    cos = sem.similarity(query_vec, np.array([r["id"] for r in merged], dtype=np.int64))
+    w = HYBRID_SEMANTIC_WEIGHT
+    for r, c in zip(merged, cos.tolist()):
+        r["score_semantic"] = None if np.isnan(c) else round(100.0 * c, 4)
+        r["score"] = (1.0 - w) * r["score"] + w * 100.0 * max(0.0 if np.isnan(c) else c, 0.0)
+
+    merged = [r for r in merged if r["score"] >= min_score]
+    merged.sort(key=lambda r: (-r["score"], r["id"]))
+    return merged[:top_k]
+
+
+# ==========================
+#   CLI
+# ==========================
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-сборка семантического индекса SmartSearch")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parser.add_argument("--backend", choices=["auto", "faiss", "numpy"], default=ANN_BACKEND)
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE)
+    args = parser.parse_args()
+
+    index = svc.load_or_build_index()
+    path = semantic_path(index)
+    if path is None:
+        parser.error("семантический индекс хранится в снимке, нужен USE_INDEX_SNAPSHOT = True")
+    sem = build_semantic_index(
+        index, path,
+        embedder=Embedder(args.model, batch_size=args.batch_size),
+        backend=args.backend,
+        model_name=args.model,
+    )
+    print(json.dumps(sem.info(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
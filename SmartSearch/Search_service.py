@@ -1,19 +1,17 @@
 import re
 import sys
+from functools import lru_cache
+import numpy as np
 import pandas as pd
-from rapidfuzz import fuzz
+from rapidfuzz import fuzz, process
 import pymorphy3
 
+from Search_layout import EN_TO_RU, LayoutDetector
+
 CSV_PATH = "result_itr4.csv"  # поменяй путь, если нужно
 
 # ---------- 1. Исправление раскладки EN → RU ----------
 
-EN_TO_RU = str.maketrans({
-    'q':'й', 'w':'ц', 'e':'у', 'r':'к', 't':'е', 'y':'н', 'u':'г', 'i':'ш', 'o':'щ', 'p':'з', '[':'х', ']':'ъ',
-    'a':'ф', 's':'ы', 'd':'в', 'f':'а', 'g':'п', 'h':'р', 'j':'о', 'k':'л', 'l':'д', ';':'ж', '\'':'э',
-    'z':'я', 'x':'ч', 'c':'с', 'v':'м', 'b':'и', 'n':'т', 'm':'ь', ',':'б', '.':'ю', '`':'ё'
-})
-
 def fix_layout_en_to_ru(text: str) -> str:
     return text.translate(EN_TO_RU)
 
@@ -22,6 +20,12 @@ def fix_layout_en_to_ru(text: str) -> str:
 morph = pymorphy3.MorphAnalyzer(lang="ru")
 WORD_RE = re.compile(r"[a-zа-я0-9]+", re.IGNORECASE)
 
+
+@lru_cache(maxsize=200_000)
+def lemma(word: str) -> str:
+    """normal_form слова; одни и те же слова повторяются в описаниях постоянно."""
+    return morph.parse(word)[0].normal_form
+
 def normalize_and_lemmatize(text: str) -> str:
     """
     - lower
@@ -36,19 +40,29 @@ def normalize_and_lemmatize(text: str) -> str:
     lemmas = []
     for w in words:
         if re.search("[а-я]", w):
-            p = morph.parse(w)[0]
-            lemmas.append(p.normal_form)
+            lemmas.append(lemma(w))
         else:
             # латиница / цифры — оставляем как есть
             lemmas.append(w)
     return " ".join(lemmas)
 
-# ---------- 3. Загрузка CSV и построение индекса ----------
+# ---------- 2б. Раскладка: по каждому слову, а не весь запрос ----------
 
-def build_index(csv_path: str) -> pd.DataFrame:
-    print(f"Загружаю CSV: {csv_path}")
-    df = pd.read_csv(csv_path, low_memory=False)
+def build_layout(cat_df: pd.DataFrame) -> LayoutDetector:
+    """
+    Модель раскладки (биграммы символов, см. Search_layout) по словарю лемм
+    этого индекса; слова запроса проверяются тем же normalize_and_lemmatize,
+    которым построен индекс. Латинские бренды из каталога остаются как есть.
+    """
+    words = {}
+    for col in ("name_norm", "desc_norm"):
+        for text in cat_df[col]:
+            words.update(dict.fromkeys(text.split(), 0))
+    return LayoutDetector(words, normalize_and_lemmatize)
 
+# ---------- 3. Загрузка CSV и построение индекса ----------
+
+def _join_specs(df: pd.DataFrame) -> pd.Series:
     # колонки-спеки (описание)
     spec_cols = [c for c in df.columns if c.startswith("spec")]
 
@@ -56,13 +70,41 @@ def build_index(csv_path: str) -> pd.DataFrame:
         texts = [str(row[c]) for c in spec_cols if pd.notna(row[c])]
         return " ".join(texts)
 
-    df["category_desc_raw"] = df.apply(join_specs, axis=1)
+    return df.apply(join_specs, axis=1)
+
 
-    # Группируем по id_категории + названию (на случай дублей по товарам)
-    cat_df = (
-        df.groupby(["id_категории", "название_категории"], as_index=False)
-          .agg({"category_desc_raw": lambda x: " ".join(set(x))})
-    )
+def _use_column(col: str) -> bool:
+    return col in ("id_категории", "название_категории") or col.startswith("spec")
+
+
+def build_index(csv_path: str, chunksize: int = None) -> pd.DataFrame:
+    """
+    chunksize — читать CSV кусками: в памяти копятся только уникальные
+    описания по категориям, а не вся таблица СТЕ со всеми spec-колонками.
+    """
+    print(f"Загружаю CSV: {csv_path}")
+
+    if chunksize:
+        descs = {}
+        for chunk in pd.read_csv(csv_path, usecols=_use_column, chunksize=chunksize):
+            chunk = chunk.assign(category_desc_raw=_join_specs(chunk))
+            for key, texts in chunk.groupby(["id_категории", "название_категории"])["category_desc_raw"]:
+                descs.setdefault(key, set()).update(texts)
+        keys = sorted(descs)
+        cat_df = pd.DataFrame({
+            "id_категории": [k[0] for k in keys],
+            "название_категории": [k[1] for k in keys],
+            "category_desc_raw": [" ".join(descs[k]) for k in keys],
+        })
+    else:
+        df = pd.read_csv(csv_path, usecols=_use_column, low_memory=False)
+        df["category_desc_raw"] = _join_specs(df)
+
+        # Группируем по id_категории + названию (на случай дублей по товарам)
+        cat_df = (
+            df.groupby(["id_категории", "название_категории"], as_index=False)
+              .agg({"category_desc_raw": lambda x: " ".join(set(x))})
+        )
 
     print(f"Всего уникальных категорий: {len(cat_df)}")
 
@@ -78,50 +120,95 @@ def build_index(csv_path: str) -> pd.DataFrame:
 
 # ---------- 4. Функция умного поиска ----------
 
-def smart_search(cat_df: pd.DataFrame, query: str, top_k: int = 10, min_score: int = 40):
-    # варианты запроса: как есть и с исправленной раскладкой
-    q_orig = normalize_and_lemmatize(query)
-    q_fixed = normalize_and_lemmatize(fix_layout_en_to_ru(query))
+class FuzzyScorer:
+    """
+    name_norm / desc_norm держим непрерывными списками и оцениваем все строки
+    одним вызовом process.cdist (C++, все ядра) вместо partial_ratio по строкам.
+    """
 
-    queries = [q_orig]
-    if q_fixed != q_orig:
-        queries.append(q_fixed)
+    def __init__(self, cat_df: pd.DataFrame, workers: int = -1):
+        self.name_norm = cat_df["name_norm"].tolist()
+        self.desc_norm = cat_df["desc_norm"].tolist()
+        self.workers = workers
 
-    results = []
+    def _best(self, queries, choices):
+        """Лучшая оценка по всем вариантам запроса для каждой строки."""
+        return process.cdist(
+            queries, choices, scorer=fuzz.partial_ratio,
+            dtype=np.float64, workers=self.workers,
+        ).max(axis=0)
 
-    for _, row in cat_df.iterrows():
-        best_score_name = 0
-        best_score_desc = 0
+    def score_names(self, queries):
+        return self._best(queries, self.name_norm)
 
-        for q in queries:
-            # приоритет имени категории — короткий текст
-            score_name = fuzz.partial_ratio(q, row["name_norm"])
-            # описание длинное, тоже partial_ratio
-            score_desc = fuzz.partial_ratio(q, row["desc_norm"])
+    def score_descs(self, queries, rows):
+        return self._best(queries, [self.desc_norm[i] for i in rows])
 
-            if score_name > best_score_name:
-                best_score_name = score_name
-            if score_desc > best_score_desc:
-                best_score_desc = score_desc
 
-        final_score = 0.8 * best_score_name + 0.2 * best_score_desc
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """k лучших по убыванию (при равенстве — меньший индекс) через argpartition."""
+    n = len(scores)
+    if n > k:
+        kth = np.partition(scores, n - k)[n - k]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)[:k - len(above)]
+        idx = np.concatenate([above, ties])
+    else:
+        idx = np.arange(n)
+    return idx[np.lexsort((idx, -scores[idx]))]
 
-        if final_score >= min_score:
-            results.append({
-                "id_категории": row["id_категории"],
-                "название_категории": row["название_категории"],
-                "score": final_score,
-                "score_name": best_score_name,
-                "score_desc": best_score_desc,
-            })
 
-    results.sort(key=lambda x: x["score"], reverse=True)
-    return results[:top_k]
+def smart_search(cat_df: pd.DataFrame, query: str, top_k: int = 10, min_score: int = 40,
+                 scorer: FuzzyScorer = None, layout: LayoutDetector = None):
+    """
+    scorer и layout лучше строить один раз на индекс и передавать (см. main):
+    без них они собираются заново на каждый запрос по всему каталогу.
+    """
+    if scorer is None:
+        scorer = FuzzyScorer(cat_df)
+    if layout is None:
+        layout = build_layout(cat_df)
+    # раскладку выбираем по словам заранее — оцениваем один вариант запроса, а не два
+    queries = [normalize_and_lemmatize(layout.fix(str(query)))]
+
+    # приоритет имени категории — короткий текст, считаем его для всех строк
+    best_score_name = scorer.score_names(queries)
+
+    # final = 0.8 * name + 0.2 * desc лежит в [0.8 * name, 0.8 * name + 20]:
+    # длинное описание оцениваем только там, где строка ещё может пройти
+    # min_score и попасть в top_k по нижним границам остальных
+    lower = 0.8 * best_score_name
+    n = len(lower)
+    kth = np.partition(lower, n - top_k)[n - top_k] if n > top_k else -np.inf
+    need_desc = np.flatnonzero(lower + 20 >= max(min_score, kth))
+
+    best_score_desc = np.zeros(n)
+    best_score_desc[need_desc] = scorer.score_descs(queries, need_desc)
+    final_score = np.full(n, -1.0)
+    final_score[need_desc] = lower[need_desc] + 0.2 * best_score_desc[need_desc]
+
+    passing = np.flatnonzero(final_score >= min_score)
+    best = passing[top_k_indices(final_score[passing], top_k)]
+
+    ids = cat_df["id_категории"].to_numpy()
+    names = cat_df["название_категории"].to_numpy()
+    return [
+        {
+            "id_категории": ids[i],
+            "название_категории": names[i],
+            "score": float(final_score[i]),
+            "score_name": float(best_score_name[i]),
+            "score_desc": float(best_score_desc[i]),
+        }
+        for i in best.tolist()
+    ]
 
 # ---------- 5. Простой CLI для обкатки ----------
 
 def main():
     cat_df = build_index(CSV_PATH)
+    scorer = FuzzyScorer(cat_df)
+    layout = build_layout(cat_df)
 
     print()
     print("=== УМНЫЙ ПОИСК ПО КАТЕГОРИЯМ ===")
@@ -139,7 +226,7 @@ def main():
             print("Выход.")
             break
 
-        res = smart_search(cat_df, q, top_k=10, min_score=40)
+        res = smart_search(cat_df, q, top_k=10, min_score=40, scorer=scorer, layout=layout)
 
         if not res:
             print("Ничего не найдено (score < 40).")
@@ -1,13 +1,48 @@
 #!/usr/bin/env python
+import hashlib
+import json
+import logging
+import os
 import re
-from typing import List, Dict, Any
-
+import shutil
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import count
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from typing import List, Dict, Any, Iterable, Iterator, Tuple
+
+import numpy as np
 import pandas as pd
-from rapidfuzz import fuzz
 import pymorphy3
-from fastapi import FastAPI, Query
+from fastapi import HTTPException
 from pydantic import BaseModel
 
+from Search_index import (
+    BM25_B,
+    BM25_K1,
+    DESC_SCORE_WEIGHT,
+    NGRAM_SIZE,
+    SPEC_MAX_KEY_WORDS,
+    SPEC_MAX_VALUE_WORDS,
+    SUGGEST_LIMIT,
+    FuzzyScorer,
+    ItemIndex,
+    NgramIndex,
+    SpecIndex,
+    SuggestTrie,
+    TextColumn,
+    combine_scores,
+    normalize_tokens,
+    suggest_max_distance,
+    top_k_indices,
+)
+from Search_index import NAME_HIT_WEIGHT  # noqa: F401 — реэкспорт: с ним тесты сверяют BM25
+from Search_layout import EN_TO_RU, LayoutDetector, correct_keyboard_layout
+
 # ==========================
 #   НАСТРОЙКИ
 # ==========================
@@ -20,28 +55,323 @@ CSV_PATH = "py_back/rexexp/data/result_itr4.csv"
 # Сколько результатов возвращаем
 DEFAULT_TOP_K = 10
 DEFAULT_MIN_SCORE = 40.0
+MAX_QUERY_CHARS = 300        # длиннее — 422: fuzzy по описаниям растёт с длиной запроса (4 КБ ~ 10 с)
+
+# Исполнение поиска: "inline" — в тредпуле FastAPI, "process" — в пуле
+# процессов, форкнутых после загрузки индекса (индекс общий через copy-on-write / mmap)
+SEARCH_EXECUTION = os.getenv("SEARCH_EXECUTION", "inline")
+SEARCH_PROCESSES = 0         # 0 — по числу ядер
+MAX_PENDING_SEARCHES = 32    # больше одновременных поисков — 503; меньше тредпула (40),
+                             # чтобы служебным эндпоинтам всегда оставались потоки
+
+# Пакетный поиск (/search/categories/batch)
+MAX_BATCH_QUERIES = 50_000   # ограничение на один запрос
+BATCH_CHUNK_SIZE = 64        # сколько запросов оцениваем одной матрицей cdist
 
 # Сколько СТЕ/строк спецификаций использовать при сборке описания категории
 MAX_PRODUCTS_PER_CAT = 50   # чтобы сильно не раздувать текст
 MAX_TOTAL_SPEC_LINES = 200  # на всякий случай, ограничение объёма
+CSV_AGGREGATION = "vectorized"  # "rowwise" — старый построчный вариант (для сравнения)
+CSV_CHUNK_ROWS = None        # None — читать CSV целиком; N — потоково по N строк СТЕ
+
+# Параллельная сборка индекса: 1 — последовательно, 0 — по числу ядер
+BUILD_WORKERS = 1
+BUILD_SHARDS_PER_WORKER = 4  # мелкие шарды ровнее раскладываются по процессам
+
+# Снимок индекса на диске: при неизменном CSV старт без пересборки
+USE_INDEX_SNAPSHOT = True
+SNAPSHOT_DIR = "py_back/rexexp/data/index_snapshots"
+SNAPSHOT_VERSION = 5        # менять при любом изменении формата/содержимого индекса
+
+# Несколько воркеров uvicorn: индекс один раз собирает процесс-сборщик,
+# воркеры только открывают опубликованный снимок через mmap (страницы
+# общие в page cache, в памяти каждого воркера — лишь словари n-грамм)
+SERVICE_WORKERS = int(os.getenv("SERVICE_WORKERS", "1"))
+SHARED_SNAPSHOT = os.getenv("SMARTSEARCH_SHARED_SNAPSHOT") == "1"  # выставляет `serve --workers N`
+SNAPSHOT_POLL_SECONDS = 2.0  # как часто воркер проверяет, не опубликован ли новый снимок
+
+# Шарды (Search_shard.py): категории делятся по id_категории % SEARCH_SHARDS
+# между процессами, у каждого шарда свой снимок и своя пересборка; сервис
+# рассылает запросы по Unix-сокетам и сливает top-k. 0 — весь индекс в сервисе
+SEARCH_SHARDS = int(os.getenv("SEARCH_SHARDS", "0"))
+CATEGORY_SHARD: Tuple[int, int] | None = None  # (номер, всего) — выставляет процесс-шард
+
+# Семантический поиск (Search_semantic.py, нужен sentence-transformers):
+# векторы собираются офлайн, сервис лишь подключает их и отвечает на mode=hybrid
+SEMANTIC_SEARCH = os.getenv("SEMANTIC_SEARCH", "0") == "1"
+
+# Поиск по СТЕ (/search/items): индекс названий СТЕ рядом с индексом категорий
+ITEM_SEARCH = os.getenv("ITEM_SEARCH", "0") == "1"
+ITEM_CANDIDATES = 1000       # СТЕ на fuzzy-скоринг (СТЕ намного больше, чем категорий)
+ITEMS_PER_CATEGORY = 5
+
+# Кэш лемм pymorphy3 (слово -> лемма)
+LEMMA_CACHE_SIZE = 200_000
+# Файл кэша между рестартами: "" — lemma_cache.json в SNAPSHOT_DIR (у шарда — в его
+# каталоге снимков), None — не сохранять
+LEMMA_CACHE_PATH = os.getenv("SMARTSEARCH_LEMMA_CACHE", "")
+LEMMA_CACHE_FILE = "lemma_cache.json"
+
+# Наблюдаемость: /metrics в формате Prometheus + лог медленных запросов
+LOG_LEVEL = os.getenv("SMARTSEARCH_LOG_LEVEL", "INFO")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "0")) or None  # None — лог выключен
+SEARCH_LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+INDEX_BUILD_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+# Кэш результатов поиска (запрос, top_k, min_score, версия индекса) -> ответ
+RESULT_CACHE_SIZE = 10_000
+RESULT_CACHE_TTL = 300.0     # секунд; None — без срока жизни
+
+# Настройки инвертированного индекса, BM25, характеристик, дерева /suggest
+# и fuzzy-скоринга живут рядом со структурами — в Search_index
+
+# Раскладка запроса: слово переводится EN→RU, только если так оно правдоподобнее
+# по биграммной модели символов словаря каталога (бренды на латинице не трогаем)
+LAYOUT_SMOOTHING = 0.1       # add-k сглаживание биграмм
+LAYOUT_MIN_GAIN = 1.5        # на сколько средний log P биграммы должен вырасти после перевода
+
+SUGGEST_CACHE_SIZE = 50_000  # ответы /suggest по (префикс, limit, опечатки, версия индекса)
+
+# Бюджет времени на запрос: когда он исчерпан, описания больше не оцениваются,
+# ответ — лучшее из уже посчитанного с признаком partial. 0 в переменной — без ограничения
+SEARCH_TIME_BUDGET_MS = float(os.getenv("SEARCH_TIME_BUDGET_MS", "500")) or None
+BATCH_TIME_BUDGET_MS = float(os.getenv("BATCH_TIME_BUDGET_MS", "60000")) or None  # на весь пакет
+DESC_SCORING_CHUNK = 32      # максимум описаний на один вызов cdist между проверками бюджета
 
 
 # ==========================
-#   ИСПРАВЛЕНИЕ РАСКЛАДКИ EN→RU
+#   ИСПРАВЛЕНИЕ РАСКЛАДКИ EN→RU (Search_layout)
 # ==========================
 
-EN_TO_RU = str.maketrans({
-    'q':'й', 'w':'ц', 'e':'у', 'r':'к', 't':'е', 'y':'н', 'u':'г', 'i':'ш', 'o':'щ', 'p':'з', '[':'х', ']':'ъ',
-    'a':'ф', 's':'ы', 'd':'в', 'f':'а', 'g':'п', 'h':'р', 'j':'о', 'k':'л', 'l':'д', ';':'ж', '\'':'э',
-    'z':'я', 'x':'ч', 'c':'с', 'v':'м', 'b':'и', 'n':'т', 'm':'ь', ',':'б', '.':'ю', '`':'ё'
-})
+_LATIN_RE = re.compile(r"[a-z]")
 
 
-def correct_keyboard_layout(text: str) -> str:
-    """Пытаемся починить, если пользователь набрал русский на EN-раскладке."""
-    if not text:
-        return text
-    return text.translate(EN_TO_RU)
+# ==========================
+#   LRU-КЭШ
+# ==========================
+
+class LRUCache:
+    """
+    Потокобезопасный LRU-кэш ограниченного размера со счётчиками попаданий.
+    ttl (секунды) — записи старше считаются промахом и выбрасываются.
+    """
+
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._expires: Dict[Any, float] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None and self._expires[key] <= time.monotonic():
+                del self._data[key]
+                del self._expires[key]
+                self.expired += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if self.ttl is not None:
+                self._expires[key] = time.monotonic() + self.ttl
+            while len(self._data) > self.maxsize:
+                old_key, _ = self._data.popitem(last=False)
+                self._expires.pop(old_key, None)
+
+    def items(self) -> List[Tuple[Any, Any]]:
+        """Копия содержимого от старых к свежим (для сохранения на диск)."""
+        with self._lock:
+            return list(self._data.items())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        stats = {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+        if self.ttl is not None:
+            stats["ttl"] = self.ttl
+            stats["expired"] = self.expired
+        return stats
+
+
+# ==========================
+#   ЛОГИ И МЕТРИКИ
+# ==========================
+
+logger = logging.getLogger("smartsearch")
+if not logger.handlers:
+    # воркеры uvicorn импортируют модуль заново, basicConfig из main() до них не доходит
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s")
+    )
+    logger.addHandler(_log_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+
+class Histogram:
+    """Гистограмма в стиле Prometheus: счётчики по корзинам (le), сумма, количество."""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # последняя корзина — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class MetricsRegistry:
+    """
+    Счётчики и гистограммы процесса с метками; render() отдаёт текстовый
+    формат Prometheus. Каждый процесс (воркер uvicorn) считает своё.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {}
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        self._histograms: Dict[Tuple[str, tuple], Histogram] = {}
+
+    def counter(self, name: str, help_text: str) -> None:
+        self._meta[name] = ("counter", help_text, ())
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...]) -> None:
+        self._meta[name] = ("histogram", help_text, buckets)
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram(self._meta[name][2])
+            hist.observe(value)
+
+    @contextmanager
+    def time(self, name: str, **labels: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def render(self, gauges: Dict[str, Tuple[str, float]] | None = None) -> str:
+        """gauges: имя -> (описание, значение) — мгновенные значения на момент запроса."""
+        lines: List[str] = []
+        with self._lock:
+            for name, (kind, help_text, _) in self._meta.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "counter":
+                    for (n, labels), value in self._counters.items():
+                        if n == name:
+                            lines.append(f"{name}{_format_labels(labels)} {value:g}")
+                    continue
+                for (n, labels), hist in self._histograms.items():
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count_ in zip(hist.buckets + (float("inf"),), hist.counts):
+                        cumulative += count_
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        bucket_labels = _format_labels(labels, f'le="{le}"')
+                        lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {hist.sum:.6f}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {hist.count}")
+        for name, (help_text, value) in (gauges or {}).items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    """Замер стадий запроса: with timer("scoring"): ... -> timer.timings["scoring"] (с)."""
+
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def __call__(self, stage: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - t0
+
+
+metrics = MetricsRegistry()
+metrics.histogram(
+    "smartsearch_search_stage_seconds",
+    "Время стадий поиска (layout, lemmatize, candidates, scoring, serialize)",
+    SEARCH_LATENCY_BUCKETS,
+)
+metrics.histogram(
+    "smartsearch_request_seconds", "Полное время обработки поискового запроса",
+    SEARCH_LATENCY_BUCKETS,
+)
+metrics.counter("smartsearch_queries_total", "Поисковые запросы (batch — по числу запросов в пакете)")
+metrics.counter("smartsearch_result_cache_hits_total", "Ответы из кэша результатов")
+metrics.counter("smartsearch_empty_results_total", "Запросы без единого результата")
+metrics.counter("smartsearch_rejected_total", "Запросы, отклонённые с 503 из-за перегрузки")
+metrics.counter("smartsearch_slow_queries_total", "Запросы дольше SLOW_QUERY_MS")
+metrics.counter("smartsearch_partial_results_total", "Неполные ответы (partial): кончился бюджет времени или шард недоступен")
+metrics.counter("smartsearch_shard_errors_total", "Шарды, не ответившие на операцию (SEARCH_SHARDS)")
+metrics.histogram(
+    "smartsearch_index_build_seconds",
+    "Сборка/загрузка индекса (source: csv, snapshot, incremental, upsert, delete)",
+    INDEX_BUILD_BUCKETS,
+)
+
+
+def observe_search_stages(timings: Dict[str, float], endpoint: str) -> None:
+    for stage, seconds in timings.items():
+        metrics.observe("smartsearch_search_stage_seconds", seconds, stage=stage, endpoint=endpoint)
 
 
 # ==========================
@@ -49,15 +379,40 @@ def correct_keyboard_layout(text: str) -> str:
 # ==========================
 
 _morph = pymorphy3.MorphAnalyzer()
+_lemma_cache = LRUCache(LEMMA_CACHE_SIZE)
 
 _clear_re = re.compile(r"[^a-zA-Zа-яА-ЯёЁ0-9%/.,\-\s]+")
 
+_NUMERIC_TOKEN_RE = re.compile(r"[0-9%/.\-]+")
+
 
 def normalize_text(text: str) -> str:
     """
     Приводим текст к нижнему регистру, чистим мусор,
     заменяем ё→е, сжимаем пробелы.
     """
+    return " ".join(normalize_tokens(text))
+
+
+def lemmatize_text(text: str) -> str:
+    """
+    Лемматизация русских слов через pymorphy3.
+    Для смешанного текста (русский+цифры) работает нормально.
+    """
+    lemmas = []
+    seen: Dict[str, str] = {}  # в описаниях слова повторяются — в общий кэш идём раз на слово
+    for token in normalize_tokens(text):
+        lemma = seen.get(token)
+        if lemma is None:
+            # если чисто цифры/проценты — оставляем как есть
+            lemma = token if _NUMERIC_TOKEN_RE.fullmatch(token) else lemmatize_token(token)
+            seen[token] = lemma
+        lemmas.append(lemma)
+    return " ".join(lemmas)
+
+
+def normalize_text_legacy(text: str) -> str:
+    """Прежняя нормализация в несколько проходов — для сверки в бенчмарке."""
     if not text:
         return ""
     text = text.lower()
@@ -67,38 +422,69 @@ def normalize_text(text: str) -> str:
     return text
 
 
-def lemmatize_text(text: str) -> str:
-    """
-    Лемматизация русских слов через pymorphy3.
-    Для смешанного текста (русский+цифры) работает нормально.
-    """
-    text = normalize_text(text)
+def lemmatize_text_legacy(text: str) -> str:
+    """Прежняя лемматизация (поверх normalize_text_legacy) — для сверки в бенчмарке."""
+    text = normalize_text_legacy(text)
     if not text:
         return ""
-
-    tokens = text.split()
     lemmas = []
-
-    for token in tokens:
-        # если чисто цифры/проценты — оставляем как есть
+    for token in text.split():
         if re.fullmatch(r"[0-9%/.\-]+", token):
             lemmas.append(token)
             continue
+        lemmas.append(lemmatize_token(token))
+    return " ".join(lemmas)
 
-        parsed = _morph.parse(token)
-        if not parsed:
-            lemmas.append(token)
-        else:
-            lemmas.append(parsed[0].normal_form)
 
-    return " ".join(lemmas)
+def lemmatize_token(token: str) -> str:
+    """Лемма одного слова: сначала кэш, pymorphy3 только при промахе."""
+    lemma = _lemma_cache.get(token)
+    if lemma is None:
+        parsed = _morph.parse(token)
+        lemma = parsed[0].normal_form if parsed else token
+        _lemma_cache.put(token, lemma)
+    return lemma
+
+
+def lemma_cache_path() -> str | None:
+    """Куда сохраняется кэш лемм; считается при вызове — шард меняет SNAPSHOT_DIR."""
+    if LEMMA_CACHE_PATH is None:
+        return None
+    return LEMMA_CACHE_PATH or os.path.join(SNAPSHOT_DIR, LEMMA_CACHE_FILE)
+
+
+def save_lemma_cache(path: str | None = None) -> None:
+    path = path or lemma_cache_path()
+    if not path:
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(dict(_lemma_cache.items()), f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def load_lemma_cache(path: str | None = None) -> int:
+    """Подгружаем сохранённый кэш лемм; возвращаем число загруженных слов."""
+    path = path or lemma_cache_path()
+    if not path or not os.path.isfile(path):
+        return 0
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("Кэш лемм %s не читается: %s", path, e)
+        return 0
+    for token, lemma in data.items():
+        _lemma_cache.put(token, lemma)
+    return len(data)
 
 
 # ==========================
 #   СБОРКА КАТЕГОРИЙ ИЗ CSV
 # ==========================
 
-def load_categories_from_csv() -> pd.DataFrame:
+def load_categories_from_csv(aggregation: str | None = None) -> pd.DataFrame:
     """
     Читаем result_itr4.csv (СТЕ) и агрегируем всё до уровня категории.
 
@@ -110,17 +496,144 @@ def load_categories_from_csv() -> pd.DataFrame:
       - производитель
       - страна_происхождения
       - spec1..spec31 (строки вида "Ключ: Значение")
+
+    aggregation: "vectorized" (по умолчанию CSV_AGGREGATION) или "rowwise" —
+    старый построчный вариант, оставлен для сравнения в бенчмарке.
+    При CSV_CHUNK_ROWS файл читается кусками (см. stream_categories_from_csv).
     """
-    df = pd.read_csv(CSV_PATH)
+    if CSV_CHUNK_ROWS and (aggregation or CSV_AGGREGATION) != "rowwise":
+        return stream_categories_from_csv(CSV_CHUNK_ROWS)
+
+    df = pd.read_csv(CSV_PATH, usecols=_is_used_column)
+    _check_required_columns(df)
+    df = own_shard_rows(df)
+
+    if (aggregation or CSV_AGGREGATION) == "rowwise":
+        return aggregate_categories_rowwise(df)
+    return aggregate_categories(df)
+
+
+def stream_categories_from_csv(chunk_rows: int) -> pd.DataFrame:
+    """
+    Потоковая агрегация: CSV читается кусками по chunk_rows строк, от каждого
+    куска остаются только первые MAX_PRODUCTS_PER_CAT СТЕ категории, которые
+    сливаются с накопленными. Пиковая память ~ число категорий x N,
+    а не число строк СТЕ; результат совпадает с чтением целиком.
+    """
+    heads = None
+    for chunk in pd.read_csv(CSV_PATH, usecols=_is_used_column, chunksize=chunk_rows):
+        _check_required_columns(chunk)
+        chunk = own_shard_rows(chunk)
+        chunk_heads = _category_heads(chunk.assign(ste_text=build_ste_texts(chunk)))
+        if heads is None:
+            heads = chunk_heads
+        else:
+            heads = _category_heads(pd.concat([heads, chunk_heads], ignore_index=True))
+
+    if heads is None:
+        return pd.DataFrame(columns=["id_категории", "название_категории", "category_desc_raw"])
+    return _finish_categories(heads)
+
+
+def own_shard_rows(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    В процессе-шарде (CATEGORY_SHARD) оставляем строки только своих категорий:
+    id_категории % всего == номер. Фильтруем до агрегации — чужие СТЕ не
+    склеиваются и не лемматизируются.
+    """
+    if CATEGORY_SHARD is None:
+        return df
+    shard, shards = CATEGORY_SHARD
+    ids = pd.to_numeric(df["id_категории"], errors="coerce").to_numpy()
+    return df[np.nan_to_num(ids, nan=-1).astype(np.int64) % shards == shard]
+
+
+_USED_COLUMNS = {"id_сте", "название_сте", "id_категории", "название_категории"}
+
+
+def _is_used_column(col: str) -> bool:
+    """Читаем из CSV только то, что идёт в описание категории."""
+    return col in _USED_COLUMNS or col.startswith("spec")
 
+
+def _check_required_columns(df: pd.DataFrame) -> None:
     # Приводим названия колонок к ожидаемым (на случай, если pandas подтянул NaN и т.п.)
     required_cols = ["id_категории", "название_категории"]
     for col in required_cols:
         if col not in df.columns:
             raise RuntimeError(f"В CSV нет обязательной колонки '{col}'")
 
+
+def _spec_columns(df: pd.DataFrame) -> List[str]:
+    return [c for c in df.columns if c.startswith("spec")]
+
+
+def build_ste_texts(df: pd.DataFrame) -> pd.Series:
+    """
+    Текст каждой СТЕ: название + непустые спец-строки через "; ".
+    Склейка по колонкам целиком (без apply по строкам): на каждом шаге
+    разделитель ставится только между двумя непустыми частями.
+    """
+    parts = []
+    if "название_сте" in df.columns:
+        # как и в построчном варианте, пропуск названия превращается в "nan"
+        parts.append(df["название_сте"].fillna("nan").astype(str).str.strip())
+    for col in _spec_columns(df):
+        parts.append(df[col].fillna("").astype(str).str.strip())
+
+    if not parts:
+        return pd.Series("", index=df.index, dtype=object)
+
+    text = parts[0].astype(object)
+    for part in parts[1:]:
+        sep = np.where((text != "") & (part != ""), "; ", "")
+        text = text + sep + part
+    return text
+
+
+def aggregate_categories(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Векторная агрегация СТЕ до категорий: groupby().head(N) вместо цикла
+    по группам и один str.join на категорию.
+    """
+    df = df.assign(ste_text=build_ste_texts(df))
+    return _finish_categories(_category_heads(df))
+
+
+def _category_heads(df: pd.DataFrame) -> pd.DataFrame:
+    """Первые MAX_PRODUCTS_PER_CAT СТЕ каждой категории (по id_сте), отсортированные."""
+    cols = [c for c in ("id_категории", "id_сте", "название_категории", "ste_text") if c in df.columns]
+    df_sorted = df[cols].sort_values(["id_категории", "id_сте"])
+    # берем первые N товаров на категорию, чтобы не раздувать описания до безумия
+    return df_sorted.groupby("id_категории").head(MAX_PRODUCTS_PER_CAT)
+
+
+def _finish_categories(head: pd.DataFrame) -> pd.DataFrame:
+    """Отсортированные головы категорий -> id, название и склеенное описание."""
+    first = head.groupby("id_категории").head(1)
+    cat_ids = first["id_категории"].astype(np.int64).to_numpy()
+    cat_names = [str(x or "").strip() for x in first["название_категории"].tolist()]
+
+    texts = head["ste_text"].str.strip()
+    head = head.assign(ste_text=texts)[texts != ""]
+    head = head[head.groupby("id_категории").cumcount() < MAX_TOTAL_SPEC_LINES]
+
+    desc = head.groupby("id_категории")["ste_text"].agg(" | ".join)
+    desc.index = desc.index.astype(np.int64)
+
+    return pd.DataFrame(
+        {
+            "id_категории": cat_ids,
+            "название_категории": cat_names,
+            "category_desc_raw": desc.reindex(cat_ids, fill_value="").tolist(),
+        }
+    )
+
+
+def aggregate_categories_rowwise(df: pd.DataFrame) -> pd.DataFrame:
+    """Исходная построчная агрегация (apply + iterrows)."""
     # Собираем текст по каждой строке СТЕ: название + спец-строки
-    spec_cols = [c for c in df.columns if c.startswith("spec")]
+    spec_cols = _spec_columns(df)
 
     def build_ste_text(row) -> str:
         parts = []
@@ -174,145 +687,1537 @@ def load_categories_from_csv() -> pd.DataFrame:
     return cat_df
 
 
-def build_index_from_csv() -> pd.DataFrame:
+# ==========================
+#   ИНДЕКС КАТЕГОРИЙ
+# ==========================
+
+_index_versions = count(1)
+
+
+@dataclass
+class CategoryIndex:
     """
-    Строим индекс: нормализованные / лемматизированные поля для поиска.
+    Всё, что нужно для поиска, в колоночном виде: id категорий (NumPy),
+    строки в TextColumn, инвертированный индекс и пакетный скорер.
+    Сырые описания нужны только для ответа, поэтому при загрузке из снимка
+    они остаются на диске и читаются лишь для top-k.
     """
-    df = load_categories_from_csv()
+    ids: np.ndarray
+    names: TextColumn
+    desc_raw: TextColumn
+    name_norm: TextColumn
+    desc_norm: TextColumn
+    ngram: NgramIndex | None = None
+    spec: SpecIndex | None = None
+    items: "ItemIndex | None" = None  # СТЕ этих категорий (ITEM_SEARCH)
+    scorer: FuzzyScorer | None = None
+    version: int = 0  # у каждого нового индекса своя версия (ключ кэша результатов)
+    snapshot: str | None = None  # ключ снимка, из которого открыт индекс
+    catalog: str | None = None  # ключ общей статистики каталога, если индекс — шард (with_catalog)
+    _layout: LayoutDetector | None = field(default=None, repr=False, compare=False)
+    _suggest: SuggestTrie | None = field(default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        if not self.version:
+            self.version = next(_index_versions)
+        if self.scorer is None:
+            self.scorer = FuzzyScorer(self.name_norm, self.desc_norm)
+
+    def catalog_stats(self) -> Dict[str, Any]:
+        """Статистика своих строк для общего словаря шардов (см. with_catalog)."""
+        return {
+            "categories": self.ngram.stats(),
+            "spec_terms": self.spec.live_terms(),
+            "items": None if self.items is None else self.items.ngram.stats(),
+        }
+
+    def with_catalog(self, catalog: Dict[str, Any]) -> "CategoryIndex | None":
+        """
+        Индекс-шард со словарями (лемм, триграмм, характеристик) и BM25 всего
+        каталога: catalog — сумма catalog_stats() всех шардов с ключом "key".
+        Раскладка, разбор характеристик, кандидаты и оценки строк тогда те же,
+        что у одного индекса; строки и постинги остаются свои. Чужие леммы и
+        термины лежат в словарях шарда с пустыми постингами.
+        None — catalog собран до правки этого шарда (своих лемм в нём нет).
+        """
+        ngram = self.ngram.with_catalog(catalog["categories"])
+        spec = self.spec.with_terms(catalog["spec_terms"])
+        items = self.items
+        if items is not None and catalog["items"] is not None:
+            item_ngram = items.ngram.with_catalog(catalog["items"])
+            items = None if item_ngram is None else replace(items, ngram=item_ngram)
+        if ngram is None or spec is None or (self.items is not None and items is None):
+            return None
+        return replace(self, ngram=ngram, spec=spec, items=items, catalog=catalog["key"], version=0, _layout=None)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "CategoryIndex":
+        """Индекс по уже лемматизированной таблице (name_norm / desc_norm)."""
+        name_norm = df["name_norm"].tolist()
+        desc_norm = df["desc_norm"].tolist()
+        desc_raw = df["category_desc_raw"].fillna("").astype(str)
+        return cls(
+            ids=df["id_категории"].to_numpy(dtype=np.int64),
+            names=TextColumn.from_strings(df["название_категории"].fillna("").astype(str)),
+            desc_raw=TextColumn.from_strings(desc_raw),
+            name_norm=TextColumn.from_strings(name_norm),
+            desc_norm=TextColumn.from_strings(desc_norm),
+            ngram=NgramIndex.build(name_norm, desc_norm),
+            spec=SpecIndex.build(desc_raw, lemmatize_token),
+        )
 
-    df["name_norm"] = df["название_категории"].fillna("").astype(str).apply(
-        lambda s: lemmatize_text(correct_keyboard_layout(s))
+    @classmethod
+    def merge(cls, parts: List[Tuple["CategoryIndex", np.ndarray]]) -> "CategoryIndex":
+        """
+        Индекс из строк нескольких индексов (new_rows — как в NgramIndex.merge):
+        колонки, постинги и характеристики сливаются массивами, тексты заново
+        не разбираются. Совпадает с from_frame по тем же строкам.
+        """
+        n_rows = sum(int((np.asarray(new_rows) >= 0).sum()) for _, new_rows in parts)
+        ids = np.empty(n_rows, dtype=np.int64)
+        for index, new_rows in parts:
+            new_rows = np.asarray(new_rows, dtype=np.int64)
+            rows = np.flatnonzero(new_rows >= 0)
+            ids[new_rows[rows]] = np.asarray(index.ids)[rows]
+        columns = {
+            name: TextColumn.merge([(getattr(index, name), new_rows) for index, new_rows in parts], n_rows)
+            for name in ("names", "desc_raw", "name_norm", "desc_norm")
+        }
+        ngram = spec = None
+        if all(index.ngram is not None for index, _ in parts):
+            ngram = NgramIndex.merge([(index.ngram, new_rows) for index, new_rows in parts], n_rows)
+        if all(index.spec is not None for index, _ in parts):
+            spec = SpecIndex.merge([(index.spec, new_rows) for index, new_rows in parts])
+        return cls(ids=ids, ngram=ngram, spec=spec, **columns)
+
+    def frame(self) -> pd.DataFrame:
+        """Таблица категорий (все строки раскодированы) — для обновлений индекса."""
+        return pd.DataFrame(
+            {
+                "id_категории": np.asarray(self.ids),
+                "название_категории": self.names.to_list(),
+                "category_desc_raw": self.desc_raw.to_list(),
+                "name_norm": self.name_norm.to_list(),
+                "desc_norm": self.desc_norm.to_list(),
+            }
+        )
+
+    def memory_usage(self) -> Dict[str, Any]:
+        """Байты по частям индекса: in_memory — в куче процесса, mapped — mmap снимка."""
+        parts = {"ids": self.ids.nbytes}
+        in_memory = 0 if isinstance(self.ids, np.memmap) else self.ids.nbytes
+        mapped = self.ids.nbytes - in_memory
+
+        for name in ("names", "desc_raw", "name_norm", "desc_norm"):
+            col: TextColumn = getattr(self, name)
+            parts[name] = col.nbytes
+            if col.on_disk:
+                mapped += col.nbytes
+            else:
+                in_memory += col.nbytes
+
+        if self.ngram is not None:
+            ngram_memory, ngram_mapped = self.ngram.memory_usage()
+            parts["ngram"] = ngram_memory + ngram_mapped
+            in_memory += ngram_memory
+            mapped += ngram_mapped
+
+        if self.items is not None:
+            items_memory, items_mapped = self.items.memory_usage()
+            parts["items"] = items_memory + items_mapped
+            in_memory += items_memory
+            mapped += items_mapped
+
+        if self.spec is not None:
+            spec_memory, spec_mapped = self.spec.memory_usage()
+            parts["spec"] = spec_memory + spec_mapped
+            in_memory += spec_memory
+            mapped += spec_mapped
+
+        if self._suggest is not None:
+            parts["suggest"] = self._suggest.nbytes
+            in_memory += self._suggest.nbytes
+
+        return {"in_memory_bytes": in_memory, "mapped_bytes": mapped, "parts": parts}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def layout(self) -> LayoutDetector | None:
+        """Детектор раскладки по словарю индекса (сервис обучает его при подмене индекса, _swap_index)."""
+        if self._layout is None and self.ngram is not None:
+            self._layout = LayoutDetector(
+                self.ngram.vocab, lemmatize_text, smoothing=LAYOUT_SMOOTHING, min_gain=LAYOUT_MIN_GAIN,
+            )
+        return self._layout
+
+    @property
+    def suggest(self) -> SuggestTrie:
+        """Префиксное дерево для /suggest (сервис строит его при подмене индекса, _warm_suggest)."""
+        if self._suggest is None:
+            self._suggest = SuggestTrie.build(self.name_norm.to_list())
+        return self._suggest
+
+
+def _init_build_worker() -> None:
+    """Каждый процесс сборки работает со своим MorphAnalyzer."""
+    global _morph
+    _morph = pymorphy3.MorphAnalyzer()
+
+
+def _lemmatize_shard(shard: Tuple[List[str], List[str]]) -> Tuple[List[str], List[str]]:
+    names, descs = shard
+    return (
+        [lemmatize_text(s) for s in names],
+        [lemmatize_text(s) for s in descs],
     )
-    df["desc_norm"] = df["category_desc_raw"].fillna("").astype(str).apply(
-        lambda s: lemmatize_text(correct_keyboard_layout(s))
+
+
+def lemmatize_categories(
+    names: List[str], descs: List[str], workers: int = 1
+) -> Tuple[List[str], List[str]]:
+    """
+    Лемматизация названий и описаний категорий.
+
+    workers > 1 — категории режутся на непрерывные шарды и обрабатываются
+    в пуле процессов; executor.map сохраняет порядок шардов, поэтому
+    результат побайтно совпадает с последовательным проходом.
+    """
+    if workers <= 1 or len(names) < 2 * workers:
+        return _lemmatize_shard((names, descs))
+
+    chunk = -(-len(names) // (workers * BUILD_SHARDS_PER_WORKER))
+    shards = [
+        (names[i:i + chunk], descs[i:i + chunk]) for i in range(0, len(names), chunk)
+    ]
+    name_norm: List[str] = []
+    desc_norm: List[str] = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_build_worker) as pool:
+        for shard_names, shard_descs in pool.map(_lemmatize_shard, shards):
+            name_norm.extend(shard_names)
+            desc_norm.extend(shard_descs)
+    return name_norm, desc_norm
+
+
+def lemmatize_frame(df: pd.DataFrame, workers: int | None = None) -> pd.DataFrame:
+    """
+    Добавляем к таблице категорий name_norm / desc_norm.
+    workers — число процессов лемматизации (по умолчанию BUILD_WORKERS).
+    """
+    if workers is None:
+        workers = BUILD_WORKERS
+    if workers == 0:
+        workers = os.cpu_count() or 1
+
+    df["name_norm"], df["desc_norm"] = lemmatize_categories(
+        df["название_категории"].fillna("").astype(str).tolist(),
+        df["category_desc_raw"].fillna("").astype(str).tolist(),
+        workers=workers,
+    )
+    return df
+
+
+def build_index_from_csv(workers: int | None = None) -> CategoryIndex:
+    """
+    Строим индекс: нормализованные / лемматизированные поля для поиска
+    и инвертированный n-граммный индекс по ним.
+    """
+    with metrics.time("smartsearch_index_build_seconds", source="csv"):
+        df = lemmatize_frame(load_categories_from_csv(), workers=workers)
+        frame_bytes = int(df.memory_usage(deep=True).sum())
+        index = CategoryIndex.from_frame(df)
+    if ITEM_SEARCH:
+        index.items = build_item_index(workers=workers)
+
+    compact_bytes = index.memory_usage()["in_memory_bytes"]
+    logger.info(
+        "Память индекса: DataFrame %.1f МБ -> колоночный %.1f МБ",
+        frame_bytes / 2**20, compact_bytes / 2**20,
     )
+    return index
+
+
+# ==========================
+#   ИНДЕКС СТЕ
+# ==========================
+
+_ITEM_COLUMNS = ["id_сте", "название_сте", "id_категории"]
+
+
+def load_items_from_csv() -> pd.DataFrame:
+    """
+    Все СТЕ без spec-колонок: id_сте, название_сте, id_категории (по id_сте).
+    При CSV_CHUNK_ROWS файл читается кусками.
+    """
+    if CSV_CHUNK_ROWS:
+        chunks = pd.read_csv(CSV_PATH, usecols=lambda c: c in _ITEM_COLUMNS, chunksize=CSV_CHUNK_ROWS)
+        df = pd.concat(list(chunks), ignore_index=True)
+    else:
+        df = pd.read_csv(CSV_PATH, usecols=lambda c: c in _ITEM_COLUMNS)
+    for col in _ITEM_COLUMNS:
+        if col not in df.columns:
+            raise RuntimeError(f"В CSV нет колонки '{col}' (нужна для ITEM_SEARCH)")
 
-    df["full_norm"] = (df["name_norm"] + " " + df["desc_norm"]).str.strip()
+    df = own_shard_rows(df.dropna(subset=["id_сте", "id_категории"]))
+    df = df.drop_duplicates("id_сте").sort_values("id_сте", kind="stable").reset_index(drop=True)
+    df["название_сте"] = df["название_сте"].fillna("").astype(str).str.strip()
+    return df
 
+
+def lemmatize_items(df: pd.DataFrame, workers: int | None = None) -> pd.DataFrame:
+    """
+    name_norm для СТЕ. Названия СТЕ сильно повторяются, поэтому
+    лемматизируем только уникальные (в тех же шардах, что и категории).
+    """
+    if workers is None:
+        workers = BUILD_WORKERS
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    unique = pd.unique(df["название_сте"]).tolist()
+    unique_norm, _ = lemmatize_categories(unique, [""] * len(unique), workers=workers)
+    df["name_norm"] = df["название_сте"].map(dict(zip(unique, unique_norm)))
     return df
 
 
+def build_item_index(workers: int | None = None, df: pd.DataFrame | None = None) -> ItemIndex:
+    with metrics.time("smartsearch_index_build_seconds", source="items"):
+        if df is None:
+            df = load_items_from_csv()
+        items = ItemIndex.from_frame(lemmatize_items(df, workers=workers))
+    logger.info("Индекс СТЕ: %d позиций", len(items))
+    return items
+
+
+# ==========================
+#   СНИМОК ИНДЕКСА НА ДИСКЕ
+# ==========================
+#
+# Формат: каталог <SNAPSHOT_DIR>/<ключ>/
+#   meta.json            — версия формата, хэш CSV, параметры сборки
+#   <колонка>.bin        — строки колонки подряд в UTF-8
+#   <колонка>.offsets.npy — смещения строк в .bin (len + 1)
+#   <массив>.npy         — массивы инвертированного индекса
+#   items_*              — индекс СТЕ (ITEM_SEARCH) в том же виде
+# Массивы и колонки открываются через mmap, без копирования в память.
+#
+# SNAPSHOT_DIR/CURRENT хранит ключ опубликованного снимка: по нему воркеры
+# подключаются к индексу на старте и подхватывают новые версии после /reload.
+
+_CURRENT_SNAPSHOT_FILE = "CURRENT"
+_LIVE_SNAPSHOT_SEP = "-live-"  # снимок CSV + изменения через /index/upsert и DELETE
+
+_SNAPSHOT_TEXT_COLUMNS = ("names", "desc_raw", "name_norm", "desc_norm")
+
+
+def csv_content_hash(csv_path: str, chunk_size: int = 1 << 20) -> str:
+    """Хэш содержимого CSV (читаем блоками, чтобы не держать файл в памяти)."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(csv_path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _snapshot_build_params() -> Dict[str, Any]:
+    """Настройки, от которых зависит содержимое индекса: их смена = новый снимок."""
+    params = {
+        "snapshot_version": SNAPSHOT_VERSION,
+        "max_products_per_cat": MAX_PRODUCTS_PER_CAT,
+        "max_total_spec_lines": MAX_TOTAL_SPEC_LINES,
+        "ngram_size": NGRAM_SIZE,
+        "bm25_k1": BM25_K1,
+        "bm25_b": BM25_B,
+        "spec_max_key_words": SPEC_MAX_KEY_WORDS,
+        "spec_max_value_words": SPEC_MAX_VALUE_WORDS,
+        "item_search": ITEM_SEARCH,
+    }
+    if CATEGORY_SHARD is not None:
+        params["category_shard"] = list(CATEGORY_SHARD)
+    return params
+
+
+def snapshot_key(csv_hash: str) -> str:
+    params = json.dumps(_snapshot_build_params(), sort_keys=True).encode("utf-8")
+    return f"v{SNAPSHOT_VERSION}-{csv_hash}-{hashlib.blake2b(params, digest_size=4).hexdigest()}"
+
+
+_NGRAM_ARRAYS = (
+    "name_indptr", "name_docs", "desc_indptr", "desc_docs",
+    "gram_indptr", "gram_tokens", "token_gram_count", "name_weights", "desc_weights",
+    "name_tf", "desc_tf", "name_lens", "desc_lens",
+)
+
+
+def _save_ngram(ngram: NgramIndex, path: str, prefix: str = "") -> None:
+    TextColumn.from_strings(ngram.vocab).save(os.path.join(path, prefix + "vocab"))
+    TextColumn.from_strings(ngram.gram_slots).save(os.path.join(path, prefix + "grams"))
+    for name in _NGRAM_ARRAYS:
+        np.save(os.path.join(path, prefix + name + ".npy"), getattr(ngram, name))
+
+
+def _load_ngram(path: str, n_docs: int, prefix: str = "") -> NgramIndex:
+    def arr(name: str) -> np.ndarray:
+        return np.load(os.path.join(path, prefix + name + ".npy"), mmap_mode="r")
+
+    vocab = TextColumn.load(os.path.join(path, prefix + "vocab"), lazy=False).to_list()
+    grams = TextColumn.load(os.path.join(path, prefix + "grams"), lazy=False).to_list()
+    return NgramIndex(
+        vocab={t: i for i, t in enumerate(vocab)},
+        name_postings=(arr("name_indptr"), arr("name_docs")),
+        desc_postings=(arr("desc_indptr"), arr("desc_docs")),
+        gram_slots={g: i for i, g in enumerate(grams)},
+        gram_postings=(arr("gram_indptr"), arr("gram_tokens")),
+        token_gram_count=arr("token_gram_count"),
+        n_docs=n_docs,
+        name_weights=arr("name_weights"),
+        desc_weights=arr("desc_weights"),
+        name_tf=arr("name_tf"),
+        desc_tf=arr("desc_tf"),
+        name_lens=arr("name_lens"),
+        desc_lens=arr("desc_lens"),
+    )
+
+
+def save_index_snapshot(index: CategoryIndex, path: str, csv_hash: str) -> None:
+    """Атомарно пишем снимок: сначала во временный каталог, потом rename."""
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    np.save(os.path.join(tmp_path, "ids.npy"), np.asarray(index.ids, dtype=np.int64))
+    for name in _SNAPSHOT_TEXT_COLUMNS:
+        getattr(index, name).save(os.path.join(tmp_path, name))
+
+    ngram = index.ngram
+    if ngram is not None:
+        _save_ngram(ngram, tmp_path)
+
+    items = index.items
+    if items is not None:
+        np.save(os.path.join(tmp_path, "items_ids.npy"), np.asarray(items.ids, dtype=np.int64))
+        np.save(os.path.join(tmp_path, "items_category_ids.npy"), np.asarray(items.category_ids, dtype=np.int64))
+        items.names.save(os.path.join(tmp_path, "items_names"))
+        items.name_norm.save(os.path.join(tmp_path, "items_name_norm"))
+        _save_ngram(items.ngram, tmp_path, prefix="items_")
+
+    spec = index.spec
+    if spec is not None:
+        TextColumn.from_strings(spec.terms).save(os.path.join(tmp_path, "spec_terms"))
+        np.save(os.path.join(tmp_path, "spec_indptr.npy"), spec.indptr)
+        np.save(os.path.join(tmp_path, "spec_docs.npy"), spec.docs)
+
+    meta = {
+        **_snapshot_build_params(),
+        "csv_hash": csv_hash,
+        "n_categories": len(index),
+        "has_ngram": ngram is not None,
+        "has_spec": spec is not None,
+        "has_items": items is not None,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    # сам снимок — только файлы; подкаталоги пишут другие модули по тому же
+    # CSV (векторы Search_semantic) — переносим их, а не теряем при пересохранении
+    if os.path.isdir(path):
+        for entry in os.scandir(path):
+            if entry.is_dir():
+                os.replace(entry.path, os.path.join(tmp_path, entry.name))
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def load_index_snapshot(path: str) -> CategoryIndex:
+    with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("snapshot_version") != SNAPSHOT_VERSION:
+        raise RuntimeError(f"Снимок {path}: версия {meta.get('snapshot_version')} != {SNAPSHOT_VERSION}")
+
+    def arr(name: str) -> np.ndarray:
+        return np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+
+    columns = {
+        name: TextColumn.load(os.path.join(path, name)) for name in _SNAPSHOT_TEXT_COLUMNS
+    }
+    ids = arr("ids")
+
+    ngram = _load_ngram(path, len(ids)) if meta.get("has_ngram") else None
+
+    items = None
+    if meta.get("has_items"):
+        item_ids = arr("items_ids")
+        items = ItemIndex(
+            ids=item_ids,
+            category_ids=arr("items_category_ids"),
+            names=TextColumn.load(os.path.join(path, "items_names")),
+            name_norm=TextColumn.load(os.path.join(path, "items_name_norm")),
+            ngram=_load_ngram(path, len(item_ids), prefix="items_"),
+        )
+
+    spec = None
+    if meta.get("has_spec"):
+        terms = TextColumn.load(os.path.join(path, "spec_terms"), lazy=False).to_list()
+        spec = SpecIndex(
+            {t: i for i, t in enumerate(terms)}, (arr("spec_indptr"), arr("spec_docs")), lemmatize_token
+        )
+    return CategoryIndex(
+        ids=ids, ngram=ngram, spec=spec, items=items,
+        snapshot=os.path.basename(os.path.normpath(path)), **columns
+    )
+
+
+def _remove_stale_snapshots(keep: Iterable[str]) -> None:
+    """
+    Удаляем старые снимки. Воркеры, которые ещё работают поверх удалённого
+    снимка, не страдают: открытые mmap живут до закрытия.
+    """
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return
+    keep = set(keep)
+    for name in os.listdir(SNAPSHOT_DIR):
+        # чужие недописанные снимки (*.tmp-<pid>), CURRENT и кэш лемм не трогаем
+        if name in keep or name in (_CURRENT_SNAPSHOT_FILE, LEMMA_CACHE_FILE) or ".tmp-" in name:
+            continue
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, name), ignore_errors=True)
+
+
+def read_current_snapshot() -> str | None:
+    """Ключ опубликованного снимка или None, если публикаций ещё не было."""
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, _CURRENT_SNAPSHOT_FILE), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def _set_current_snapshot(key: str) -> None:
+    """Атомарно переключаем CURRENT на key; снимок CSV, из которого вырос key, сохраняем."""
+    current_path = os.path.join(SNAPSHOT_DIR, _CURRENT_SNAPSHOT_FILE)
+    tmp_path = f"{current_path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(key)
+    os.replace(tmp_path, current_path)
+    _remove_stale_snapshots(keep={key, key.split(_LIVE_SNAPSHOT_SEP)[0]})
+
+
+def publish_index(
+    index: CategoryIndex, key: str | None = None, csv_hash: str | None = None
+) -> CategoryIndex:
+    """
+    Сохраняем индекс снимком, делаем его текущим (CURRENT) и открываем заново —
+    колонки уходят в mmap. По умолчанию ключ — снимок текущего CSV_PATH.
+    Если записать не вышло, возвращаем исходный индекс.
+    """
+    if csv_hash is None:
+        csv_hash = csv_content_hash(CSV_PATH)
+    key = key or snapshot_key(csv_hash)
+    path = os.path.join(SNAPSHOT_DIR, key)
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        save_index_snapshot(index, path, csv_hash)
+        _set_current_snapshot(key)
+    except OSError as e:
+        logger.error("Не удалось сохранить снимок индекса: %s", e)
+        return index
+    logger.info("Снимок индекса сохранён: %s", path)
+    return load_index_snapshot(path)
+
+
+def publish_live_index(index: CategoryIndex, base: CategoryIndex) -> CategoryIndex:
+    """
+    Публикуем индекс с изменениями из /index/upsert и DELETE, чтобы их увидели
+    все воркеры. base — индекс, к которому применялись изменения: от его
+    снимка берём ключ и хэш CSV (CSV при этом не перечитываем).
+    """
+    if base.snapshot is None:
+        return publish_index(index)
+    csv_key = base.snapshot.split(_LIVE_SNAPSHOT_SEP)[0]
+    with open(os.path.join(SNAPSHOT_DIR, base.snapshot, "meta.json"), encoding="utf-8") as f:
+        csv_hash = json.load(f)["csv_hash"]
+    key = f"{csv_key}{_LIVE_SNAPSHOT_SEP}{os.getpid()}-{index.version}"
+    return publish_index(index, key=key, csv_hash=csv_hash)
+
+
+def attach_current_snapshot(attempts: int = 3) -> CategoryIndex:
+    """
+    Открыть опубликованный снимок без сборки (воркер в режиме SHARED_SNAPSHOT).
+    Если снимок заменили между чтением CURRENT и открытием — читаем CURRENT снова.
+    """
+    error: Exception | None = None
+    for _ in range(attempts):
+        key = read_current_snapshot()
+        if key is None:
+            break
+        try:
+            with metrics.time("smartsearch_index_build_seconds", source="snapshot"):
+                return load_index_snapshot(os.path.join(SNAPSHOT_DIR, key))
+        except (OSError, ValueError, RuntimeError) as e:
+            error = e
+    raise RuntimeError(
+        f"Нет опубликованного снимка в {SNAPSHOT_DIR} ({error or 'CURRENT не найден'}); "
+        "сначала соберите индекс: python Search_service_module.py build"
+    )
+
+
+def load_or_build_index(force_rebuild: bool = False) -> CategoryIndex:
+    """
+    Индекс для сервиса: из снимка, если CSV не менялся, иначе сборка из CSV
+    с сохранением нового снимка. Индекс в обоих случаях работает поверх
+    mmap снимка, так что сырые описания в память процесса не попадают.
+    """
+    if not USE_INDEX_SNAPSHOT:
+        return build_index_from_csv()
+
+    csv_hash = csv_content_hash(CSV_PATH)
+    key = snapshot_key(csv_hash)
+    path = os.path.join(SNAPSHOT_DIR, key)
+
+    if not force_rebuild and os.path.isfile(os.path.join(path, "meta.json")):
+        try:
+            with metrics.time("smartsearch_index_build_seconds", source="snapshot"):
+                index = load_index_snapshot(path)
+            logger.info("Индекс загружен из снимка: %s", path)
+        except (OSError, ValueError, RuntimeError) as e:
+            logger.warning("Снимок %s не читается (%s), пересобираем", path, e)
+        else:
+            try:
+                _set_current_snapshot(key)
+            except OSError as e:
+                logger.error("Не удалось опубликовать снимок %s: %s", path, e)
+            return index
+
+    return publish_index(build_index_from_csv(), csv_hash=csv_hash)
+
+
+# ==========================
+#   ИНКРЕМЕНТАЛЬНЫЕ ОБНОВЛЕНИЯ
+# ==========================
+#
+# Индекс не меняется на месте: каждое обновление собирает новый
+# CategoryIndex, который потом одним присваиванием подменяет старый.
+# Перелемматизируются только изменённые категории, остальные строки
+# (с готовыми name_norm / desc_norm) переиспользуются.
+
+_RAW_CATEGORY_COLUMNS = ["id_категории", "название_категории", "category_desc_raw"]
+
+
+def apply_category_changes(
+    index: CategoryIndex,
+    changed: pd.DataFrame,
+    removed_ids: Iterable[int] = (),
+) -> CategoryIndex:
+    """
+    Новый индекс: changed (новые/изменённые категории в сыром виде,
+    колонки _RAW_CATEGORY_COLUMNS) заменяют строки с теми же id,
+    removed_ids удаляются. Строки упорядочены по id, как при сборке из CSV.
+
+    Лемматизируются и разбираются только строки changed — из них собирается
+    маленький индекс, который сливается с оставшимися строками
+    (CategoryIndex.merge). Слияние — NumPy по массивам индекса, без
+    Python-цикла по категориям, но всё же O(размер индекса): перенумеровать
+    приходится все постинги, а idf и avgdl BM25 меняются у всех. Остальное
+    при подмене (_swap_index): дерево /suggest достраивается в фоне, пул
+    поиска (SEARCH_EXECUTION="process") форкается заново, при SHARED_SNAPSHOT
+    индекс целиком пишется снимком.
+    """
+    drop_ids = np.array(sorted(set(removed_ids) | set(changed["id_категории"].tolist())), dtype=np.int64)
+    ids = np.asarray(index.ids)
+    kept = np.flatnonzero(~np.isin(ids, drop_ids))
+
+    parts = [index]
+    if not changed.empty:
+        parts.append(CategoryIndex.from_frame(
+            lemmatize_frame(changed[_RAW_CATEGORY_COLUMNS].reset_index(drop=True))
+        ))
+    all_ids = np.concatenate([ids[kept]] + [np.asarray(part.ids) for part in parts[1:]])
+    position = np.empty(len(all_ids), dtype=np.int64)
+    position[np.argsort(all_ids, kind="stable")] = np.arange(len(all_ids))
+
+    old_rows = np.full(len(index), -1, dtype=np.int64)
+    old_rows[kept] = position[:len(kept)]
+    new_rows = [old_rows] + [position[len(kept):]] * (len(parts) - 1)
+    new_index = CategoryIndex.merge(list(zip(parts, new_rows)))
+    new_index.items = index.items
+    return new_index
+
+
+def diff_categories(
+    current: pd.DataFrame, fresh: pd.DataFrame
+) -> Tuple[pd.DataFrame, List[int]]:
+    """
+    Сравниваем текущие категории со свежей агрегацией из CSV.
+    Возвращаем (новые + изменённые строки fresh, id удалённых категорий).
+    """
+    old = current[_RAW_CATEGORY_COLUMNS]
+    merged = fresh[_RAW_CATEGORY_COLUMNS].merge(
+        old, on="id_категории", how="left", suffixes=("", "_old"), indicator=True
+    )
+    is_changed = (
+        (merged["_merge"] == "left_only")
+        | (merged["название_категории"] != merged["название_категории_old"])
+        | (merged["category_desc_raw"] != merged["category_desc_raw_old"])
+    )
+    changed = fresh[_RAW_CATEGORY_COLUMNS][is_changed.to_numpy()]
+    removed = sorted(set(old["id_категории"].tolist()) - set(fresh["id_категории"].tolist()))
+    return changed, removed
+
+
+def diff_reload_index(index: CategoryIndex) -> Tuple[CategoryIndex, Dict[str, int]]:
+    """Перечитываем CSV и перелемматизируем только изменившиеся категории."""
+    fresh = load_categories_from_csv()
+    changed, removed = diff_categories(index.frame(), fresh)
+    current_ids = set(index.ids.tolist())
+    added = sum(1 for cid in changed["id_категории"].tolist() if cid not in current_ids)
+    stats = {"added": added, "updated": len(changed) - added, "removed": len(removed)}
+
+    fresh_items = None
+    if ITEM_SEARCH:
+        fresh_items = load_items_from_csv()
+        if index.items is not None and index.items.same_items(fresh_items):
+            fresh_items = None
+        stats["items_rebuilt"] = int(fresh_items is not None)
+
+    if changed.empty and not removed and fresh_items is None:
+        return index, stats
+    new_index = index
+    if not changed.empty or removed:
+        new_index = apply_category_changes(index, changed, removed)
+    if fresh_items is not None:
+        if new_index is index:
+            new_index = replace(index, version=0, snapshot=None, catalog=None, _layout=None, _suggest=None)
+        new_index.items = build_item_index(df=fresh_items)
+    return new_index, stats
+
+
 # ==========================
 #   ПОИСК
 # ==========================
 
+def _rank_rows(
+    index: CategoryIndex,
+    query_lems: List[str],
+    rows: np.ndarray | None,
+    cand_mask: np.ndarray | None,
+    top_k: int,
+    min_score: float,
+    deadline: float | None = None,
+) -> Tuple[List[List[Dict[str, Any]]], List[bool]]:
+    """
+    Скоринг и отбор top_k для пачки лемматизированных запросов.
+
+    Сначала считаются только названия (короткие строки). Итог
+    max(name, desc * w) не меньше score_name и не больше max(name, 100 * w),
+    поэтому описание (длинное и дорогое) оцениваем лишь там, где оно может
+    изменить итог и попасть в top_k: name < 100 * w и 100 * w не ниже
+    k-й лучшей оценки по названию / min_score. Для попавших в ответ строк
+    без оценки описания она досчитывается поштучно — только для вывода.
+
+    cand_mask (запросы x строки) — у каждого запроса свои кандидаты.
+
+    deadline (time.perf_counter()) — описания оцениваются порциями, начиная
+    со строк с лучшим названием. Размер порции (до DESC_SCORING_CHUNK) берётся
+    по замеренной цене строки так, чтобы порция уложилась в остаток бюджета;
+    первая порция — одна строка, если по прикидке (время названий x длина
+    описаний) она укладывается.
+    Не уложились — оставшиеся строки идут с оценкой по названию (нижняя
+    граница итога), а score_desc у них None. Строки, итогу которых описание
+    не нужно, получают score_desc как обычно. Второй элемент ответа — partial
+    по каждому запросу: у него осталась строка без нужной оценки описания.
+    """
+    desc_cap = 100.0 * DESC_SCORE_WEIGHT
+
+    t_names = time.perf_counter()
+    score_name = index.scorer.score_names(query_lems, rows)
+    t_names = time.perf_counter() - t_names
+    if cand_mask is not None:
+        score_name[~cand_mask] = -1.0
+    n_rows = score_name.shape[1]
+
+    if n_rows > top_k:
+        kth_name = np.partition(score_name, n_rows - top_k, axis=1)[:, n_rows - top_k]
+    else:
+        kth_name = np.full(len(query_lems), -np.inf)
+    threshold = np.maximum(kth_name, min_score)
+
+    need_desc = (score_name >= 0) & (score_name < desc_cap) & (desc_cap >= threshold[:, None])
+    score_desc = np.full(score_name.shape, np.nan)
+    cols = np.flatnonzero(need_desc.any(axis=0))
+    if deadline is None:
+        if len(cols):
+            desc_rows = cols if rows is None else rows[cols]
+            score_desc[:, cols] = index.scorer.score_descs(query_lems, desc_rows)
+    else:
+        # при нехватке времени без описания останутся строки с худшим названием
+        cols = cols[np.argsort(-score_name[:, cols].max(axis=0), kind="stable")]
+        # первая порция — одна строка, и та только если уложится по прикидке:
+        # цена названия на строку (растёт с длиной запроса так же) x во сколько
+        # раз описания длиннее названий; дальше порции — по замеренной цене
+        scorer = index.scorer
+        name_bytes = max(int(scorer.name_norm.offsets[-1]), 1)
+        row_cost = max(t_names / max(n_rows, 1) * int(scorer.desc_norm.offsets[-1]) / name_bytes, 1e-9)
+        measured, start = 0.0, 0
+        while start < len(cols):
+            now = time.perf_counter()
+            step = min(int((deadline - now) / (measured or row_cost)), DESC_SCORING_CHUNK if measured else 1)
+            if step < 1:
+                break
+            chunk = cols[start:start + step]
+            desc_rows = chunk if rows is None else rows[chunk]
+            score_desc[:, chunk] = index.scorer.score_descs(query_lems, desc_rows)
+            measured = max(measured, (time.perf_counter() - now) / len(chunk))
+            start += len(chunk)
+
+    skipped = need_desc & np.isnan(score_desc)
+    final = np.where(np.isnan(score_desc), score_name, combine_scores(score_name, score_desc))
+    if cand_mask is not None:
+        final[~cand_mask] = -1.0
+
+    out: List[List[Dict[str, Any]]] = []
+    for i, query_lem in enumerate(query_lems):
+        passing = np.flatnonzero(final[i] >= min_score)
+        best = passing[top_k_indices(final[i][passing], top_k)]
+        positions = best if rows is None else rows[best]
+
+        results = []
+        for j, pos in zip(best.tolist(), positions.tolist()):
+            desc = score_desc[i, j]
+            if np.isnan(desc):
+                desc = None if skipped[i, j] else index.scorer.score_desc_one(query_lem, pos)
+            results.append(
+                {
+                    "id": int(index.ids[pos]),
+                    "name": index.names[pos],
+                    "description": index.desc_raw[pos],
+                    "score": float(final[i, j]),
+                    "score_name": float(score_name[i, j]),
+                    "score_desc": None if desc is None else float(desc),
+                }
+            )
+        out.append(results)
+    return out, skipped.any(axis=1).tolist()
+
+
+def score_rows(
+    index: CategoryIndex, query_lem: str, rows: np.ndarray, min_score: float = 0.0
+) -> List[Dict[str, Any]]:
+    """
+    Fuzzy-оценка заданных строк индекса по лемматизированному запросу — та же,
+    что в smart_search, но без отбора кандидатов (строки пришли извне, например
+    из векторного поиска). Все строки с score >= min_score по убыванию score.
+    """
+    if not query_lem or len(rows) == 0:
+        return []
+    rows = np.unique(np.asarray(rows, dtype=np.int64))
+    return _rank_rows(index, [query_lem], rows, None, len(rows), min_score)[0][0]
+
+
+def _spec_search(
+    index: CategoryIndex,
+    query: str,
+    top_k: int,
+    min_score: float,
+    exhaustive: bool,
+    timer: StageTimer,
+    deadline: float | None = None,
+    strict: bool = False,
+) -> Tuple[List[Dict[str, Any]], bool, float] | None:
+    """
+    Поиск по запросу с характеристиками ("шампунь объем 500 мл"): строки
+    берём из индекса характеристик (больше всего совпавших), а текст без
+    характеристик ранжируем fuzzy только среди них. score_spec — 100 * доля
+    совпавших характеристик. Запрос из одних характеристик: строки (у всех
+    совпало одинаково много) ранжируются по score = score_spec *
+    SpecIndex.specificity — сначала категории, где у ключей запроса меньше
+    других значений, при равенстве — по id; min_score сравнивается со score_spec.
+    None — в запросе нет известных индексу характеристик или по ним ничего
+    не нашлось: тогда обычный поиск по всему запросу. Иначе (результаты,
+    partial, score_spec). Если среди строк с характеристиками ничего не
+    нашлось, тоже None, а при strict — пустые результаты (шард: откат к
+    обычному поиску решает координатор по всем шардам).
+    """
+    if index.spec is None or not query:
+        return None
+    with timer("spec"):
+        text, attrs = index.spec.parse_query(query)
+        if not attrs:
+            return None
+        rows, share = index.spec.match(attrs)
+    if not len(rows):
+        return None
+    score_spec = 100.0 * share
+    nothing = ([], False, score_spec) if strict else None
+
+    with timer("lemmatize"):
+        text_lem = lemmatize_text(text) if text else ""
+    if not text_lem:
+        if score_spec < min_score:
+            return nothing
+        # разбор характеристик идёт в счёт того же бюджета: если он съеден,
+        # строки отдаются без ранжирования (по id) с признаком partial
+        partial = deadline is not None and time.perf_counter() >= deadline
+        with timer("scoring"):
+            if partial:
+                scores = np.full(len(rows), score_spec)
+            else:
+                scores = score_spec * index.spec.specificity(attrs, rows)
+            best = np.lexsort((np.asarray(index.ids)[rows], -scores))[:top_k]
+        return ([
+            {
+                "id": int(index.ids[pos]),
+                "name": index.names[pos],
+                "description": index.desc_raw[pos],
+                "score": float(score),
+                "score_name": 0.0,
+                "score_desc": 0.0,
+                "score_spec": score_spec,
+            }
+            for pos, score in zip(rows[best].tolist(), scores[best].tolist())
+        ], partial, score_spec)
+
+    if not exhaustive and index.ngram is not None:
+        with timer("candidates"):
+            rows = index.ngram.candidates(text_lem, allowed=rows)
+        if len(rows) == 0:
+            return nothing
+    with timer("scoring"):
+        ranked, partial = _rank_rows(index, [text_lem], rows, None, top_k, min_score, deadline)
+    for r in ranked[0]:
+        r["score_spec"] = score_spec
+    return (ranked[0], partial[0], score_spec) if ranked[0] else nothing
+
+
 def smart_search(
-    cat_df: pd.DataFrame,
+    index: CategoryIndex,
     query: str,
     top_k: int = DEFAULT_TOP_K,
     min_score: float = DEFAULT_MIN_SCORE,
+    exhaustive: bool = False,
+    stats: Dict[str, Any] | None = None,
+    budget: float | None = None,
+    spec: str = "auto",
 ) -> List[Dict[str, Any]]:
     """
-    Умный поиск по DataFrame категорий:
+    Умный поиск по индексу категорий:
     - исправление раскладки
+    - характеристики из запроса — по индексу характеристик (см. _spec_search)
     - нормализация и лемматизация запроса
+    - отбор кандидатов по инвертированному индексу
+      (exhaustive=True — старый полный проход по всем категориям)
     - fuzzy по названию и описанию
+
+    stats (необязательный dict) получает "timings": секунды по стадиям
+    layout / spec / lemmatize / candidates / scoring, "partial": True, если
+    не уложились в budget (секунды) и описания оценены не у всех кандидатов,
+    и "score_spec": оценку характеристик, если ответ дан по ним (иначе 0).
+
+    spec — характеристики: "auto" — как описано выше, "strict" — если они
+    нашлись, отвечаем только по ним, даже пустым списком (шарды), "off" —
+    без индекса характеристик.
     """
-    query = (query or "").strip()
-    if not query:
+    timer = StageTimer()
+    deadline = None if budget is None else time.perf_counter() + budget
+    if stats is not None:
+        stats["timings"] = timer.timings
+        stats["partial"] = False
+        stats["score_spec"] = 0.0
+
+    with timer("layout"):
+        query = correct_keyboard_layout((query or "").strip(), index.layout)
+    found = None
+    if spec != "off":
+        found = _spec_search(index, query, top_k, min_score, exhaustive, timer, deadline, strict=spec == "strict")
+    if found is not None:
+        results, partial, score_spec = found
+        if stats is not None:
+            stats["partial"] = partial
+            stats["score_spec"] = score_spec
+        return results
+    with timer("lemmatize"):
+        query_lem = lemmatize_text(query) if query else ""
+    if not query_lem:
         return []
 
-    query_fixed = correct_keyboard_layout(query)
-    query_lem = lemmatize_text(query_fixed)
+    rows = None
+    if not exhaustive and index.ngram is not None:
+        with timer("candidates"):
+            rows = index.ngram.candidates(query_lem)
+        if len(rows) == 0:
+            return []
+
+    with timer("scoring"):
+        ranked, partial = _rank_rows(index, [query_lem], rows, None, top_k, min_score, deadline)
+    if stats is not None:
+        stats["partial"] = partial[0]
+    return ranked[0]
+
+
+def iter_smart_search_batch(
+    index: CategoryIndex,
+    queries: List[str],
+    top_k: int = DEFAULT_TOP_K,
+    min_score: float = DEFAULT_MIN_SCORE,
+    exhaustive: bool = False,
+    stats: Dict[str, Any] | None = None,
+    budget: float | None = None,
+    spec: str = "auto",
+) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    """
+    Пакетный поиск: (запрос, результаты) в порядке входного списка.
+
+    Одинаковые запросы лемматизируются и оцениваются один раз. Запросы идут
+    пачками по BATCH_CHUNK_SIZE: на пачку один вызов cdist по объединению
+    кандидатов (матрица запросы x строки), чужие кандидаты маскируются,
+    так что результат совпадает с smart_search по каждому запросу.
+    Запросы с характеристиками (редкие) ищутся по одному через _spec_search.
+
+    stats["timings"] копит время стадий по всем пачкам (как в smart_search).
+    budget (секунды) — на весь пакет: после него описания не оцениваются,
+    такие запросы попадают в stats["partial_queries"]. spec — как в
+    smart_search; stats["score_spec"] — {запрос: оценка} для ответов по
+    характеристикам.
+    """
+    timer = StageTimer()
+    deadline = None if budget is None else time.perf_counter() + budget
+    partial_queries: set = set()
+    spec_scores: Dict[str, float] = {}
+    if stats is not None:
+        stats["timings"] = timer.timings
+        stats["partial_queries"] = partial_queries
+        stats["score_spec"] = spec_scores
+
+    for start in range(0, len(queries), BATCH_CHUNK_SIZE):
+        chunk = queries[start:start + BATCH_CHUNK_SIZE]
+
+        with timer("layout"):
+            layout = index.layout
+            fixed = {q: correct_keyboard_layout((q or "").strip(), layout) for q in dict.fromkeys(chunk)}
+        by_spec = {}
+        for q, f in fixed.items():
+            found = None
+            if spec != "off":
+                found = _spec_search(index, f, top_k, min_score, exhaustive, timer, deadline, strict=spec == "strict")
+            if found is not None:
+                by_spec[q], partial, spec_scores[q] = found
+                if partial:
+                    partial_queries.add(q)
+        with timer("lemmatize"):
+            lem_by_query = {q: lemmatize_text(f) if f else "" for q, f in fixed.items() if q not in by_spec}
+        lems = [lem for lem in dict.fromkeys(lem_by_query.values()) if lem]
+        results_by_lem: Dict[str, List[Dict[str, Any]]] = {"": []}
+
+        if lems:
+            rows = None
+            mask = None
+            if not exhaustive and index.ngram is not None:
+                with timer("candidates"):
+                    per_query = [index.ngram.candidates(lem) for lem in lems]
+                    rows = np.unique(np.concatenate(per_query))
+                    mask = np.zeros((len(lems), len(rows)), dtype=bool)
+                    for i, cand in enumerate(per_query):
+                        mask[i, np.searchsorted(rows, cand)] = True
+
+            if rows is not None and len(rows) == 0:
+                results_by_lem.update((lem, []) for lem in lems)
+            else:
+                with timer("scoring"):
+                    ranked, partial = _rank_rows(index, lems, rows, mask, top_k, min_score, deadline)
+                results_by_lem.update(zip(lems, ranked))
+                partial_lems = {lem for lem, p in zip(lems, partial) if p}
+                partial_queries.update(q for q, lem in lem_by_query.items() if lem in partial_lems)
+
+        for q in chunk:
+            yield q, by_spec[q] if q in by_spec else results_by_lem[lem_by_query[q]]
+
+
+def search_items(
+    index: CategoryIndex,
+    query: str,
+    top_k: int = DEFAULT_TOP_K,
+    per_category: int = ITEMS_PER_CATEGORY,
+    min_score: float = DEFAULT_MIN_SCORE,
+    stats: Dict[str, Any] | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    Поиск конкретных СТЕ тем же конвейером, что и smart_search (раскладка,
+    лемматизация, кандидаты по NgramIndex, fuzzy по названиям), с группировкой
+    по категориям: top_k категорий по лучшей СТЕ, в каждой до per_category СТЕ.
+    СТЕ удалённых из индекса категорий пропускаются.
+    """
+    timer = StageTimer()
+    if stats is not None:
+        stats["timings"] = timer.timings
+    items = index.items
+    if items is None:
+        return []
 
+    with timer("layout"):
+        query = correct_keyboard_layout((query or "").strip(), index.layout)
+    with timer("lemmatize"):
+        query_lem = lemmatize_text(query) if query else ""
     if not query_lem:
         return []
+    with timer("candidates"):
+        rows = items.ngram.candidates(query_lem, limit=ITEM_CANDIDATES)
+    if len(rows) == 0:
+        return []
 
-    results: List[Dict[str, Any]] = []
+    with timer("scoring"):
+        scores = items.scorer.score_names([query_lem], rows)[0]
+        passing = np.flatnonzero(scores >= min_score)
+        order = passing[top_k_indices(scores[passing], len(passing))]
+        cat_ids = items.category_ids[rows[order]]
+        # категории в индексе упорядочены по id
+        cat_rows = np.minimum(np.searchsorted(index.ids, cat_ids), max(len(index) - 1, 0))
+        known = np.asarray(index.ids)[cat_rows] == cat_ids
+
+    groups: Dict[int, Dict[str, Any]] = {}
+    for j, cat_row, ok in zip(order.tolist(), cat_rows.tolist(), known.tolist()):
+        if not ok:
+            continue
+        group = groups.get(cat_row)
+        if group is None:
+            if len(groups) == top_k:
+                continue
+            group = groups[cat_row] = {
+                "id": int(index.ids[cat_row]),
+                "name": index.names[cat_row],
+                "score": float(scores[j]),
+                "items": [],
+            }
+        if len(group["items"]) < per_category:
+            pos = int(rows[j])
+            group["items"].append(
+                {"id": int(items.ids[pos]), "name": items.names[pos], "score": float(scores[j])}
+            )
+    return list(groups.values())
 
-    for _, row in cat_df.iterrows():
-        name_norm = row["name_norm"]
-        desc_norm = row["desc_norm"]
 
-        score_name = fuzz.WRatio(query_lem, name_norm) if name_norm else 0.0
-        score_desc = fuzz.WRatio(query_lem, desc_norm) if desc_norm else 0.0
+_result_cache = LRUCache(RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
 
-        final_score = max(score_name, score_desc * 0.7)
 
-        if final_score < min_score:
-            continue
+def _result_cache_key(index: CategoryIndex, query: str, top_k: int, min_score: float) -> tuple:
+    """
+    Ключ кэша результатов (/search/categories, шарды): запрос в нижнем регистре
+    со сжатыми пробелами (исправление раскладки всё равно приводит слова к
+    нижнему регистру — "Бумага A4" и "бумага a4" один запрос), top_k, min_score
+    и версия индекса — у индекса после /reload, upsert и delete она новая,
+    старые ответы не отдаются.
+    """
+    return (" ".join((query or "").lower().split()), top_k, min_score, index.version)
 
-        results.append(
-            {
-                "id": int(row["id_категории"]),
-                "name": row["название_категории"],
-                "description": row["category_desc_raw"],
-                "score": float(final_score),
-                "score_name": float(score_name),
-                "score_desc": float(score_desc),
-            }
-        )
 
-    results.sort(key=lambda x: x["score"], reverse=True)
-    return results[:top_k]
+_suggest_cache = LRUCache(SUGGEST_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+
+
+def prepare_suggest_prefix(text: str, index: CategoryIndex | None = None) -> str:
+    """
+    Префикс для дерева: законченные слова (за ними пробел) исправляем
+    и лемматизируем как запрос, последнее — недопечатанное — только
+    нормализуем: лемма от «руч» ничего не даст.
+    """
+    tokens = normalize_tokens(text)
+    if not tokens:
+        return ""
+    done, last = (tokens, "") if text[-1].isspace() else (tokens[:-1], tokens[-1])
+    layout = index.layout if index is not None else None
+    words = [lemmatize_token(layout.fix_token(t) if layout else t) for t in done]
+    return " ".join(words + [last]) if last else " ".join(words) + " "
+
+
+def suggest_categories(
+    index: CategoryIndex,
+    text: str,
+    limit: int = SUGGEST_LIMIT,
+    max_distance: int | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    Подсказки по началу названия категории с опечатками (max_distance, по
+    умолчанию — по длине префикса). Если на латинице ничего не нашлось,
+    пробуем тот же префикс в русской раскладке.
+    """
+    text = re.sub(r"\s+", " ", (text or "").lstrip())  # пробел в конце значим: слово закончено
+    key = (text, limit, max_distance, index.version)
+    results = _suggest_cache.get(key)
+    if results is not None:
+        return results
+
+    prefix = prepare_suggest_prefix(text, index)
+    variants = [prefix]
+    if _LATIN_RE.search(prefix):
+        variants.append(prefix.translate(EN_TO_RU))
+    found: List[Tuple[int, int]] = []
+    for variant in variants:
+        allowed = suggest_max_distance(variant) if max_distance is None else max_distance
+        found = index.suggest.search(variant, allowed, limit)
+        if found:
+            break
+
+    results = [
+        {"id": int(index.ids[row]), "name": index.names[row], "distance": distance}
+        for row, distance in found
+    ]
+    _suggest_cache.put(key, results)
+    return results
+
+
+def candidate_recall(
+    index: CategoryIndex,
+    queries: Iterable[str],
+    top_k: int = DEFAULT_TOP_K,
+    min_score: float = DEFAULT_MIN_SCORE,
+) -> float:
+    """
+    Доля результатов полного прохода (exhaustive), которые находит и поиск
+    через инвертированный индекс. 1.0 — индекс ничего не теряет.
+    """
+    expected = found = 0
+    for q in queries:
+        full = {r["id"] for r in smart_search(index, q, top_k, min_score, exhaustive=True)}
+        fast = {r["id"] for r in smart_search(index, q, top_k, min_score)}
+        expected += len(full)
+        found += len(full & fast)
+    return found / expected if expected else 1.0
 
 
 # ==========================
-#   FASTAPI СЕРВИС
+#   СОСТОЯНИЕ СЕРВИСА
 # ==========================
+#
+# Маршруты FastAPI — в Search_api, пул процессов и допуск запросов — в
+# Search_pool; здесь индекс процесса и операции над ним (старт, /reload,
+# upsert, delete), которые зовут и HTTP-слой, и шарды.
+
+cat_index: CategoryIndex | None = None
+sem_index = None  # Search_semantic.SemanticIndex, если SEMANTIC_SEARCH и векторы собраны
+shard_client = None  # Search_shard.ShardClient, если SEARCH_SHARDS: индекс живёт в процессах-шардах
+# Обновления индекса идут по одному; поиск лок не берёт — он работает
+# со ссылкой на индекс, взятой в начале запроса (атомарная подмена)
+_index_write_lock = threading.Lock()
+# /suggest отвечает по индексу с готовым деревом: после правки новое дерево
+# строится в фоне, до тех пор подсказки идут по предыдущему индексу
+_suggest_index: CategoryIndex | None = None
+_suggest_index_lock = threading.Lock()
+
+_snapshot_stop = threading.Event()  # останавливает _snapshot_follower при shutdown
+
+
+def _swap_index(new_index: CategoryIndex) -> None:
+    """
+    Подмена индекса: одно присваивание + сброс зависящих от него кэшей/воркеров.
+    Детектор раскладки и дерево /suggest готовятся здесь же, а не первым запросом.
+    """
+    import Search_pool
 
-app = FastAPI(title="TH3 Smart Search (CSV-based)")
+    global cat_index
+    _ = new_index.layout
+    cat_index = new_index
+    _result_cache.clear()
+    _suggest_cache.clear()
+    _warm_suggest(new_index)
+    _attach_semantic_index(new_index)
+    Search_pool.restart_search_pool()
+
+
+def _warm_suggest(index: CategoryIndex) -> None:
+    """
+    Дерево /suggest строим заранее, а не на первом нажатии клавиши.
+    SuggestTrie.build — цикл по всем названиям (~0.5 с на 20 тыс. категорий),
+    поэтому при подмене уже работающего индекса он идёт в фоновом потоке,
+    а не под _index_write_lock; при старте дерево строится сразу.
+    """
+    global _suggest_index
 
-cat_index: pd.DataFrame | None = None
+    def publish() -> None:
+        global _suggest_index
+        with _suggest_index_lock:
+            if cat_index is index:  # за время сборки индекс могли подменить ещё раз
+                _suggest_index = index
 
+    if index._suggest is not None or _suggest_index is None:
+        _ = index.suggest
+        with _suggest_index_lock:
+            _suggest_index = index
+        return
 
-class SearchResult(BaseModel):
+    def build() -> None:
+        _ = index.suggest
+        publish()
+
+    threading.Thread(target=build, name="suggest-trie", daemon=True).start()
+
+
+def _attach_semantic_index(index: CategoryIndex) -> None:
+    """
+    Векторы лежат в снимке CSV и адресуются по id категории: пока снимок тот же
+    (или индекс получен из него через upsert без публикации), оставляем уже
+    открытый семантический индекс, иначе открываем заново.
+    """
+    global sem_index
+    if not SEMANTIC_SEARCH:
+        return
+    import Search_semantic
+
+    path = Search_semantic.semantic_path(index)
+    if sem_index is not None and (path is None or getattr(sem_index, "path", None) == path):
+        return
+    sem_index = Search_semantic.load_semantic_index(index, path=path)
+    if sem_index is None:
+        logger.warning("Семантический индекс не найден (%s): mode=hybrid недоступен", path)
+    else:
+        sem_index.path = path
+        logger.info("Семантический индекс подключён: %s", sem_index.info())
+
+
+def _follow_shared_snapshot() -> None:
+    """
+    В режиме SHARED_SNAPSHOT каждый воркер uvicorn держит свой cat_index.
+    /reload и правки индекса приходят в один воркер и публикуют новый снимок,
+    остальные сверяются с CURRENT и переоткрывают его (см. _snapshot_follower).
+    """
+    key = read_current_snapshot()
+    if key is None or (cat_index is not None and cat_index.snapshot == key):
+        return
+    if not _index_write_lock.acquire(blocking=False):
+        return  # индекс как раз меняется в этом воркере — проверим в следующий раз
+    try:
+        _swap_index(attach_current_snapshot())
+        logger.info("Подключён новый снимок индекса: %s", cat_index.snapshot)
+    except RuntimeError as e:
+        logger.error("Не удалось подключить снимок %s: %s", key, e)
+    finally:
+        _index_write_lock.release()
+
+
+def _snapshot_follower(stop: threading.Event) -> None:
+    """
+    Фоновый поток воркера: раз в SNAPSHOT_POLL_SECONDS проверяет CURRENT.
+    Переподключение (словарь снимка, семантика, форк пула поиска) идёт здесь,
+    а не в обработчиках запросов — event loop и /health его не ждут;
+    запросы видят новый индекс после одного присваивания в _swap_index.
+    """
+    while not stop.wait(SNAPSHOT_POLL_SECONDS):
+        try:
+            _follow_shared_snapshot()
+        except Exception:
+            logger.exception("Ошибка при проверке опубликованного снимка")
+
+
+class CategoryUpsert(BaseModel):
     id: int
     name: str
-    description: str | None = None
-    score: float
-    score_name: float
-    score_desc: float
+    description: str = ""
 
 
-@app.on_event("startup")
 def on_startup():
-    global cat_index
-    print(f"Загрузка категорий из CSV: {CSV_PATH}")
-    cat_index = build_index_from_csv()
-    print(f"Индекс готов, категорий: {len(cat_index)}")
-
-
-@app.get("/health")
-def health():
+    import Search_pool
+
+    global cat_index, shard_client
+    if SEARCH_SHARDS:
+        import Search_shard
+
+        # индекс собирают и держат шарды (`serve --shards N`), здесь только рассылка
+        shard_client = Search_shard.ShardClient(SEARCH_SHARDS)
+        if shard_client.wait_ready():
+            logger.info("Подключено шардов: %d", SEARCH_SHARDS)
+            shard_client.sync_catalog()
+        return
+    loaded = load_lemma_cache()
+    if loaded:
+        logger.info("Кэш лемм: загружено %d слов", loaded)
+    t0 = time.perf_counter()
+    if SHARED_SNAPSHOT:
+        # сборкой занимается процесс-сборщик (`build` / `serve --workers N`)
+        cat_index = attach_current_snapshot()
+        logger.info("Воркер подключён к снимку %s", cat_index.snapshot)
+        _snapshot_stop.clear()
+        threading.Thread(
+            target=_snapshot_follower, args=(_snapshot_stop,), name="snapshot-follower", daemon=True
+        ).start()
+    else:
+        logger.info("Загрузка категорий из CSV: %s", CSV_PATH)
+        cat_index = load_or_build_index()
+    _ = cat_index.layout
+    _warm_suggest(cat_index)
+    logger.info("Индекс готов за %.2f с, категорий: %d", time.perf_counter() - t0, len(cat_index))
+    _attach_semantic_index(cat_index)
+    Search_pool.restart_search_pool()
+
+
+def on_shutdown():
+    import Search_pool
+
+    _snapshot_stop.set()
+    if shard_client is not None:
+        shard_client.close()
+        return  # лемм здесь нет — не перезаписываем кэш шардов пустым
+    Search_pool.shutdown_search_pool()
+    try:
+        save_lemma_cache()
+    except OSError as e:
+        logger.error("Не удалось сохранить кэш лемм: %s", e)
+
+
+def index_health() -> Dict[str, Any]:
+    """Состояние индекса и кэшей этого процесса (/health; у шарда — операция health)."""
+    import Search_pool
+
+    index = cat_index
     return {
         "status": "ok",
-        "categories_indexed": 0 if cat_index is None else len(cat_index),
+        "categories_indexed": 0 if index is None else len(index),
         "csv_path": CSV_PATH,
+        "index_version": None if index is None else index.version,
+        "index_memory": None if index is None else index.memory_usage(),
+        "lemma_cache": _lemma_cache.stats(),
+        "result_cache": _result_cache.stats(),
+        "index_snapshot": None if index is None else index.snapshot,
+        "worker_pid": os.getpid(),
+        "search_execution": "process" if Search_pool.search_pool is not None else "inline",
+        "semantic": None if sem_index is None else sem_index.info(),
+        "items_indexed": None if index is None or index.items is None else len(index.items),
+        "pending_searches": Search_pool.pending_searches,
     }
 
 
-@app.post("/reload")
-def reload_index():
+def reload_index(force: bool = False, incremental: bool = False, shard: int | None = None) -> Dict[str, Any]:
     """
     Пересобрать индекс (можно дергать после обновления CSV).
+    Если CSV не менялся, индекс берётся из снимка на диске.
+    incremental=true — diff с текущим индексом по id_категории.
+    С шардами каждый пересобирает свою часть; shard=i — только шард i.
     """
-    global cat_index
-    cat_index = build_index_from_csv()
+    if shard_client is not None:
+        return shard_client.reload(shard, force=force, incremental=incremental)
+    if shard is not None:
+        raise HTTPException(status_code=400, detail="Сервис запущен без шардов (SEARCH_SHARDS)")
+    with _index_write_lock:
+        if incremental and cat_index is not None and not force:
+            with metrics.time("smartsearch_index_build_seconds", source="incremental"):
+                new_index, stats = diff_reload_index(cat_index)
+                if USE_INDEX_SNAPSHOT and new_index is not cat_index:
+                    new_index = publish_index(new_index)
+            if new_index is not cat_index:
+                _swap_index(new_index)
+            return {"status": "reloaded", "categories_indexed": len(cat_index), **stats}
+
+        _swap_index(load_or_build_index(force_rebuild=force))
     return {"status": "reloaded", "categories_indexed": len(cat_index)}
 
 
-@app.get("/search/categories", response_model=List[SearchResult])
-def search_categories(
-    q: str = Query(..., min_length=1),
-    top_k: int = Query(DEFAULT_TOP_K, ge=1, le=50),
-    min_score: float = Query(DEFAULT_MIN_SCORE, ge=0.0, le=100.0),
-):
-    global cat_index
-    if cat_index is None or cat_index.empty:
-        return []
+def upsert_categories(items: List[CategoryUpsert]) -> Dict[str, Any]:
+    """
+    Добавить или заменить категории без пересборки всего индекса.
+    Изменения живут до следующего /reload из CSV.
+    С шардами категория уходит в шард id % SEARCH_SHARDS.
+    """
+    if shard_client is not None:
+        return shard_client.upsert([item.model_dump() for item in items])
+    changed = pd.DataFrame(
+        {
+            "id_категории": [item.id for item in items],
+            "название_категории": [item.name for item in items],
+            "category_desc_raw": [item.description for item in items],
+        }
+    ).drop_duplicates("id_категории", keep="last")
+
+    with _index_write_lock:
+        if cat_index is None:
+            raise HTTPException(status_code=503, detail="Индекс ещё не загружен")
+        with metrics.time("smartsearch_index_build_seconds", source="upsert"):
+            new_index = apply_category_changes(cat_index, changed)
+            if SHARED_SNAPSHOT:
+                new_index = publish_live_index(new_index, base=cat_index)
+        _swap_index(new_index)
+    return {"status": "ok", "upserted": len(changed), "categories_indexed": len(cat_index)}
+
+
+def delete_category(category_id: int) -> Dict[str, Any]:
+    if shard_client is not None:
+        return shard_client.delete(category_id)
+    with _index_write_lock:
+        if cat_index is None:
+            raise HTTPException(status_code=503, detail="Индекс ещё не загружен")
+        if not (cat_index.ids == category_id).any():
+            raise HTTPException(status_code=404, detail=f"Категория {category_id} не найдена")
+        no_changes = pd.DataFrame(columns=_RAW_CATEGORY_COLUMNS)
+        with metrics.time("smartsearch_index_build_seconds", source="delete"):
+            new_index = apply_category_changes(cat_index, no_changes, removed_ids=[category_id])
+            if SHARED_SNAPSHOT:
+                new_index = publish_live_index(new_index, base=cat_index)
+        _swap_index(new_index)
+    return {"status": "deleted", "id": category_id, "categories_indexed": len(cat_index)}
+
+
+def __getattr__(name: str):
+    """
+    Search_service_module.app — приложение из Search_api (TestClient, старые
+    команды uvicorn). Search_api сам импортирует этот модуль, поэтому
+    подгружается при первом обращении, а не при импорте.
+    """
+    if name == "app":
+        import Search_api
 
-    results = smart_search(cat_index, q, top_k=top_k, min_score=min_score)
-    return [SearchResult(**r) for r in results]
+        return Search_api.app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-if __name__ == "__main__":
+def main():
+    """
+    python Search_service_module.py build              — собрать и опубликовать снимок
+    python Search_service_module.py serve --workers 4  — сборка один раз, затем N воркеров
+    python Search_service_module.py serve --shards 4   — N процессов-шардов (Search_shard.py) + сервис
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="TH3 Smart Search")
+    parser.add_argument("command", nargs="?", choices=["serve", "build"], default="serve")
+    parser.add_argument("--workers", type=int, default=SERVICE_WORKERS)
+    parser.add_argument("--shards", type=int, default=SEARCH_SHARDS, help="0 — без шардов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+
+    shard_procs = []
+    if args.shards:
+        if args.command == "build":
+            parser.error("шарды собирают свои снимки сами: python Search_shard.py build --shard I --shards N")
+        # до импорта Search_shard: он импортирует этот модуль заново, а uvicorn берёт его же
+        os.environ["SEARCH_SHARDS"] = str(args.shards)
+        import Search_shard
+
+        # воркеры сервиса индекс не держат, так что общий снимок им не нужен;
+        # каталог сокетов и ключ шардов start_shards кладёт в окружение — воркеры его наследуют
+        shard_procs = Search_shard.start_shards(args.shards)
+    elif args.command == "build" or args.workers > 1:
+        if not USE_INDEX_SNAPSHOT:
+            parser.error("для build и нескольких воркеров нужен USE_INDEX_SNAPSHOT = True")
+        # процесс-сборщик: воркеры не лемматизируют каталог каждый сам по себе
+        load_lemma_cache()
+        index = load_or_build_index()
+        save_lemma_cache()
+        logger.info("Опубликован снимок %s, категорий: %d", index.snapshot, len(index))
+        if args.command == "build":
+            return
+        del index
+        # воркеры uvicorn стартуют через spawn и наследуют окружение
+        os.environ["SMARTSEARCH_SHARED_SNAPSHOT"] = "1"
+
     import uvicorn
 
-    uvicorn.run(
-        "search_service:app",
-        host="127.0.0.1",
-        port=8001,
-        reload=False,
-        workers=1,
-    )
\ No newline at end of file
+    try:
+        uvicorn.run(
+            "Search_api:app",
+            host=args.host,
+            port=args.port,
+            reload=False,
+            workers=args.workers,
+        )
+    finally:
+        if shard_procs:
+            Search_shard.stop_shards(shard_procs)
+
+
+if __name__ == "__main__":
+    main()
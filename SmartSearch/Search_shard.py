@@ -0,0 +1,754 @@
+#!/usr/bin/env python
+"""
+Шардирование SmartSearch: каталог категорий делится между процессами.
+
+Шард i из N держит категории с id_категории % N == i — собирает их из того же
+CSV, хранит свой снимок (SNAPSHOT_DIR/shard-i-of-N) и пересобирается сам по
+себе. Запросы принимает по Unix-сокету SHARD_SOCKET_DIR/shard-i-of-N.sock:
+одно сообщение — JSON {"op": ..., "args": {...}}, ответ — JSON
+{"ok": true, "result": ...} или {"ok": false, "status": ..., "detail": ...}.
+
+Через сокет можно пересобрать и поправить индекс, поэтому каталог сокетов
+должен принадлежать пользователю сервиса и быть закрыт для остальных (0700),
+а соединение проходит проверку общим ключом SMARTSEARCH_SHARD_AUTHKEY.
+start_shards сам выбирает каталог ($XDG_RUNTIME_DIR или новый временный) и
+ключ и передаёт их шардам и воркерам сервиса через окружение; шард,
+запущенный вручную, должен получить те же SHARD_SOCKET_DIR и ключ.
+
+Сервис с SEARCH_SHARDS=N индекс сам не держит: ShardClient рассылает запрос
+всем шардам параллельно и сливает их top-k (порядок при равных оценках — по
+id, как без шардов). Чтобы оценки строк от шардирования не зависели, шарды
+получают от координатора общую статистику каталога (ShardClient.sync_catalog):
+словари лемм, триграмм и характеристик и idf / avgdl BM25. Запрос с
+характеристиками каждый шард решает по своим строкам и сообщает score_spec —
+координатор оставляет только шарды с лучшим совпадением (merge_shard_results).
+
+Ответ совпадает с одним индексом по всему каталогу, пока кандидатов у запроса
+не больше MAX_CANDIDATES: иначе каждый шард берёт свои MAX_CANDIDATES лучших
+по тому же BM25, в сумме кандидатов больше, и в ответ могут попасть строки,
+которые один индекс отсёк бы до fuzzy-скоринга.
+
+    python Search_service_module.py serve --shards 4   # шарды + сервис
+    python Search_shard.py serve --shard 2 --shards 4  # один шард (перезапуск)
+    python Search_shard.py build --shard 2 --shards 4  # только снимок шарда
+"""
+import argparse
+import hashlib
+import heapq
+import json
+import os
+import queue
+import secrets
+import signal
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from fastapi import HTTPException
+
+import Search_pool
+import Search_service_module as svc
+
+
+# ==========================
+#   НАСТРОЙКИ
+# ==========================
+
+# Каталог сокетов: без SHARD_SOCKET_DIR — $XDG_RUNTIME_DIR/smartsearch-shards,
+# а если нет и его, start_shards создаёт временный (tempfile.mkdtemp)
+SHARD_SOCKET_DIR = os.getenv("SHARD_SOCKET_DIR") or (
+    os.path.join(os.environ["XDG_RUNTIME_DIR"], "smartsearch-shards") if os.getenv("XDG_RUNTIME_DIR") else None
+)
+# Общий ключ шардов и сервиса (hex); start_shards генерирует его, если не задан
+SHARD_AUTHKEY_ENV = "SMARTSEARCH_SHARD_AUTHKEY"
+SHARD_AUTHKEY = bytes.fromhex(os.getenv(SHARD_AUTHKEY_ENV, "")) or None
+SHARD_TIMEOUT = 30.0           # секунд на ответ шарда (к бюджету поиска прибавляется)
+SHARD_HEALTH_TIMEOUT = 1.0     # /health не должен висеть на упавшем шарде
+SHARD_START_TIMEOUT = 600.0    # сколько сервис ждёт шарды на старте (первая сборка индекса)
+SHARD_BATCH_CHUNK = 1024       # запросов пакета на одну рассылку (NDJSON отдаётся по мере готовности)
+
+logger = svc.logger
+
+
+class ShardError(RuntimeError):
+    """Шард недоступен или не ответил вовремя."""
+
+
+def shard_name(shard: int, shards: int) -> str:
+    return f"shard-{shard}-of-{shards}"
+
+
+def shard_socket_path(shard: int, shards: int, socket_dir: str | None = None) -> str:
+    socket_dir = socket_dir or SHARD_SOCKET_DIR
+    if not socket_dir:
+        raise ShardError("Не задан каталог сокетов шардов (SHARD_SOCKET_DIR)")
+    return os.path.join(socket_dir, shard_name(shard, shards) + ".sock")
+
+
+def ensure_socket_dir(path: str) -> None:
+    """
+    Создаём каталог сокетов (0700) и проверяем уже существующий: чужой или
+    открытый другим пользователям каталог позволил бы подменить сокет шарда.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise ShardError(
+            f"Каталог сокетов {path} должен быть каталогом этого пользователя с правами 0700 "
+            f"(владелец {st.st_uid}, права {stat.S_IMODE(st.st_mode):o})"
+        )
+
+
+def shard_of(category_id: int, shards: int) -> int:
+    return int(category_id) % shards
+
+
+# ==========================
+#   ПРОЦЕСС-ШАРД
+# ==========================
+
+def configure_shard(shard: int, shards: int) -> None:
+    """
+    Этот процесс — шард: загрузчики CSV оставляют только его категории,
+    снимки лежат в своём подкаталоге (CURRENT и чистка старых — свои).
+    """
+    if not 0 <= shard < shards:
+        raise ValueError(f"Номер шарда {shard} вне 0..{shards - 1}")
+    svc.CATEGORY_SHARD = (shard, shards)
+    svc.SNAPSHOT_DIR = os.path.join(svc.SNAPSHOT_DIR, shard_name(shard, shards))
+    svc.SEARCH_SHARDS = 0
+    svc.SHARED_SNAPSHOT = False
+
+
+def _search(
+    q: str,
+    top_k: int,
+    min_score: float,
+    exhaustive: bool = False,
+    mode: str = "lexical",
+    budget: float | None = None,
+    spec: str = "strict",
+) -> Dict[str, Any]:
+    """
+    Поиск в своей части индекса: кэш результатов, пул поиска и hybrid — как в сервисе.
+    Характеристики по умолчанию strict: откат к обычному поиску решает координатор.
+    """
+    index = svc.cat_index
+    key = None
+    if not exhaustive:
+        key = svc._result_cache_key(index, q, top_k, min_score) + (mode, spec)
+        cached = svc._result_cache.get(key)
+        if cached is not None:
+            results, score_spec = cached
+            return {
+                "results": results, "score_spec": score_spec, "timings": {}, "partial": False,
+                "cached": True, "catalog": index.catalog,
+            }
+
+    stats: Dict[str, Any] = {}
+    if mode == "hybrid":
+        if svc.sem_index is None:
+            raise HTTPException(status_code=400, detail="Семантический индекс не подключён (SEMANTIC_SEARCH)")
+        import Search_semantic
+
+        results = Search_semantic.hybrid_search(
+            index, svc.sem_index, q, top_k=top_k, min_score=min_score, stats=stats, budget=budget
+        )
+    elif Search_pool.search_pool is not None:
+        results, stats = Search_pool.search_pool.submit(
+            Search_pool.search_in_worker, q, top_k, min_score, exhaustive, budget, spec
+        ).result()
+    else:
+        results = svc.smart_search(
+            index, q, top_k=top_k, min_score=min_score, exhaustive=exhaustive,
+            stats=stats, budget=budget, spec=spec,
+        )
+    score_spec = stats.get("score_spec", 0.0)
+    if key is not None and not stats["partial"]:
+        svc._result_cache.put(key, (results, score_spec))
+    return {
+        "results": results, "score_spec": score_spec, "timings": stats["timings"],
+        "partial": stats["partial"], "cached": False, "catalog": index.catalog,
+    }
+
+
+def _batch(
+    queries: List[str], top_k: int, min_score: float, budget: float | None = None, spec: str = "strict"
+) -> Dict[str, Any]:
+    index = svc.cat_index
+    stats: Dict[str, Any] = {}
+    pairs = list(svc.iter_smart_search_batch(
+        index, queries, top_k=top_k, min_score=min_score, stats=stats, budget=budget, spec=spec
+    ))
+    partial = stats["partial_queries"]
+    return {
+        "results": [results for _, results in pairs],
+        "score_spec": [stats["score_spec"].get(q, 0.0) for q, _ in pairs],
+        "partial": [j for j, (q, _) in enumerate(pairs) if q in partial],
+        "timings": stats["timings"],
+        "catalog": index.catalog,
+    }
+
+
+def _items(q: str, top_k: int, per_category: int, min_score: float) -> Dict[str, Any]:
+    if svc.cat_index.items is None:
+        raise HTTPException(status_code=400, detail="Индекс СТЕ не собран (ITEM_SEARCH)")
+    index = svc.cat_index
+    stats: Dict[str, Any] = {}
+    results = svc.search_items(
+        index, q, top_k=top_k, per_category=per_category, min_score=min_score, stats=stats
+    )
+    return {"results": results, "timings": stats["timings"], "catalog": index.catalog}
+
+
+def _set_catalog(catalog: Dict[str, Any]) -> Dict[str, Any]:
+    """Общая статистика каталога от координатора (ShardClient.sync_catalog)."""
+    with svc._index_write_lock:
+        index = svc.cat_index
+        if index.catalog == catalog["key"]:
+            return {"applied": True}
+        new_index = index.with_catalog(catalog)
+        if new_index is None:
+            return {"applied": False}  # шард поправили после сбора статистики
+        svc._swap_index(new_index)
+    return {"applied": True}
+
+
+_SHARD_OPS: Dict[str, Callable[..., Any]] = {
+    "health": lambda: svc.index_health(),
+    "search": _search,
+    "batch": _batch,
+    "items": _items,
+    "catalog_stats": lambda: svc.cat_index.catalog_stats(),
+    "set_catalog": _set_catalog,
+    "suggest": lambda q, limit, max_distance=None: svc.suggest_categories(
+        svc._suggest_index, q, limit=limit, max_distance=max_distance
+    ),
+    "reload": lambda force=False, incremental=False: svc.reload_index(
+        force=force, incremental=incremental, shard=None
+    ),
+    "upsert": lambda items: svc.upsert_categories([svc.CategoryUpsert(**item) for item in items]),
+    "delete": lambda category_id: svc.delete_category(category_id),
+}
+
+
+def _handle(message: bytes) -> Dict[str, Any]:
+    try:
+        request = json.loads(message)
+        op = _SHARD_OPS.get(request.get("op"))
+        if op is None:
+            return {"ok": False, "status": 400, "detail": f"Неизвестная операция {request.get('op')!r}"}
+        return {"ok": True, "result": op(**request.get("args", {}))}
+    except HTTPException as e:
+        return {"ok": False, "status": e.status_code, "detail": e.detail}
+    except Exception as e:  # шард не должен падать из-за одного запроса
+        logger.exception("Ошибка операции шарда")
+        return {"ok": False, "status": 500, "detail": str(e)}
+
+
+def _serve_connection(conn: Connection) -> None:
+    """Соединение сервиса: запросы идут по одному, пока сервис его не закроет."""
+    with conn:
+        while True:
+            try:
+                message = conn.recv_bytes()
+            except (EOFError, OSError):
+                return
+            conn.send_bytes(json.dumps(_handle(message), ensure_ascii=False).encode("utf-8"))
+
+
+def shard_listener(path: str) -> Listener:
+    """Сокет шарда в закрытом каталоге; без общего ключа шард не слушает."""
+    if SHARD_AUTHKEY is None:
+        raise ShardError(f"Не задан ключ шардов {SHARD_AUTHKEY_ENV}")
+    ensure_socket_dir(os.path.dirname(path))
+    if os.path.exists(path):
+        os.unlink(path)  # сокет от прошлого запуска
+    return Listener(path, family="AF_UNIX", authkey=SHARD_AUTHKEY)
+
+
+def accept_connections(listener: Listener) -> None:
+    """
+    Каждое соединение — в своём потоке. Клиент без ключа (или оборвавший
+    проверку) отбрасывается, шард продолжает слушать; выходим, когда сокет закрыт.
+    """
+    while True:
+        try:
+            conn = listener.accept()
+        except (AuthenticationError, EOFError, ConnectionError) as e:
+            logger.warning("Отклонено подключение к шарду: %s", e)
+            continue
+        except OSError:
+            return
+        threading.Thread(target=_serve_connection, args=(conn,), daemon=True).start()
+
+
+def serve_shard(shard: int, shards: int, socket_dir: str | None = None) -> None:
+    """
+    Загружаем (или собираем) свою часть индекса и слушаем сокет. Сокет
+    появляется только после загрузки индекса — сервис так узнаёт, что шард готов.
+    """
+    configure_shard(shard, shards)
+    svc.on_startup()
+
+    path = shard_socket_path(shard, shards, socket_dir)
+    listener = shard_listener(path)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    logger.info("Шард %d/%d слушает %s, категорий: %d", shard, shards, path, len(svc.cat_index))
+    try:
+        accept_connections(listener)
+    finally:
+        listener.close()
+        svc.on_shutdown()
+
+
+def start_shards(shards: int, socket_dir: str | None = None) -> List[subprocess.Popen]:
+    """
+    Запускаем N процессов-шардов (каждый собирает или открывает свой снимок).
+    Каталог сокетов и ключ, если не заданы, выбираются здесь и попадают в
+    окружение этого процесса — его наследуют шарды и воркеры сервиса.
+    """
+    global SHARD_SOCKET_DIR, SHARD_AUTHKEY
+    SHARD_SOCKET_DIR = socket_dir or SHARD_SOCKET_DIR or tempfile.mkdtemp(prefix="smartsearch-shards-")
+    ensure_socket_dir(SHARD_SOCKET_DIR)
+    if SHARD_AUTHKEY is None:
+        SHARD_AUTHKEY = secrets.token_bytes(32)
+    os.environ["SHARD_SOCKET_DIR"] = SHARD_SOCKET_DIR
+    os.environ[SHARD_AUTHKEY_ENV] = SHARD_AUTHKEY.hex()
+    env = dict(os.environ)
+    env.pop("SEARCH_SHARDS", None)
+    script = os.path.abspath(__file__)
+    return [
+        subprocess.Popen(
+            [sys.executable, script, "serve", "--shard", str(i), "--shards", str(shards)], env=env
+        )
+        for i in range(shards)
+    ]
+
+
+def stop_shards(procs: List[subprocess.Popen], timeout: float = 10.0) -> None:
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        try:
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+# ==========================
+#   КООРДИНАТОР
+# ==========================
+
+def merge_top_k(lists: List[List[Dict[str, Any]]], top_k: int) -> List[Dict[str, Any]]:
+    """Слияние отсортированных top-k шардов: по убыванию score, при равенстве — по id."""
+    return list(islice(heapq.merge(*lists, key=lambda r: (-r["score"], r["id"])), top_k))
+
+
+def merge_shard_results(
+    lists: List[List[Dict[str, Any]]], spec_scores: List[float], top_k: int
+) -> List[Dict[str, Any]] | None:
+    """
+    Слияние ответов шардов на запрос (spec="strict"). Без шардов запрос с
+    характеристиками ищется среди строк с наибольшим числом совпавших по всему
+    каталогу, поэтому берём только шарды с лучшим score_spec (0 — шард ответил
+    обычным поиском). None — строки с характеристиками есть, но среди них
+    ничего не нашлось: без шардов это откат к обычному поиску (spec="off").
+    """
+    best = max(spec_scores, default=0.0)
+    results = merge_top_k([r for r, score in zip(lists, spec_scores) if score == best], top_k)
+    if best and not results:
+        return None
+    return results
+
+
+def _merge_ngram_stats(parts: List[Dict[str, Any] | None]) -> Dict[str, Any] | None:
+    parts = [p for p in parts if p is not None]
+    if not parts:
+        return None
+    tokens: Dict[str, List[int]] = {}
+    for part in parts:
+        for token, df in part["tokens"].items():
+            total = tokens.setdefault(token, [0] * len(df))
+            for i, n in enumerate(df):
+                total[i] += n
+    return {
+        "n_docs": sum(p["n_docs"] for p in parts),
+        "len_sum": {f: sum(p["len_sum"][f] for p in parts) for f in parts[0]["len_sum"]},
+        "tokens": tokens,
+    }
+
+
+def merge_catalog_stats(parts: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Статистика всего каталога из CategoryIndex.catalog_stats() шардов.
+    "key" — хэш содержимого: шард с тем же ключом уже её применил.
+    """
+    catalog = {
+        "categories": _merge_ngram_stats([p["categories"] for p in parts]),
+        "spec_terms": sorted(set().union(*(p["spec_terms"] for p in parts))),
+        "items": _merge_ngram_stats([p["items"] for p in parts]),
+    }
+    digest = json.dumps(catalog, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    catalog["key"] = hashlib.sha1(digest).hexdigest()[:16]
+    return catalog
+
+
+def _merge_timings(all_timings: List[Dict[str, float]], into: Dict[str, float] | None = None) -> Dict[str, float]:
+    """Шарды работают параллельно: время стадии — по самому медленному шарду."""
+    stage_max: Dict[str, float] = {}
+    for timings in all_timings:
+        for stage, seconds in timings.items():
+            stage_max[stage] = max(stage_max.get(stage, 0.0), seconds)
+    if into is None:
+        return stage_max
+    for stage, seconds in stage_max.items():
+        into[stage] = into.get(stage, 0.0) + seconds
+    return into
+
+
+class ShardClient:
+    """
+    Соединения с шардами и рассылка запросов. На каждый шард — очередь
+    свободных соединений (одно соединение обслуживает один запрос за раз),
+    новые открываются по необходимости, сломанные закрываются.
+    """
+
+    def __init__(self, shards: int, socket_dir: str | None = None):
+        self.shards = shards
+        self.socket_dir = socket_dir
+        self._idle: List[queue.SimpleQueue] = [queue.SimpleQueue() for _ in range(shards)]
+        self._executor = ThreadPoolExecutor(
+            max_workers=shards * svc.MAX_PENDING_SEARCHES, thread_name_prefix="shard-call"
+        )
+        self.catalog_key: str | None = None  # статистика каталога, разосланная шардам
+        self._catalog_syncs = 0
+        self._catalog_lock = threading.Lock()
+
+    def _connect(self, shard: int) -> Connection:
+        path = shard_socket_path(shard, self.shards, self.socket_dir)
+        try:
+            return Client(path, family="AF_UNIX", authkey=SHARD_AUTHKEY)
+        except (OSError, EOFError, AuthenticationError) as e:
+            raise ShardError(f"шард {shard} недоступен: {e}") from e
+
+    def _send(self, shard: int, message: bytes) -> Connection:
+        """
+        Отправка по свободному соединению. Если шард перезапускался, старые
+        соединения мертвы: запрос до шарда не дошёл — повторяем по новому.
+        """
+        while True:
+            try:
+                conn = self._idle[shard].get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.send_bytes(message)
+                return conn
+            except OSError:
+                conn.close()
+        conn = self._connect(shard)
+        try:
+            conn.send_bytes(message)
+        except OSError as e:
+            conn.close()
+            raise ShardError(f"шард {shard}: {e}") from e
+        return conn
+
+    def call(self, shard: int, op: str, timeout: float | None = SHARD_TIMEOUT, **args) -> Any:
+        """Одна операция на шарде; ошибки шарда (4xx/5xx) приходят как HTTPException."""
+        conn = self._send(shard, json.dumps({"op": op, "args": args}, ensure_ascii=False).encode("utf-8"))
+        try:
+            if not conn.poll(timeout):
+                raise TimeoutError(f"нет ответа за {timeout} с")
+            reply = json.loads(conn.recv_bytes())
+        except (OSError, EOFError, TimeoutError) as e:
+            conn.close()  # в соединении мог остаться чужой ответ — не переиспользуем
+            raise ShardError(f"шард {shard}: {e}") from e
+        self._idle[shard].put(conn)
+        if not reply["ok"]:
+            raise HTTPException(status_code=reply["status"], detail=reply["detail"])
+        return reply["result"]
+
+    def gather(
+        self, op: str, shards: List[int] | None = None, timeout: float | None = SHARD_TIMEOUT, **args
+    ) -> Tuple[Dict[int, Any], Dict[int, ShardError]]:
+        """
+        Параллельно на всех (или перечисленных) шардах. Недоступные шарды
+        возвращаются отдельно; ошибки запроса (HTTPException) пробрасываются.
+        """
+        shards = list(range(self.shards)) if shards is None else shards
+        futures = {i: self._executor.submit(self.call, i, op, timeout, **args) for i in shards}
+        replies: Dict[int, Any] = {}
+        failed: Dict[int, ShardError] = {}
+        for i, future in futures.items():
+            try:
+                replies[i] = future.result()
+            except ShardError as e:
+                failed[i] = e
+        if failed:
+            svc.metrics.inc("smartsearch_shard_errors_total", len(failed), op=op)
+            logger.error("Шарды не ответили на %s: %s", op, "; ".join(map(str, failed.values())))
+        return replies, failed
+
+    def gather_all(self, op: str, shards: List[int] | None = None, **args) -> Dict[int, Any]:
+        """Операция, которой нужны все шарды (правки индекса): недоступный шард — 503."""
+        replies, failed = self.gather(op, shards, **args)
+        if failed:
+            raise HTTPException(status_code=503, detail="; ".join(map(str, failed.values())))
+        return replies
+
+    def _gather_search(
+        self, op: str, timeout: float, check_catalog: bool = False, **args
+    ) -> Tuple[List[Any], bool]:
+        """
+        Поиск отвечает по доступным шардам (ответ partial); если не ответил ни один — 503.
+        check_catalog — ответы несут ключ статистики каталога шарда: если он не
+        тот, что разослан (шард перезапущен или поправлен), синхронизируем и повторяем.
+        """
+        seen = self._catalog_syncs
+        replies, failed = self.gather(op, timeout=timeout, **args)
+        if check_catalog and any(
+            r["catalog"] is None or r["catalog"] != self.catalog_key for r in replies.values()
+        ):
+            self.sync_catalog(seen)
+            replies, failed = self.gather(op, timeout=timeout, **args)
+        if not replies:
+            raise HTTPException(status_code=503, detail="Шарды поиска недоступны", headers={"Retry-After": "1"})
+        return [replies[i] for i in sorted(replies)], bool(failed)
+
+    def sync_catalog(self, seen: int | None = None) -> None:
+        """
+        Рассылаем шардам общую статистику каталога (CategoryIndex.with_catalog):
+        без неё каждый шард исправлял бы раскладку, разбирал характеристики и
+        взвешивал кандидатов BM25 по своей части каталога. Вызывается на старте
+        и после правок индекса; каждый шард при этом пересобирает словари и
+        веса (O(своей части + словаря каталога)) и перезапускает пул поиска.
+        seen — номер синхронизации, при которой заметили расхождение: если с тех
+        пор синхронизация уже прошла, повторно не запускаем.
+        """
+        with self._catalog_lock:
+            if seen is not None and seen != self._catalog_syncs:
+                return
+            parts, _ = self.gather("catalog_stats")
+            if not parts:
+                return
+            catalog = merge_catalog_stats([parts[i] for i in sorted(parts)])
+            applied, _ = self.gather("set_catalog", list(parts), catalog=catalog)
+            self.catalog_key = catalog["key"]
+            self._catalog_syncs += 1
+        stale = sorted(i for i, r in applied.items() if not r["applied"])
+        if stale:
+            logger.warning("Шарды %s изменились во время рассылки статистики каталога", stale)
+
+    def wait_ready(self, timeout: float = SHARD_START_TIMEOUT) -> bool:
+        """Ждём, пока все шарды откроют сокеты (то есть загрузят индекс)."""
+        deadline = time.monotonic() + timeout
+        pending = set(range(self.shards))
+        while pending:
+            for i in sorted(pending):
+                try:
+                    self._idle[i].put(self._connect(i))
+                    pending.discard(i)
+                except ShardError:
+                    pass
+            if pending and time.monotonic() >= deadline:
+                logger.error("Не дождались шардов %s за %.0f с", sorted(pending), timeout)
+                return False
+            if pending:
+                time.sleep(0.2)
+        return True
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for idle in self._idle:
+            while True:
+                try:
+                    idle.get_nowait().close()
+                except queue.Empty:
+                    break
+
+    # ---------- операции сервиса ----------
+
+    def search(
+        self,
+        q: str,
+        top_k: int,
+        min_score: float,
+        exhaustive: bool = False,
+        mode: str = "lexical",
+        budget: float | None = None,
+    ) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """Результаты + stats как у smart_search; stats["cached"] — все шарды ответили из кэша."""
+        args = dict(q=q, top_k=top_k, min_score=min_score, exhaustive=exhaustive, mode=mode, budget=budget)
+        replies, degraded = self._gather_search("search", SHARD_TIMEOUT + (budget or 0.0), check_catalog=True, **args)
+        timings = _merge_timings([r["timings"] for r in replies])
+        results = merge_shard_results([r["results"] for r in replies], [r["score_spec"] for r in replies], top_k)
+        if results is None:
+            fallback, fallback_degraded = self._gather_search(
+                "search", SHARD_TIMEOUT + (budget or 0.0), spec="off", **args
+            )
+            _merge_timings([r["timings"] for r in fallback], into=timings)
+            results = merge_top_k([r["results"] for r in fallback], top_k)
+            replies, degraded = replies + fallback, degraded or fallback_degraded
+        stats = {
+            "timings": timings,
+            "partial": degraded or any(r["partial"] for r in replies),
+            "cached": all(r["cached"] for r in replies),
+        }
+        return results, stats
+
+    def iter_batch(
+        self,
+        queries: List[str],
+        top_k: int,
+        min_score: float,
+        stats: Dict[str, Any] | None = None,
+        budget: float | None = None,
+    ) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+        """Как iter_smart_search_batch: пакет рассылается кусками по SHARD_BATCH_CHUNK."""
+        deadline = None if budget is None else time.perf_counter() + budget
+        timings: Dict[str, float] = {}
+        partial_queries: set = set()
+        if stats is not None:
+            stats["timings"] = timings
+            stats["partial_queries"] = partial_queries
+
+        for start in range(0, len(queries), SHARD_BATCH_CHUNK):
+            chunk = queries[start:start + SHARD_BATCH_CHUNK]
+            remaining = None if deadline is None else max(deadline - time.perf_counter(), 0.0)
+            timeout = None if remaining is None else SHARD_TIMEOUT + remaining
+            replies, degraded = self._gather_search(
+                "batch", timeout, check_catalog=True,
+                queries=chunk, top_k=top_k, min_score=min_score, budget=remaining,
+            )
+            _merge_timings([r["timings"] for r in replies], into=timings)
+            partial = {j for r in replies for j in r["partial"]}
+            merged = [
+                merge_shard_results([r["results"][j] for r in replies], [r["score_spec"][j] for r in replies], top_k)
+                for j in range(len(chunk))
+            ]
+            retry = [j for j, results in enumerate(merged) if results is None]
+            if retry:
+                # характеристики нашлись, а fuzzy среди них ничего не оставил — обычный поиск
+                fallback, fallback_degraded = self._gather_search(
+                    "batch", timeout, queries=[chunk[j] for j in retry],
+                    top_k=top_k, min_score=min_score, budget=remaining, spec="off",
+                )
+                _merge_timings([r["timings"] for r in fallback], into=timings)
+                for i, j in enumerate(retry):
+                    merged[j] = merge_top_k([r["results"][i] for r in fallback], top_k)
+                    if fallback_degraded or any(i in r["partial"] for r in fallback):
+                        partial.add(j)
+            for j, q in enumerate(chunk):
+                if degraded or j in partial:
+                    partial_queries.add(q)
+                yield q, merged[j]
+
+    def search_items(
+        self, q: str, top_k: int, per_category: int, min_score: float
+    ) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """СТЕ лежат в шарде своей категории, так что группы шардов не пересекаются."""
+        replies, degraded = self._gather_search(
+            "items", SHARD_TIMEOUT, check_catalog=True,
+            q=q, top_k=top_k, per_category=per_category, min_score=min_score,
+        )
+        groups = merge_top_k([r["results"] for r in replies], top_k)
+        return groups, {"timings": _merge_timings([r["timings"] for r in replies]), "partial": degraded}
+
+    def suggest(self, q: str, limit: int, max_distance: int | None = None) -> List[Dict[str, Any]]:
+        """
+        По числу опечаток; при равном — шарды по очереди, каждый в своём
+        порядке (ранг подсказки внутри шарда считается по его дереву).
+        """
+        replies, _ = self._gather_search("suggest", SHARD_TIMEOUT, q=q, limit=limit, max_distance=max_distance)
+        ranked = sorted(
+            ((pos, r) for found in replies for pos, r in enumerate(found)),
+            key=lambda p: (p[1]["distance"], p[0], p[1]["id"]),
+        )
+        return [r for _, r in ranked[:limit]]
+
+    def reload(self, shard: int | None = None, force: bool = False, incremental: bool = False) -> Dict[str, Any]:
+        """Шарды пересобираются параллельно, каждый по своей части CSV; shard — только один."""
+        if shard is not None and not 0 <= shard < self.shards:
+            raise HTTPException(status_code=400, detail=f"Нет шарда {shard} (всего {self.shards})")
+        replies = self.gather_all(
+            "reload", None if shard is None else [shard], timeout=None, force=force, incremental=incremental
+        )
+        self.sync_catalog()
+        return {
+            "status": "reloaded",
+            "categories_indexed": sum(r["categories_indexed"] for r in replies.values()),
+            "shards": {str(i): replies[i] for i in sorted(replies)},
+        }
+
+    def upsert(self, items: List[Dict[str, Any]]) -> Dict[str, Any]:
+        by_shard: Dict[int, List[Dict[str, Any]]] = {}
+        for item in items:
+            by_shard.setdefault(shard_of(item["id"], self.shards), []).append(item)
+        replies = {}
+        for i, shard_items in sorted(by_shard.items()):
+            replies[i] = self.call_or_503(i, "upsert", timeout=None, items=shard_items)
+        self.sync_catalog()
+        return {
+            "status": "ok",
+            "upserted": sum(r["upserted"] for r in replies.values()),
+            "shards": {str(i): replies[i] for i in sorted(replies)},
+        }
+
+    def delete(self, category_id: int) -> Dict[str, Any]:
+        shard = shard_of(category_id, self.shards)
+        reply = self.call_or_503(shard, "delete", timeout=None, category_id=category_id)
+        self.sync_catalog()
+        return {**reply, "shard": shard}
+
+    def call_or_503(self, shard: int, op: str, timeout: float | None = SHARD_TIMEOUT, **args) -> Any:
+        try:
+            return self.call(shard, op, timeout, **args)
+        except ShardError as e:
+            svc.metrics.inc("smartsearch_shard_errors_total", op=op)
+            raise HTTPException(status_code=503, detail=str(e)) from e
+
+    def health(self) -> Dict[str, Any]:
+        replies, failed = self.gather("health", timeout=SHARD_HEALTH_TIMEOUT)
+        shards = {str(i): replies[i] for i in sorted(replies)}
+        shards.update({str(i): {"status": "down", "error": str(e)} for i, e in failed.items()})
+        return {
+            "status": "degraded" if failed else "ok",
+            "categories_indexed": sum(r["categories_indexed"] for r in replies.values()),
+            "shards": dict(sorted(shards.items(), key=lambda kv: int(kv[0]))),
+        }
+
+
+# ==========================
+#   CLI
+# ==========================
+
+def main():
+    parser = argparse.ArgumentParser(description="Процесс-шард SmartSearch")
+    parser.add_argument("command", choices=["serve", "build"])
+    parser.add_argument("--shard", type=int, required=True)
+    parser.add_argument("--shards", type=int, required=True)
+    parser.add_argument("--socket-dir", default=SHARD_SOCKET_DIR)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        configure_shard(args.shard, args.shards)
+        svc.load_lemma_cache()
+        index = svc.load_or_build_index()
+        svc.save_lemma_cache()
+        logger.info("Шард %d/%d: снимок %s, категорий: %d", args.shard, args.shards, index.snapshot, len(index))
+        return
+    serve_shard(args.shard, args.shards, args.socket_dir)
+
+
+if __name__ == "__main__":
+    main()
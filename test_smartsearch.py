@@ -0,0 +1,862 @@
+import dataclasses
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("pymorphy3")
+pytest.importorskip("rapidfuzz")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "SmartSearch"))
+
+import Search_api  # noqa: E402
+import Search_benchmark  # noqa: E402
+import Search_semantic  # noqa: E402
+import Search_service  # noqa: E402
+import Search_service_module as svc  # noqa: E402
+import Search_shard  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def catalog(tmp_path_factory):
+    path = tmp_path_factory.mktemp("catalog") / "result_itr4.csv"
+    Search_benchmark.make_synthetic_csv(str(path), 150, products_per_category=8)
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def index(catalog):
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(svc, "CSV_PATH", catalog)
+        mp.setattr(svc, "LEMMA_CACHE_PATH", None)
+        yield svc.build_index_from_csv()
+
+
+@pytest.fixture
+def service(catalog, tmp_path, monkeypatch):
+    monkeypatch.setattr(svc, "CSV_PATH", catalog)
+    monkeypatch.setattr(svc, "SNAPSHOT_DIR", str(tmp_path / "snapshots"))
+    monkeypatch.setattr(svc, "LEMMA_CACHE_PATH", None)
+    monkeypatch.setattr(svc, "USE_INDEX_SNAPSHOT", True)
+    monkeypatch.setattr(svc, "SEARCH_EXECUTION", "inline")
+    monkeypatch.setattr(svc, "cat_index", None)
+    monkeypatch.setattr(svc, "_suggest_index", None)
+    return svc
+
+
+@pytest.fixture
+def api(service):
+    from fastapi.testclient import TestClient
+
+    with TestClient(service.app) as client:
+        yield client
+
+
+def assert_same_index(a, b):
+    """Индексы совпадают по содержимому: колонки, постинги, веса BM25, характеристики."""
+    assert np.array_equal(a.ids, b.ids)
+    for name in svc._SNAPSHOT_TEXT_COLUMNS:
+        assert getattr(a, name).to_list() == getattr(b, name).to_list(), name
+    assert list(a.ngram.vocab) == list(b.ngram.vocab)
+    assert list(a.ngram.gram_slots) == list(b.ngram.gram_slots)
+    for name in svc._NGRAM_ARRAYS:
+        assert np.array_equal(getattr(a.ngram, name), getattr(b.ngram, name)), name
+    assert list(a.spec.terms) == list(b.spec.terms)
+    assert np.array_equal(a.spec.indptr, b.spec.indptr)
+    assert np.array_equal(a.spec.docs, b.spec.docs)
+
+
+class HashEmbedder:
+    """Детерминированные векторы вместо модели: тесту важны файлы, а не смысл."""
+
+    def encode(self, texts):
+        rnd = np.random.default_rng(len(texts))
+        vectors = rnd.standard_normal((len(texts), 8)).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_forced_reload_keeps_semantic_index(service):
+    service.reload_index(force=False, incremental=False, shard=None)
+    path = Search_semantic.semantic_path(service.cat_index)
+    Search_semantic.build_semantic_index(service.cat_index, path, embedder=HashEmbedder(), backend="numpy")
+
+    service.reload_index(force=True, incremental=False, shard=None)
+
+    assert Search_semantic.semantic_path(service.cat_index) == path
+    assert Search_semantic.load_semantic_index(service.cat_index, embedder=HashEmbedder()) is not None
+
+
+def test_score_rows_matches_exhaustive_search(index):
+    query = "ручка шариковая"
+    full = svc.smart_search(index, query, top_k=len(index), min_score=0.0, exhaustive=True)
+    scored = svc.score_rows(index, svc.lemmatize_text(query), np.arange(len(index))[::-1])
+    assert [(r["id"], r["score"]) for r in scored] == [(r["id"], r["score"]) for r in full]
+
+
+def test_budget_marks_only_affected_queries_partial(index):
+    queries = ["бумага", "нитрил картон"]
+    stats = {}
+    got = dict(svc.iter_smart_search_batch(index, queries, top_k=3, min_score=0.0, stats=stats, budget=1e-9))
+
+    # у "бумага" top-3 решают названия — описания для итога не нужны
+    assert stats["partial_queries"] == {"нитрил картон"}
+    assert got["бумага"] == svc.smart_search(index, "бумага", top_k=3, min_score=0.0)
+    assert all(r["score_desc"] is None for r in got["нитрил картон"])
+
+
+class SlowNameScorer:
+    """Оценка названий с задержкой: прикидка цены описания выходит больше остатка бюджета."""
+
+    def __init__(self, scorer):
+        self.scorer = scorer
+        self.desc_calls = 0
+
+    def __getattr__(self, name):
+        return getattr(self.scorer, name)
+
+    def score_names(self, queries, rows=None):
+        time.sleep(0.01)
+        return self.scorer.score_names(queries, rows)
+
+    def score_descs(self, queries, rows):
+        self.desc_calls += 1
+        return self.scorer.score_descs(queries, rows)
+
+
+def test_budget_skips_first_description_chunk_that_cannot_fit(index):
+    query_lem = svc.lemmatize_text("нитрил картон")
+    rows = index.ngram.candidates(query_lem)[:3]
+    scorer = SlowNameScorer(index.scorer)
+    slow = dataclasses.replace(index, scorer=scorer)
+    ranked, partial = svc._rank_rows(slow, [query_lem], rows, None, 3, 0.0, time.perf_counter() + 0.05)
+    assert scorer.desc_calls == 0 and partial == [True]
+    assert all(r["score_desc"] is None for r in ranked[0])
+
+
+def test_budget_covers_attribute_stage(index):
+    stats = {}
+    results = svc.smart_search(index, "цвет синий", top_k=20, min_score=0.0, stats=stats, budget=1e-9)
+    assert stats["partial"] and stats["score_spec"] == 100.0
+    assert [r["id"] for r in results] == sorted(r["id"] for r in results)
+
+
+def test_api_caps_query_length_and_budget(api, monkeypatch):
+    long_query = "бумага " * (svc.MAX_QUERY_CHARS // 7 + 1)
+    assert api.get("/search/categories", params={"q": long_query}).status_code == 422
+    assert api.get("/search/items", params={"q": long_query}).status_code == 422
+    assert api.post("/search/categories/batch", json={"queries": ["бумага", long_query]}).status_code == 422
+
+    budgets = []
+    search = svc.smart_search
+    monkeypatch.setattr(svc, "smart_search", lambda *a, **kw: budgets.append(kw["budget"]) or search(*a, **kw))
+    assert api.get("/search/categories", params={"q": "бумага"}).status_code == 200
+    assert 0 < budgets[0] <= svc.SEARCH_TIME_BUDGET_MS / 1000
+    assert svc.BATCH_TIME_BUDGET_MS is not None
+    assert Search_api.BatchSearchRequest(queries=["бумага"]).budget_ms == svc.BATCH_TIME_BUDGET_MS
+
+
+@pytest.fixture(scope="module")
+def queries(index):
+    return [q for _, q in Search_benchmark.make_query_mix(index.names.to_list(), 200)]
+
+
+def reference_bm25(texts, terms):
+    """BM25 одного поля по определению, без индекса."""
+    lens = [len(text.split()) for text in texts]
+    avgdl = sum(lens) / len(texts)
+    scores = [0.0] * len(texts)
+    for term in terms:
+        df = sum(term in text.split() for text in texts)
+        if not df:
+            continue
+        idf = math.log(1 + (len(texts) - df + 0.5) / (df + 0.5))
+        for i, text in enumerate(texts):
+            tf = text.split().count(term)
+            norm = svc.BM25_K1 * (1 - svc.BM25_B + svc.BM25_B * lens[i] / avgdl)
+            scores[i] += idf * tf * (svc.BM25_K1 + 1) / (tf + norm)
+    return np.asarray(scores)
+
+
+def test_bm25_matches_definition_and_orders_hand_built_corpus():
+    names = ["клей канцелярский", "клей", "ручка", "ручка гелевый", "бумага"]
+    descs = ["", "", "клей", "клей клей", "клей бумага офисный офисный офисный офисный"]
+    ngram = svc.NgramIndex.build(names, descs)
+
+    for query in ("клей", "офисный клей", "ручка бумага"):
+        terms = query.split()
+        expected = svc.NAME_HIT_WEIGHT * reference_bm25(names, terms) + reference_bm25(descs, terms)
+        assert np.allclose(ngram.bm25_scores(query), expected, rtol=1e-5), query
+
+    # название важнее описания, короткое поле важнее длинного, tf растёт с насыщением
+    scores = ngram.bm25_scores("клей")
+    assert np.argsort(-scores, kind="stable").tolist() == [1, 0, 3, 2, 4]
+    assert ngram.candidates("клей", limit=2, ranking="bm25").tolist() == [0, 1]
+    assert ngram.bm25_scores("степлер") is None
+
+
+def test_candidate_index_keeps_strong_matches(index, queries):
+    # слабые совпадения WRatio без общих с запросом лемм и триграмм
+    # ("ручка" -> "Перчатки", 61.5) индекс отсекает намеренно
+    assert svc.candidate_recall(index, queries, min_score=85.0) == 1.0
+    assert svc.candidate_recall(index, queries) > 0.85
+
+
+def brute_force(index, query_lem, rows, top_k, min_score):
+    """Все строки полным cdist по названию и описанию, сортировка целиком."""
+    score_name, score_desc = index.scorer.score([query_lem], rows)
+    final = svc.combine_scores(score_name, score_desc)[0]
+    order = np.lexsort((np.arange(len(final)), -final))
+    positions = np.arange(len(index)) if rows is None else rows
+    return [(int(index.ids[positions[j]]), final[j]) for j in order if final[j] >= min_score][:top_k]
+
+
+# бренды и слова из описаний: итог решает описание, а не название
+DESC_QUERIES = ["erich krause", "brauberg пищевой", "нитрил картон", "lenovo перчатки", "hp стул"]
+
+
+@pytest.mark.parametrize("top_k, min_score", [(10, 40.0), (3, 0.0), (50, 60.0)])
+def test_pruned_top_k_equals_brute_force(index, queries, top_k, min_score):
+    for q in queries[:40] + DESC_QUERIES:
+        fixed = svc.correct_keyboard_layout(q.strip(), index.layout)
+        if index.spec.parse_query(fixed)[1]:
+            continue  # запросы с характеристиками идут через индекс характеристик
+        query_lem = svc.lemmatize_text(fixed)
+        full = svc.smart_search(index, q, top_k, min_score, exhaustive=True)
+        assert [(r["id"], r["score"]) for r in full] == brute_force(index, query_lem, None, top_k, min_score)
+
+        rows = index.ngram.candidates(query_lem)
+        fast = svc.smart_search(index, q, top_k, min_score)
+        assert [(r["id"], r["score"]) for r in fast] == brute_force(index, query_lem, rows, top_k, min_score)
+
+
+LAYOUT_CASES = [("ghbynth hp", "принтер hp"), (",evfuf", "бумага")] + [
+    (brand, brand) for brand in ("hp", "lenovo", "bic", "samsung")
+]
+
+
+@pytest.mark.parametrize("query, expected", LAYOUT_CASES)
+def test_layout_fixes_words_and_keeps_brands(index, query, expected):
+    assert svc.correct_keyboard_layout(query, index.layout) == expected
+
+
+@pytest.fixture(scope="module")
+def cli_catalog(catalog):
+    return Search_service.build_index(catalog)
+
+
+@pytest.mark.parametrize("query, expected", LAYOUT_CASES)
+def test_cli_layout_uses_own_lemmatizer(cli_catalog, query, expected):
+    # в каталоге консольного поиска только характеристики — латиницы в словаре нет
+    assert Search_service.build_layout(cli_catalog).fix(query) == expected
+
+
+def test_cli_search_builds_scorer_and_layout_by_default(cli_catalog):
+    scorer = Search_service.FuzzyScorer(cli_catalog)
+    layout = Search_service.build_layout(cli_catalog)
+    got = Search_service.smart_search(cli_catalog, "ghbynth hp", top_k=5)
+    assert got == Search_service.smart_search(cli_catalog, "ghbynth hp", top_k=5, scorer=scorer, layout=layout)
+    assert got and got[0]["название_категории"].lower().startswith("принтер")
+
+
+def test_cdist_scoring_matches_rowwise_wratio(index):
+    from rapidfuzz import fuzz
+
+    query_lems = [svc.lemmatize_text(q) for q in ("бумага офисная", "erich krause", "кабел")]
+    rows = np.arange(0, len(index), 7)
+    score_name, score_desc = index.scorer.score(query_lems, rows)
+    for i, lem in enumerate(query_lems):
+        assert score_name[i].tolist() == [fuzz.WRatio(lem, index.name_norm[r]) for r in rows]
+        assert score_desc[i].tolist() == [fuzz.WRatio(lem, index.desc_norm[r]) for r in rows]
+
+
+def test_batch_matches_single_queries(index, queries):
+    batch = list(svc.iter_smart_search_batch(index, queries, top_k=5, min_score=30.0))
+    assert [q for q, _ in batch] == queries
+    for q, results in batch:
+        assert results == svc.smart_search(index, q, top_k=5, min_score=30.0), q
+
+
+def test_parallel_build_matches_serial(index, catalog, monkeypatch):
+    monkeypatch.setattr(svc, "CSV_PATH", catalog)
+    monkeypatch.setattr(svc, "LEMMA_CACHE_PATH", None)
+    svc._lemma_cache.clear()  # иначе процессы сборки получат готовые леммы форком
+    assert_same_index(svc.build_index_from_csv(workers=2), index)
+
+
+@pytest.mark.parametrize("max_products, max_spec_lines", [(50, 200), (3, 10)])
+def test_vectorized_aggregation_matches_rowwise(catalog, monkeypatch, max_products, max_spec_lines):
+    monkeypatch.setattr(svc, "CSV_PATH", catalog)
+    monkeypatch.setattr(svc, "MAX_PRODUCTS_PER_CAT", max_products)
+    monkeypatch.setattr(svc, "MAX_TOTAL_SPEC_LINES", max_spec_lines)
+    pd.testing.assert_frame_equal(
+        svc.load_categories_from_csv("vectorized"), svc.load_categories_from_csv("rowwise")
+    )
+
+
+@pytest.mark.parametrize("chunk_rows", [29, 100, 5000])
+def test_streaming_aggregation_matches_full_read(catalog, monkeypatch, chunk_rows):
+    monkeypatch.setattr(svc, "CSV_PATH", catalog)
+    monkeypatch.setattr(svc, "MAX_PRODUCTS_PER_CAT", 3)
+    expected = svc.load_categories_from_csv()
+    monkeypatch.setattr(svc, "CSV_CHUNK_ROWS", chunk_rows)
+    pd.testing.assert_frame_equal(svc.load_categories_from_csv(), expected)
+
+
+def test_single_pass_tokenizer_matches_legacy(index):
+    texts = Search_benchmark._noisy_texts(500) + index.names.to_list() + index.desc_raw.to_list()[:30]
+    texts += ["", "   ", "Ёлка ЁЖИК", "10% 1/2 3.5-4", "a\tb\nc", "___", "-5.5%"]
+    for text in texts:
+        assert svc.normalize_text(text) == svc.normalize_text_legacy(text), repr(text)
+        assert svc.lemmatize_text(text) == svc.lemmatize_text_legacy(text), repr(text)
+
+
+def test_snapshot_round_trip_matches_fresh_build(service, tmp_path, monkeypatch):
+    monkeypatch.setattr(svc, "ITEM_SEARCH", True)
+    fresh = svc.build_index_from_csv()
+    published = svc.load_or_build_index()
+    assert published.snapshot == svc.read_current_snapshot()
+    assert_same_index(published, fresh)
+    assert np.array_equal(published.items.ids, fresh.items.ids)
+    assert np.array_equal(published.items.category_ids, fresh.items.category_ids)
+    assert published.items.names.to_list() == fresh.items.names.to_list()
+    for name in svc._NGRAM_ARRAYS:
+        assert np.array_equal(getattr(published.items.ngram, name), getattr(fresh.items.ngram, name)), name
+    for q in ("ручка шариковая", "бумага а4", "клей объем 500 мл цвет синий", "ghjdjl"):
+        assert svc.smart_search(published, q, top_k=10) == svc.smart_search(fresh, q, top_k=10), q
+        assert svc.search_items(published, q, 5, 3, 30.0) == svc.search_items(fresh, q, 5, 3, 30.0), q
+
+    # другой CSV — другой ключ снимка, старый снимок убран
+    changed = tmp_path / "changed.csv"
+    Search_benchmark.make_synthetic_csv(str(changed), 40, products_per_category=2)
+    monkeypatch.setattr(svc, "CSV_PATH", str(changed))
+    rebuilt = svc.load_or_build_index()
+    assert rebuilt.snapshot != published.snapshot and len(rebuilt) == 40
+    assert not os.path.exists(os.path.join(svc.SNAPSHOT_DIR, published.snapshot))
+
+    # CSV не менялся — старт только открывает снимок
+    monkeypatch.setattr(svc, "build_index_from_csv", lambda *a, **kw: pytest.fail("пересборка при том же CSV"))
+    reopened = svc.load_or_build_index()
+    assert reopened.snapshot == rebuilt.snapshot
+    assert_same_index(reopened, rebuilt)
+
+
+def test_incremental_update_matches_full_rebuild(index, tmp_path):
+    frame = index.frame()[svc._RAW_CATEGORY_COLUMNS]
+    ids = frame["id_категории"]
+    changed = frame.iloc[[3, 40, 77]].copy()
+    changed["название_категории"] = ["Кабель оптический", "Ручка гелевая синяя", "Бумага крафт"]
+    changed["category_desc_raw"] += " объем: 500 мл; цвет: синий"
+    added = pd.DataFrame({
+        "id_категории": [int(ids.min()) - 1, int(ids.max()) + 7],
+        "название_категории": ["Клей канцелярский", "Zzz новая категория"],
+        "category_desc_raw": ["объем: 500 мл; цвет: синий", ""],
+    })
+    changed = pd.concat([added.iloc[[1]], changed, added.iloc[[0]]], ignore_index=True)
+    removed = ids.iloc[[0, 10, 149]].tolist()
+
+    expected = pd.concat([frame[~ids.isin(removed + changed["id_категории"].tolist())], changed])
+    expected = expected.sort_values("id_категории", kind="stable").reset_index(drop=True)
+    full = svc.CategoryIndex.from_frame(svc.lemmatize_frame(expected, workers=1))
+    merged = svc.apply_category_changes(index, changed, removed)
+    assert_same_index(merged, full)
+
+    # в сервисе правки приходят к индексу, открытому из снимка (mmap)
+    svc.save_index_snapshot(index, str(tmp_path / "snap"), csv_hash="test")
+    loaded = svc.load_index_snapshot(str(tmp_path / "snap"))
+    assert_same_index(svc.apply_category_changes(loaded, changed, removed), full)
+    for q in ("клей объем 500 мл цвет синий", "кабель", "ручка гелевая"):
+        assert svc.smart_search(merged, q, top_k=5) == svc.smart_search(full, q, top_k=5), q
+
+
+def test_memory_usage_reports_heap_and_mapped_bytes(index, tmp_path, api):
+    built = index.memory_usage()
+    assert built["mapped_bytes"] == 0
+    assert built["in_memory_bytes"] == sum(built["parts"].values())
+    raw = sum(len(text.encode("utf-8")) for text in index.desc_raw.to_list())
+    assert built["parts"]["desc_raw"] == raw + index.desc_raw.offsets.nbytes
+
+    svc.save_index_snapshot(index, str(tmp_path / "snap"), csv_hash="test")
+    loaded = svc.load_index_snapshot(str(tmp_path / "snap"))
+    usage = loaded.memory_usage()
+    columns = ("ids", "names", "desc_raw", "name_norm", "desc_norm")
+    assert {name: usage["parts"][name] for name in columns} == {name: built["parts"][name] for name in columns}
+    # колонки и постинги уходят в mmap снимка, в куче остаются только словари
+    assert usage["mapped_bytes"] > sum(usage["parts"][name] for name in columns)
+    assert usage["in_memory_bytes"] < built["in_memory_bytes"] - sum(built["parts"][name] for name in columns)
+
+    reported = api.get("/health").json()["index_memory"]
+    assert reported["mapped_bytes"] > 0
+    assert reported["parts"]["desc_raw"] == built["parts"]["desc_raw"]
+
+
+class CountingMorph:
+    """MorphAnalyzer, который считает разборы: кэш лемм должен избавлять от повторных."""
+
+    def __init__(self, morph):
+        self.morph = morph
+        self.parsed = []
+
+    def parse(self, token):
+        self.parsed.append(token)
+        return self.morph.parse(token)
+
+
+def test_lemma_cache_hits_evicts_and_persists(api, tmp_path, monkeypatch):
+    morph = CountingMorph(svc._morph)
+    monkeypatch.setattr(svc, "_morph", morph)
+    monkeypatch.setattr(svc, "_lemma_cache", svc.LRUCache(3))
+
+    assert svc.lemmatize_text("ручки ручки синие 500 мл") == "ручка ручка синий 500 мл"
+    assert morph.parsed == ["ручки", "синие", "мл"]  # числа не разбираются, повтор — из кэша
+    assert svc.lemmatize_text("Синие ручки") == "синий ручка"
+    assert len(morph.parsed) == 3
+    assert svc._lemma_cache.stats()["hits"] == 2
+
+    svc.lemmatize_text("бумага")  # кэш на 3 слова: вытесняется самое давнее ("мл")
+    assert [token for token, _ in svc._lemma_cache.items()] == ["синие", "ручки", "бумага"]
+    svc.lemmatize_text("мл")
+    assert morph.parsed[-1] == "мл"
+
+    path = str(tmp_path / "lemmas.json")
+    svc.save_lemma_cache(path)
+    monkeypatch.setattr(svc, "_lemma_cache", svc.LRUCache(10))
+    assert svc.load_lemma_cache(path) == 3
+    parsed = len(morph.parsed)
+    assert svc.lemmatize_text("бумага ручки мл") == "бумага ручка мл"
+    assert len(morph.parsed) == parsed
+
+    stats = api.get("/health").json()["lemma_cache"]
+    assert stats["maxsize"] == 10 and stats["hits"] >= 3 and 0 < stats["hit_rate"] <= 1
+
+
+def test_result_cache_ignores_case_and_spacing(api):
+    first = api.get("/search/categories", params={"q": "Бумага A4"}).json()
+    hits = svc._result_cache.hits
+    assert api.get("/search/categories", params={"q": "  бумага   a4 "}).json() == first
+    assert svc._result_cache.hits == hits + 1
+
+
+def test_result_cache_follows_index_changes(api, catalog, tmp_path, monkeypatch):
+    def found():
+        return [r["id"] for r in api.get("/search/categories", params={"q": "кабель оптический"}).json()]
+
+    assert 1 not in found()
+    api.post("/index/upsert", json=[{"id": 1, "name": "Кабель оптический"}]).raise_for_status()
+    assert found()[0] == 1
+    api.delete("/index/1").raise_for_status()
+    assert 1 not in found()
+
+    csv = pd.read_csv(catalog)
+    row = csv.iloc[[0]].assign(**{"id_сте": 0, "id_категории": 1, "название_категории": "Кабель оптический"})
+    pd.concat([csv, row]).to_csv(tmp_path / "changed.csv", index=False)
+    monkeypatch.setattr(svc, "CSV_PATH", str(tmp_path / "changed.csv"))
+    api.post("/reload").raise_for_status()
+    assert found()[0] == 1
+
+
+def test_lru_cache_expires_entries():
+    cache = svc.LRUCache(4, ttl=0.05)
+    cache.put("q", [1])
+    assert cache.get("q") == [1]
+    time.sleep(0.06)
+    assert cache.get("q") is None
+    assert cache.stats()["expired"] == 1 and len(cache) == 0
+
+
+def test_snapshot_reattach_runs_off_the_event_loop(service, index, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    service.publish_index(index)
+    monkeypatch.setattr(svc, "SHARED_SNAPSHOT", True)
+    monkeypatch.setattr(svc, "SNAPSHOT_POLL_SECONDS", 0.01)
+    attach = svc.attach_current_snapshot
+    started, release = threading.Event(), threading.Event()
+
+    def slow_attach():
+        started.set()
+        release.wait(10)
+        return attach()
+
+    with TestClient(service.app) as client:
+        old = client.get("/health").json()["index_snapshot"]
+        monkeypatch.setattr(svc, "attach_current_snapshot", slow_attach)
+        changed = pd.DataFrame({"id_категории": [1], "название_категории": ["Кабель оптический"],
+                                "category_desc_raw": [""]})
+        new = svc.publish_live_index(svc.apply_category_changes(svc.cat_index, changed), base=svc.cat_index)
+        assert started.wait(5)
+
+        # переподключение висит в фоновом потоке — запросы идут по старому индексу
+        t0 = time.perf_counter()
+        assert client.get("/health").json()["index_snapshot"] == old
+        assert client.get("/search/categories", params={"q": "кабель оптический"}).status_code == 200
+        assert time.perf_counter() - t0 < 5
+
+        release.set()
+        deadline = time.monotonic() + 10
+        while svc.cat_index.snapshot != new.snapshot and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert client.get("/health").json()["index_snapshot"] == new.snapshot
+        assert client.get("/search/categories", params={"q": "кабель оптический"}).json()[0]["id"] == 1
+
+
+def _shared_snapshot_worker(conn):
+    """Воркер `serve --workers N` после fork: подключается к снимку и ждёт публикации соседа."""
+    try:
+        svc.on_startup()
+        conn.send((svc.cat_index.snapshot, svc.cat_index.memory_usage()["mapped_bytes"] > 0))
+        published = conn.recv()
+        deadline = time.monotonic() + 10
+        while svc.cat_index.snapshot != published and time.monotonic() < deadline:
+            time.sleep(0.01)
+        top = svc.smart_search(svc.cat_index, "кабель оптический", top_k=1)
+        conn.send((svc.cat_index.snapshot, top[0]["id"]))
+    except BaseException as e:
+        conn.send(repr(e))
+    finally:
+        svc.on_shutdown()
+        conn.close()
+
+
+def test_workers_attach_one_snapshot_and_follow_publications(service, monkeypatch):
+    import multiprocessing
+    from fastapi.testclient import TestClient
+
+    built = svc.load_or_build_index()  # процесс-сборщик публикует снимок
+    monkeypatch.setattr(svc, "SHARED_SNAPSHOT", True)
+    monkeypatch.setattr(svc, "SNAPSHOT_POLL_SECONDS", 0.01)
+    monkeypatch.setattr(svc, "build_index_from_csv", lambda *a, **kw: pytest.fail("воркер собирает индекс сам"))
+    ctx = multiprocessing.get_context("fork")
+    pipes, workers = [], []
+    for _ in range(2):
+        conn, child_conn = ctx.Pipe()
+        worker = ctx.Process(target=_shared_snapshot_worker, args=(child_conn,))
+        worker.start()
+        pipes.append(conn)
+        workers.append(worker)
+    try:
+        for conn in pipes:
+            assert conn.poll(60)
+            assert conn.recv() == (built.snapshot, True)
+
+        # правка приходит в третий воркер: он публикует снимок, остальные его подхватывают
+        with TestClient(svc.app) as client:
+            client.post("/index/upsert", json=[{"id": 1, "name": "Кабель оптический"}]).raise_for_status()
+            published = client.get("/health").json()["index_snapshot"]
+        assert published != built.snapshot and svc.read_current_snapshot() == published
+        for conn in pipes:
+            conn.send(published)
+        for conn in pipes:
+            assert conn.poll(30)
+            assert conn.recv() == (published, 1)
+    finally:
+        for worker in workers:
+            worker.join(10)
+            if worker.is_alive():
+                worker.terminate()
+
+
+def test_saturated_search_is_rejected_but_health_answers(api, monkeypatch):
+    monkeypatch.setattr(svc, "MAX_PENDING_SEARCHES", 1)
+    search = svc.smart_search
+    started, release = threading.Event(), threading.Event()
+
+    def slow_search(*args, **kwargs):
+        started.set()
+        release.wait(10)
+        return search(*args, **kwargs)
+
+    monkeypatch.setattr(svc, "smart_search", slow_search)
+    first = {}
+    worker = threading.Thread(
+        target=lambda: first.update(r=api.get("/search/categories", params={"q": "бумага"}))
+    )
+    worker.start()
+    try:
+        assert started.wait(5)
+        rejected = api.get("/search/categories", params={"q": "ручка"})
+        assert rejected.status_code == 503
+        assert rejected.headers["Retry-After"] == "1"
+        health = api.get("/health")
+        assert health.status_code == 200 and health.json()["pending_searches"] == 1
+    finally:
+        release.set()
+        worker.join(10)
+    assert first["r"].status_code == 200
+    assert api.get("/search/categories", params={"q": "ручка"}).status_code == 200
+
+
+def stage_counts(api):
+    """Число наблюдений гистограммы стадий поиска по меткам stage из /metrics."""
+    counts = {}
+    for line in api.get("/metrics").text.splitlines():
+        if line.startswith('smartsearch_search_stage_seconds_count{endpoint="search",'):
+            labels, value = line.rsplit(" ", 1)
+            counts[labels.split('stage="')[1].rstrip('"}')] = int(value)
+    return counts
+
+
+def test_metrics_count_each_search_stage(api):
+    before = stage_counts(api)
+    assert api.get("/search/categories", params={"q": "тетрадь объем 500 мл"}).status_code == 200
+    after = stage_counts(api)
+    stages = {"layout", "spec", "lemmatize", "candidates", "scoring", "serialize"}
+    assert stages <= set(after)
+    assert {stage: after[stage] - before.get(stage, 0) for stage in stages} == dict.fromkeys(stages, 1)
+    assert "# TYPE smartsearch_search_stage_seconds histogram" in api.get("/metrics").text
+
+
+def test_slow_query_is_logged(api, monkeypatch, caplog):
+    monkeypatch.setattr(svc, "SLOW_QUERY_MS", 200.0)
+    search = svc.smart_search
+
+    def slow_search(*args, **kwargs):
+        time.sleep(0.25)
+        return search(*args, **kwargs)
+
+    monkeypatch.setattr(svc, "smart_search", slow_search)
+    svc.logger.addHandler(caplog.handler)  # у логгера сервиса propagate выключен
+    try:
+        api.get("/search/categories", params={"q": "степлер"})
+        api.get("/search/categories", params={"q": "степлер"})  # из кэша — быстро
+    finally:
+        svc.logger.removeHandler(caplog.handler)
+    slow = [r.getMessage() for r in caplog.records if r.getMessage().startswith("Медленный запрос")]
+    assert len(slow) == 1 and "q='степлер'" in slow[0] and "scoring" in slow[0]
+
+
+def test_suggest_trie_orders_and_tolerates_typos():
+    trie = svc.SuggestTrie.build(["ручка шариковый", "гелевый ручка", "ручка", "рулетка"])
+    # с начала названия раньше, чем с середины; среди них — короткие раньше
+    assert trie.search("руч") == [(2, 0), (0, 0), (1, 0)]
+    assert trie.search("руч", max_distance=1) == [(2, 0), (0, 0), (1, 0), (3, 1)]
+    assert trie.search("рцчка", max_distance=1) == [(2, 1), (0, 1), (1, 1)]
+    assert trie.search("рцчка") == []
+    assert trie.search("ручка ш", limit=1) == [(0, 0)]
+
+
+def test_suggest_follows_index_changes(api):
+    def suggested(q, max_distance=None):
+        params = {"q": q} if max_distance is None else {"q": q, "max_distance": max_distance}
+        return [(r["name"], r["distance"]) for r in api.get("/suggest", params=params).json()]
+
+    def wait_for(q, expected):
+        # после правки дерево достраивается в фоне, до тех пор подсказки — по прежнему индексу
+        deadline = time.monotonic() + 10
+        while suggested(q, 0) != expected and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert suggested(q, 0) == expected
+
+    assert svc._suggest_index is svc.cat_index and svc.cat_index._suggest is not None
+    assert svc.cat_index._layout is not None
+    assert suggested("зонт", 0) == []
+    api.post("/index/upsert", json=[{"id": 1, "name": "Зонт складной"}]).raise_for_status()
+    wait_for("зонт", [("Зонт складной", 0)])
+    assert suggested("pjyn", 0) == [("Зонт складной", 0)]  # EN-раскладка
+    assert suggested("зонд скла")[0] == ("Зонт складной", 1)
+    api.delete("/index/1").raise_for_status()
+    wait_for("зонт", [])
+
+
+def test_spec_index_ranks_attribute_only_matches():
+    spec = svc.SpecIndex.build([
+        "Цвет: синий; Объем: 500 мл",
+        "Цвет: синий | Цвет: красный; Объем: 500 мл",
+        "Цвет: красный",
+        "Цвет: синий | Цвет: красный | Цвет: белый",
+    ], svc.lemmatize_token)
+    text, attrs = spec.parse_query("цвет синий")
+    rows, share = spec.match(attrs)
+    assert text == "" and rows.tolist() == [0, 1, 3] and share == 1.0
+    assert spec.specificity(attrs, rows).tolist() == pytest.approx([1.0, 1 / 2, 1 / 3])
+
+    text, attrs = spec.parse_query("объем 500 мл цвет синий")
+    rows, share = spec.match(attrs)
+    assert rows.tolist() == [0, 1] and share == 1.0
+    assert spec.specificity(attrs, rows).tolist() == pytest.approx([1.0, 0.75])
+
+
+def test_attribute_only_query_is_ranked(index):
+    results = svc.smart_search(index, "цвет синий", top_k=len(index), min_score=0.0)
+    keys = [(-r["score"], r["id"]) for r in results]
+    assert keys == sorted(keys) and len({r["score"] for r in results}) > 1
+    assert all(r["score_spec"] == 100.0 and 0 < r["score"] <= 100.0 for r in results)
+
+
+class InProcessShards(Search_shard.ShardClient):
+    """ShardClient без сокетов: шарды — индексы этого процесса, ответы идут через JSON, как по сокету."""
+
+    def __init__(self, indexes):
+        super().__init__(len(indexes))
+        self.indexes = indexes
+
+    def gather(self, op, shards=None, timeout=None, **args):
+        replies = {}
+        for i in range(self.shards) if shards is None else shards:
+            svc.cat_index = self.indexes[i]
+            reply = Search_shard._handle(json.dumps({"op": op, "args": args}).encode("utf-8"))
+            self.indexes[i] = svc.cat_index
+            assert reply["ok"], reply
+            replies[i] = json.loads(json.dumps(reply["result"], ensure_ascii=False))
+        return replies, {}
+
+
+def spec_queries(index):
+    """Запросы с 1-7 характеристиками строк каталога, без текста и без совпадений по тексту."""
+    rnd = np.random.default_rng(7)
+    terms = list(index.spec.terms)
+    queries = ["клей объем 500 мл цвет синий", "объем 500 мл цвет синий", "500 мл", "qqqq цвет синий"]
+    for row in rnd.choice(len(index), 30, replace=False).tolist():
+        picked = rnd.choice(terms, int(rnd.integers(1, 8)), replace=False)
+        attrs = " ".join(t.replace("=", " ") for t in picked)
+        queries.append(f"{index.names[row].split()[0]} {attrs}")
+    return queries
+
+
+def test_sharded_search_matches_single_index(service, tmp_path, monkeypatch):
+    # мало СТЕ на категорию — у шардов разные наборы характеристик
+    sparse = tmp_path / "sparse.csv"
+    Search_benchmark.make_synthetic_csv(str(sparse), 150, products_per_category=2)
+    monkeypatch.setattr(svc, "CSV_PATH", str(sparse))
+    monkeypatch.setattr(svc, "ITEM_SEARCH", True)
+    full = svc.build_index_from_csv()
+    shards = []
+    for i in range(3):
+        monkeypatch.setattr(svc, "CATEGORY_SHARD", (i, 3))
+        shards.append(svc.build_index_from_csv())
+    monkeypatch.setattr(svc, "CATEGORY_SHARD", None)
+    client = InProcessShards(shards)
+    client.sync_catalog()
+
+    queries = [q for _, q in Search_benchmark.make_query_mix(full.names.to_list(), 100)]
+    spec = spec_queries(full)
+    # шарды расходятся в лучшем совпадении характеристик — координатор должен это разрешать
+    assert any(
+        len({r["score_spec"] for r in client.gather("search", q=q, top_k=10, min_score=30.0)[0].values()}) > 1
+        for q in spec
+    )
+    for q in queries + spec:
+        for exhaustive in (False, True):
+            got, _ = client.search(q, top_k=10, min_score=30.0, exhaustive=exhaustive)
+            assert got == svc.smart_search(full, q, top_k=10, min_score=30.0, exhaustive=exhaustive), q
+    batch = dict(client.iter_batch(queries + spec, top_k=5, min_score=30.0))
+    assert batch == {q: svc.smart_search(full, q, top_k=5, min_score=30.0) for q in queries + spec}
+    for q in queries[:30]:
+        assert client.search_items(q, 5, 3, 30.0)[0] == svc.search_items(full, q, 5, 3, 30.0), q
+
+    # правка шарда без координатора: поиск замечает чужой ключ и пересылает статистику
+    shards[0] = svc.apply_category_changes(shards[0], pd.DataFrame(columns=svc._RAW_CATEGORY_COLUMNS), [])
+    got, _ = client.search("клей объем 500 мл цвет синий", top_k=10, min_score=30.0)
+    assert client.indexes[0].catalog == client.catalog_key
+    assert got == svc.smart_search(full, "клей объем 500 мл цвет синий", top_k=10, min_score=30.0)
+
+
+def test_shard_socket_needs_private_dir_and_authkey(index, tmp_path, monkeypatch):
+    from multiprocessing import AuthenticationError
+    from multiprocessing.connection import Client
+
+    monkeypatch.setattr(svc, "cat_index", index)
+    monkeypatch.setattr(Search_shard, "SHARD_AUTHKEY", b"k" * 32)
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    shared.chmod(0o777)
+    with pytest.raises(Search_shard.ShardError):
+        Search_shard.shard_listener(Search_shard.shard_socket_path(0, 1, str(shared)))
+
+    socket_dir = str(tmp_path / "sockets")
+    listener = Search_shard.shard_listener(Search_shard.shard_socket_path(0, 1, socket_dir))
+    assert os.stat(socket_dir).st_mode & 0o777 == 0o700
+    threading.Thread(target=Search_shard.accept_connections, args=(listener,), daemon=True).start()
+    try:
+        with pytest.raises(AuthenticationError):
+            Client(Search_shard.shard_socket_path(0, 1, socket_dir), family="AF_UNIX", authkey=b"x" * 32)
+        # чужой клиент отброшен, шард по-прежнему отвечает своим
+        client = Search_shard.ShardClient(1, socket_dir)
+        assert client.health()["categories_indexed"] == len(index)
+        client.close()
+    finally:
+        listener.close()
+
+
+def test_query_mix_follows_proportions_and_layout(index):
+    names = index.names.to_list()
+    mix = Search_benchmark.make_query_mix(names, 2000)
+    assert mix == Search_benchmark.make_query_mix(names, 2000)
+    counts = {kind: sum(k == kind for k, _ in mix) for kind, _ in Search_benchmark.QUERY_MIX}
+    for kind, share in Search_benchmark.QUERY_MIX:
+        assert abs(counts[kind] / len(mix) - share) < 0.03, kind
+    lowered = {name.lower() for name in names}
+    for kind, q in mix:
+        if kind == "layout":
+            assert q.isascii() and q.translate(svc.EN_TO_RU) in lowered, q
+        elif kind == "exact":
+            assert q in lowered
+
+
+def test_latency_summary_and_regression_check():
+    summary = Search_benchmark.latency_summary([i / 1000 for i in range(1, 101)], wall=2.0)
+    assert summary == {
+        "queries": 100, "qps": 50.0, "p50_ms": 50.5, "p95_ms": 95.05, "p99_ms": 99.01, "max_ms": 100.0,
+    }
+    baseline = {"1000/in-process": {"qps": 100.0, "p95_ms": 10.0}, "1000/http": {"qps": 50.0, "p95_ms": 20.0}}
+    current = {
+        "1000/in-process": {"qps": 90.0, "p95_ms": 11.0},   # в пределах 20%
+        "1000/http": {"qps": 40.0, "p95_ms": 30.0},         # хуже по обоим
+        "10000/in-process": {"qps": 1.0, "p95_ms": 999.0},  # нет в базовом прогоне
+    }
+    problems = Search_benchmark.find_regressions(current, baseline, tolerance=0.2)
+    assert problems == ["1000/http: p95 20.0 -> 30.0 мс", "1000/http: QPS 50.0 -> 40.0"]
+
+
+def test_bench_search_reports_in_process_and_http(service, monkeypatch, capsys):
+    monkeypatch.setattr(svc, "SHARED_SNAPSHOT", False)
+    monkeypatch.setattr(svc._result_cache, "maxsize", svc._result_cache.maxsize)
+    level = svc.logger.level
+    try:
+        results = Search_benchmark.bench_search([60], products=3, n_queries=80, concurrency=2)
+    finally:
+        svc.logger.setLevel(level)
+    assert set(results) == {"60/in-process", "60/http"}
+    for summary in results.values():
+        assert summary["queries"] == 80 and summary["qps"] > 0
+        assert 0 < summary["p50_ms"] <= summary["p95_ms"] <= summary["p99_ms"] <= summary["max_ms"]
+    assert "Категорий: 60" in capsys.readouterr().out
+
+
+def test_items_endpoint_groups_items_by_category(service, catalog, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    ste = pd.read_csv(catalog, usecols=["id_сте", "название_сте", "id_категории"])
+    category_of = dict(zip(ste["id_сте"], ste["id_категории"]))
+    with TestClient(service.app) as client:
+        assert client.get("/search/items", params={"q": "ручка"}).status_code == 400
+
+    monkeypatch.setattr(svc, "ITEM_SEARCH", True)
+    with TestClient(service.app) as client:
+        def items(q, **params):
+            response = client.get("/search/items", params={"q": q, **params})
+            assert response.status_code == 200
+            return response.json()
+
+        name = ste["название_сте"].iloc[17]
+        groups = items(name, top_k=5, per_category=3, min_score=40)
+        assert groups[0]["items"][0]["name"] == name and groups[0]["items"][0]["score"] == 100.0
+        assert groups[0]["id"] == ste["id_категории"].iloc[17]
+        assert 0 < len(groups) <= 5
+        assert [g["score"] for g in groups] == sorted((g["score"] for g in groups), reverse=True)
+        for group in groups:
+            scores = [item["score"] for item in group["items"]]
+            assert 0 < len(scores) <= 3 and scores == sorted(scores, reverse=True)
+            assert group["score"] == scores[0] and scores[-1] >= 40
+            assert all(category_of[item["id"]] == group["id"] for item in group["items"])
+
+        assert groups == svc.search_items(svc.cat_index, name, top_k=5, per_category=3, min_score=40)
+        layout = name.lower().translate(Search_benchmark._RU_TO_EN)
+        assert items(layout, top_k=5, per_category=3, min_score=40) == groups
+        assert items("qqqqzzzz") == []